@@ -17,12 +17,22 @@ from flask import (
 )
 
 from api.app_logger import get_logger
+from api.cookies import verify_signature
 from . import env_config
 
+from . import admission
+from . import deadlines
+from . import tracing
+from . import metrics
 from . import sfmc_oauth2
 from . import laasie_api_auth
 from . import sfmc_api_proxy
 from . import laasie_api_proxy
+from . import laasie_spool
+from . import persistent_cache
+from . import session_store
+from . import traffic_capture
+from . import warmup
 
 logger = get_logger("app-main")
 csrf = CSRFProtect()
@@ -58,6 +68,33 @@ def create_app(test_config=None):
                 "Could not create instance folder: %s %s", ex.strerror, ex.errno
             )
 
+    if app.config.get("SERVER_SIDE_SESSIONS"):
+        session_store.init_store(app.instance_path)
+
+    if app.config.get("LAASIE_ASYNC_DELIVERY"):
+        if app.config.get("SERVER_SIDE_SESSIONS"):
+            laasie_spool.init_spool(app.instance_path)
+        else:
+            logger.error(
+                "LAASIE_ASYNC_DELIVERY needs SERVER_SIDE_SESSIONS."
+                " Payloads are sent to Laasie synchronously."
+            )
+
+    if app.config.get("CAPTURE_ENABLED"):
+        traffic_capture.init_capture(app.instance_path)
+
+    if app.config.get("PERSISTENT_CACHE_ENABLED"):
+        persistent_cache.init_cache(app.instance_path)
+
+    if app.config.get("TRACING_ENABLED"):
+        tracing.init_app(app)
+
+    deadlines.init_app(app)
+
+    if app.config.get("ADMISSION_ENABLED"):
+        admission.init_app(app)
+
+    app.register_blueprint(metrics.bp)
     app.register_blueprint(sfmc_oauth2.bp)
     app.register_blueprint(laasie_api_auth.bp)
     app.register_blueprint(sfmc_api_proxy.bp)
@@ -69,6 +106,17 @@ def create_app(test_config=None):
 
     @app.route("/logout", methods=["POST"])
     def logout():
+        if session_store.get_store() is not None:
+            session_data = session_store.get_current_session() or {}
+            decoded_token = session_data.get("access_token")
+        else:
+            access_token = flask_request.cookies.get(
+                sfmc_oauth2.ACCESS_TOKEN_COOKIE_NAME
+            )
+            decoded_token = verify_signature(access_token) if access_token else None
+        if decoded_token is not None:
+            warmup.cancel(decoded_token)
+
         resp = make_response()
         resp.status_code = 204
         sfmc_oauth2.delete_cookies(resp)
@@ -145,4 +193,9 @@ def create_app(test_config=None):
 
         return resp
 
+    if app.config.get("TRACING_ENABLED"):
+        # Registered last so that it runs before the other after_request
+        # hooks and the tracing covers them.
+        app.after_request(tracing.mark_after_request)
+
     return app
@@ -0,0 +1,410 @@
+"""
+Admission control and load shedding for the app.
+
+Requests that call an upstream (the API proxies and the token
+endpoints) are admitted into a lane with a cap on the number of
+requests in flight. Requests over the cap wait for a slot for a short
+time and are shed with a 503 and a Retry-After header if none frees up,
+or right away if too many are already waiting.
+
+The upstream lane is shared fairly between the tenants (SFMC tenant
+sub-domains) of the requests, so that one tenant's bulk edits don't
+hold up the others. Each tenant has its own queue and is capped at
+`ADMISSION_TENANT_MAX_INFLIGHT` requests in flight, and freed slots go
+to the tenant whose requests have had the least of the lane relative to
+its weight (start-time fair queueing). When the queue is full, a tenant
+with a smaller share of the lane takes the place of the latest waiting
+request of the tenant with the largest one.
+
+A request holds its slot until its response has been sent. Requests
+that fan out into concurrent upstream calls, such as bulk imports and
+batches, run as many of them at once as the slots they hold, taking
+more slots only if they are free right away (see `hold_more_slots`.)
+
+The OAuth2 callbacks have a lane of their own, so logins still work
+while the proxies are saturated. Health checks, static files and the
+UI's `index.html` bypass admission entirely: since the proxies can't
+occupy more than `ADMISSION_MAX_INFLIGHT + ADMISSION_MAX_QUEUE` of the
+worker's threads, the remaining threads are always available to them.
+"""
+from collections import deque
+from dataclasses import dataclass, field
+import math
+import threading
+import time
+from typing import Optional
+
+from flask import Flask, g, request as flask_request
+from flask.wrappers import Response
+
+from api import metrics, session_store, sfmc_oauth2, tracing
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("admission")
+
+UPSTREAM_LANE = "upstream"
+OAUTH_LANE = "oauth"
+# Paths whose requests call an upstream and are admitted into the
+# upstream lane. Any other path under /oauth2/ uses the OAuth lane.
+UPSTREAM_PATH_PREFIXES = ("/api/", "/auth/", "/oauth2/sfmc/refresh_token")
+OAUTH_PATH_PREFIX = "/oauth2/"
+# Weight of the latest queue wait in the moving average used for the
+# Retry-After header.
+WAIT_SMOOTHING = 0.2
+# The number of tenants labelled by name in the metrics of a lane.
+MAX_TENANT_LABELS = 64
+
+shed_total = metrics.counter(
+    "admission_shed_total",
+    "Requests rejected by admission control, by lane, tenant and reason.",
+)
+queue_wait = metrics.histogram(
+    "admission_queue_wait_seconds",
+    "Time requests waited for a slot, by lane and tenant.",
+)
+inflight = metrics.gauge("admission_inflight", "Requests in flight, by lane.")
+
+
+@dataclass(eq=False)
+class Waiter:
+    """
+    A request waiting for a slot.
+    """
+
+    admitted: bool = False
+    pushed_out: bool = False
+
+
+@dataclass(eq=False)
+class TenantState:
+    """
+    The requests of a tenant in a lane.
+    """
+
+    weight: float
+    inflight: int = 0
+    waiters: deque = field(default_factory=deque)
+    # The virtual time at which the tenant's last admitted request ends.
+    finish: float = 0.0
+
+    @property
+    def load(self) -> float:
+        # pylint: disable=missing-function-docstring
+        return (self.inflight + len(self.waiters)) / self.weight
+
+
+class Lane:
+    """
+    Caps the number of requests in flight and the number waiting, and
+    shares the slots between tenants in proportion to their weights.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_inflight: int,
+        max_queue: int,
+        max_queue_wait: float,
+        max_tenant_inflight: Optional[int] = None,
+        weights: Optional[dict[str, float]] = None,
+    ) -> None:
+        self.name = name
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.max_tenant_inflight = (
+            max_inflight if max_tenant_inflight is None else max_tenant_inflight
+        )
+        self.weights = weights or {}
+        self.inflight = 0
+        self.waiting = 0
+        self.average_wait = 0.0
+        # The start tag of the last admitted request.
+        self.virtual_time = 0.0
+        self._tenants: dict[str, TenantState] = {}
+        self._labels: set[str] = set()
+        self._condition = threading.Condition()
+
+    def _get_state(self, tenant: str) -> TenantState:
+        state = self._tenants.get(tenant)
+        if state is None:
+            state = TenantState(self.weights.get(tenant, 1.0), finish=self.virtual_time)
+            self._tenants[tenant] = state
+        return state
+
+    def _has_free_slot(self, state: TenantState) -> bool:
+        return (
+            self.inflight < self.max_inflight
+            and state.inflight < self.max_tenant_inflight
+            and not state.waiters
+        )
+
+    def try_acquire(self, tenant: str = "") -> bool:
+        """
+        Takes a slot and returns True if one is free right away, without
+        waiting, otherwise returns False.
+        """
+        with self._condition:
+            state = self._get_state(tenant)
+            if self._has_free_slot(state):
+                self._admit(state)
+                return True
+            self._forget(tenant)
+            return False
+
+    def acquire(self, tenant: str = "") -> bool:
+        """
+        Waits for a slot and returns True, or returns False if the
+        request should be shed.
+        """
+        started_at = time.monotonic()
+        with self._condition:
+            state = self._get_state(tenant)
+            if self._has_free_slot(state):
+                self._admit(state)
+                self._record_wait(tenant, time.monotonic() - started_at)
+                return True
+            if self.waiting >= self.max_queue and not self._push_out(state):
+                shed_total.inc(
+                    lane=self.name, tenant=self._label(tenant), reason="queue_full"
+                )
+                self._forget(tenant)
+                return False
+
+            waiter = Waiter()
+            state.waiters.append(waiter)
+            self.waiting += 1
+            self._condition.wait_for(
+                lambda: waiter.admitted or waiter.pushed_out,
+                timeout=self.max_queue_wait,
+            )
+            wait = time.monotonic() - started_at
+            if not waiter.admitted:
+                if not waiter.pushed_out:
+                    state.waiters.remove(waiter)
+                    self.waiting -= 1
+                reason = "pushed_out" if waiter.pushed_out else "queue_timeout"
+                shed_total.inc(
+                    lane=self.name, tenant=self._label(tenant), reason=reason
+                )
+                self._record_wait(tenant, wait)
+                self._forget(tenant)
+                return False
+            self._record_wait(tenant, wait)
+        return True
+
+    def release(self, tenant: str = "", slots: int = 1):
+        """
+        Frees the slots of a finished request and hands them to the next
+        waiting requests.
+        """
+        with self._condition:
+            self._tenants[tenant].inflight -= slots
+            self.inflight -= slots
+            inflight.set(self.inflight, lane=self.name)
+            self._forget(tenant)
+            self._dispatch()
+
+    def retry_after(self) -> int:
+        """
+        Returns the number of seconds a shed client should wait before
+        retrying, based on the recent queue wait times.
+        """
+        return max(1, math.ceil(2 * self.average_wait))
+
+    def _admit(self, state: TenantState):
+        # Start-time fair queueing: the tenant's next request starts when
+        # its previous one ends in virtual time, which advances by the
+        # inverse of its weight per request.
+        self.virtual_time = max(state.finish, self.virtual_time)
+        state.finish = self.virtual_time + 1 / state.weight
+        state.inflight += 1
+        self.inflight += 1
+        inflight.set(self.inflight, lane=self.name)
+
+    def _dispatch(self):
+        """
+        Admits waiting requests into the free slots, first those of the
+        tenants that are furthest behind in virtual time.
+        """
+        admitted = False
+        while self.inflight < self.max_inflight:
+            eligible = [
+                state
+                for state in self._tenants.values()
+                if state.waiters and state.inflight < self.max_tenant_inflight
+            ]
+            if not eligible:
+                break
+            state = min(eligible, key=lambda state: state.finish)
+            state.waiters.popleft().admitted = True
+            self.waiting -= 1
+            self._admit(state)
+            admitted = True
+        if admitted:
+            self._condition.notify_all()
+
+    def _push_out(self, state: TenantState) -> bool:
+        """
+        Sheds the latest waiting request of the tenant with the largest
+        weighted share of the lane to make room for one of a tenant with
+        a smaller share. Returns whether there is room now.
+        """
+        heaviest = max(
+            (other for other in self._tenants.values() if other.waiters),
+            key=lambda other: other.load,
+            default=None,
+        )
+        if heaviest is None or heaviest.load <= state.load + 1 / state.weight:
+            return False
+        heaviest.waiters.pop().pushed_out = True
+        self.waiting -= 1
+        self._condition.notify_all()
+        return True
+
+    def _forget(self, tenant: str):
+        state = self._tenants.get(tenant)
+        if state is not None and state.inflight == 0 and not state.waiters:
+            del self._tenants[tenant]
+
+    def _label(self, tenant: str) -> str:
+        """
+        Returns the tenant label of the metrics, which is "other" for
+        tenants beyond the first MAX_TENANT_LABELS.
+        """
+        if tenant not in self._labels:
+            if len(self._labels) >= MAX_TENANT_LABELS:
+                return "other"
+            self._labels.add(tenant)
+        return tenant
+
+    def _record_wait(self, tenant: str, wait: float):
+        queue_wait.observe(wait, lane=self.name, tenant=self._label(tenant))
+        self.average_wait += WAIT_SMOOTHING * (wait - self.average_wait)
+
+
+def parse_tenant_weights(value: str) -> dict[str, float]:
+    """
+    Returns the weights of the tenants from comma-separated
+    `tssd=weight` pairs. Pairs that aren't valid or whose weight isn't
+    positive are logged and skipped.
+    """
+    weights = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        name, _, weight = pair.partition("=")
+        try:
+            parsed = float(weight)
+        except ValueError:
+            parsed = math.nan
+        if not name.strip() or not 0 < parsed < math.inf:
+            logger.error("Ignoring the invalid tenant weight %r.", pair.strip())
+            continue
+        weights[name.strip()] = parsed
+    return weights
+
+
+def get_tenant() -> str:
+    """
+    Returns the tenant sub-domain of the request, or "" if it has none.
+    It is only used to schedule the request, before it is authenticated.
+    """
+    tenant = flask_request.cookies.get(sfmc_oauth2.TSSD_COOKIE_NAME)
+    if tenant is None and session_store.get_store() is not None:
+        session_data = session_store.get_current_session()
+        tenant = session_data.get("tssd") if session_data is not None else None
+    if tenant is None or sfmc_oauth2.tssd_regex.fullmatch(tenant) is None:
+        return ""
+    return tenant
+
+
+def hold_more_slots(count: int) -> int:
+    """
+    Takes up to `count` more slots of the request's lane for its tenant,
+    as long as they are free right away, and holds them with the
+    request's slot until its response has been sent. Returns the number
+    of slots taken, or `count` if the request isn't admission controlled.
+    """
+    admitted = g.get("admission_lane")
+    if admitted is None:
+        return count
+    lane, tenant, slots = admitted
+    taken = 0
+    while taken < count and lane.try_acquire(tenant):
+        taken += 1
+    g.admission_lane = lane, tenant, slots + taken
+    return taken
+
+
+def get_lane_name(path: str) -> Optional[str]:
+    """
+    Returns the name of the lane for a request path, or None if the
+    request bypasses admission control.
+    """
+    if path.startswith(UPSTREAM_PATH_PREFIXES):
+        return UPSTREAM_LANE
+    if path.startswith(OAUTH_PATH_PREFIX):
+        return OAUTH_LANE
+    return None
+
+
+def init_app(app: Flask):
+    """
+    Registers admission control for all requests of the app.
+    """
+    lanes = {
+        UPSTREAM_LANE: Lane(
+            UPSTREAM_LANE,
+            env_config.ADMISSION_MAX_INFLIGHT,
+            env_config.ADMISSION_MAX_QUEUE,
+            env_config.ADMISSION_MAX_QUEUE_WAIT,
+            env_config.ADMISSION_TENANT_MAX_INFLIGHT,
+            parse_tenant_weights(env_config.ADMISSION_TENANT_WEIGHTS),
+        ),
+        OAUTH_LANE: Lane(
+            OAUTH_LANE,
+            env_config.ADMISSION_OAUTH_MAX_INFLIGHT,
+            0,
+            0,
+        ),
+    }
+
+    @app.before_request
+    def admit():
+        lane_name = get_lane_name(flask_request.path)
+        if lane_name is None:
+            return None
+
+        lane = lanes[lane_name]
+        tenant = get_tenant() if lane_name == UPSTREAM_LANE else ""
+        with tracing.span("queue"):
+            admitted = lane.acquire(tenant)
+        if not admitted:
+            logger.error("Shedding request to %s", flask_request.path)
+            resp = Response(status=503, response="Service busy. Try again later.")
+            resp.headers["Retry-After"] = str(lane.retry_after())
+            return resp
+
+        g.admission_lane = lane, tenant, 1
+        return None
+
+    @app.after_request
+    def release_on_close(resp: Response) -> Response:
+        # Streamed bodies are sent after the request is torn down, so the
+        # slot is held until the response is closed.
+        admitted = g.pop("admission_lane", None)
+        if admitted is not None:
+            lane, tenant, slots = admitted
+            resp.call_on_close(lambda: lane.release(tenant, slots))
+        return resp
+
+    @app.teardown_request
+    def release(exc):
+        # pylint: disable=unused-argument
+        # Only requests that failed without a response still hold a slot.
+        admitted = g.pop("admission_lane", None)
+        if admitted is not None:
+            lane, tenant, slots = admitted
+            lane.release(tenant, slots)
@@ -25,18 +25,25 @@ formatter = RequestFormatter(
     "%(remote_addr)s [%(asctime)s] ::%(name)s:: %(levelname)s: %(message)s"
 )
 
+# The names of the loggers returned by `get_logger`.
+_logger_names: set[str] = set()
+
 
 def get_logger(name: str) -> logging.Logger:
     """
-    Returns a logger instance for the given name.
+    Returns a logger instance for the given name. Calling it again for
+    the same name doesn't add the handlers again.
     """
     logger = logging.getLogger(name)
+    _logger_names.add(name)
     if env_config.FLASK_DEBUG != "1":
         gunicorn_logger = logging.getLogger("gunicorn.error")
-        logger.handlers.extend(gunicorn_logger.handlers)
+        for h in gunicorn_logger.handlers:
+            if h not in logger.handlers:
+                logger.addHandler(h)
         for h in logger.handlers:
             h.setFormatter(formatter)
-    else:
+    elif not logger.handlers:
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
         logger.addHandler(handler)
@@ -46,3 +53,17 @@ def get_logger(name: str) -> logging.Logger:
     else:
         logger.setLevel(logging.INFO)
     return logger
+
+
+def reset():
+    """
+    Replaces the handlers of the loggers returned by `get_logger`, which
+    were added in the process that imported the modules, with the
+    current handlers of gunicorn's error log. Called in each worker after
+    it is forked.
+    """
+    for name in list(_logger_names):
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        get_logger(name)
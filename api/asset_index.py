@@ -0,0 +1,688 @@
+"""
+An incremental, in-memory index of the HTML blocks each user can see
+in a business unit.
+
+Before saving a block, the UI looks it up by its customer key, and
+listing the blocks of a category always queries SFMC. The index keeps
+the metadata of the user's HTML blocks (id, customer key,
+name, category and modified date) so that these requests can be
+answered without calling SFMC, when they only ask for indexed fields
+with the `fields` query parameter (see `projection`.) The syncs don't
+fetch the content of the blocks: the hash of a block's content is only
+known once the proxy has created or updated it, and is kept until a
+sync returns another modified date.
+
+The first lookup of a user starts a full sync in the
+background. After that, the index is kept current by delta syncs,
+which only query the blocks modified since the latest modified date
+seen, and by the blocks the proxy creates and updates. A sync doesn't
+overwrite the blocks the proxy wrote while it ran. An index synced
+more than `ASSET_INDEX_SYNC_INTERVAL` seconds ago answers while a delta
+sync runs in the background, and one older than
+`ASSET_INDEX_MAX_STALENESS` seconds is synced before it answers.
+Deleted blocks are only noticed by the periodic full syncs, or when an
+update of the block returns a 404.
+
+Indexes are kept per worker process and per user of a business unit,
+so a user is only answered with the blocks their own syncs returned:
+the users of a business unit may not have access to the same folders.
+The user and business unit of an access token come from its user info,
+which the warmup usually has already cached.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+import hashlib
+import re
+import threading
+import time
+from typing import Any, Optional
+
+import requests
+
+from api import deadlines, json_codec, metrics, projection, response_cache, upstream
+from api.app_logger import get_logger
+from api.proxy_engine import ProxyRequest, UpstreamResponse
+from . import env_config
+
+logger = get_logger("asset-index")
+
+HTML_BLOCK = "htmlblock"
+ASSETS_QUERY_PATH = "/asset/v1/content/assets/query"
+USER_INFO_PATH = "/v2/userinfo"
+SYNC_PAGE_SIZE = 250
+SYNC_FIELDS = ["id", "customerKey", "name", "category", "modifiedDate"]
+# The fields of the items the index answers with.
+INDEXED_FIELDS: projection.Projection = {
+    "id": None,
+    "customerKey": None,
+    "name": None,
+    "modifiedDate": None,
+    "category": {"id": None, "name": None},
+    "assetType": {"name": None},
+}
+CUSTOMER_KEY_FILTER = re.compile(r"\s*customerKey\s+eq\s+'((?:[^']|'')*)'\s*")
+FRACTIONAL_SECONDS = re.compile(r"\.\d+")
+# The largest number of access tokens whose user is kept.
+MAX_KNOWN_TOKENS = 4096
+
+lookups_total = metrics.counter(
+    "asset_index_lookups_total", "Asset index lookups by kind and result."
+)
+syncs_total = metrics.counter(
+    "asset_index_syncs_total", "Asset index syncs by kind and outcome."
+)
+sync_duration = metrics.histogram(
+    "asset_index_sync_duration_seconds", "Time taken by asset index syncs, by kind."
+)
+
+
+@dataclass(frozen=True)
+class IndexedAsset:
+    """
+    The indexed metadata of an HTML block.
+    """
+
+    id: int
+    customer_key: str
+    name: str
+    category_id: Optional[int]
+    category_name: Optional[str]
+    modified_date: str
+    # The hash of the content, if the item had it.
+    content_hash: Optional[str] = None
+
+    def to_item(self) -> dict[str, Any]:
+        """
+        Returns the asset as an item of an SFMC asset listing.
+        """
+        return {
+            "id": self.id,
+            "customerKey": self.customer_key,
+            "name": self.name,
+            "modifiedDate": self.modified_date,
+            "category": {"id": self.category_id, "name": self.category_name},
+            "assetType": {"name": HTML_BLOCK},
+        }
+
+
+def content_hash(content: Optional[str]) -> str:
+    """
+    Returns the hash of the content of an asset.
+    """
+    return hashlib.sha256((content or "").encode()).hexdigest()
+
+
+def from_item(item: Any) -> Optional[IndexedAsset]:
+    """
+    Returns the indexed metadata of an asset returned by SFMC, or None
+    if it isn't an HTML block. The asset type is assumed when the item
+    doesn't have one, as in the results of a sync.
+    """
+    if not isinstance(item, dict) or not isinstance(item.get("id"), int):
+        return None
+    asset_type = item.get("assetType") or {"name": HTML_BLOCK}
+    if asset_type.get("name") != HTML_BLOCK:
+        return None
+    category = item.get("category") or {}
+    return IndexedAsset(
+        id=item["id"],
+        customer_key=item.get("customerKey", ""),
+        name=item.get("name", ""),
+        category_id=category.get("id"),
+        category_name=category.get("name"),
+        modified_date=item.get("modifiedDate", ""),
+        content_hash=content_hash(item["content"]) if "content" in item else None,
+    )
+
+
+def parse_date(value: str) -> Optional[datetime]:
+    """
+    Returns the time of an SFMC date, ignoring fractions of seconds, or
+    None if it can't be parsed.
+    """
+    try:
+        parsed = datetime.fromisoformat(
+            FRACTIONAL_SECONDS.sub("", value).replace("Z", "+00:00")
+        )
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+@dataclass
+class AssetIndex:
+    """
+    The indexed HTML blocks of a user in a business unit.
+    """
+
+    assets: dict[int, IndexedAsset] = field(default_factory=dict)
+    ids_by_key: dict[str, int] = field(default_factory=dict)
+    # The latest modified date seen by a sync, from which the next delta
+    # sync starts.
+    watermark: Optional[str] = None
+    # When the last successful sync and full sync started.
+    synced_at: float = 0.0
+    full_synced_at: float = 0.0
+    # Whether a full sync has completed.
+    complete: bool = False
+    syncing: bool = False
+    # When the proxy last wrote or removed each asset, to keep the syncs
+    # that started before from overwriting it.
+    written_at: dict[int, float] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    sync_lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def upsert(self, asset: IndexedAsset):
+        """
+        Adds or replaces an asset written by the proxy.
+        """
+        with self.lock:
+            self.written_at[asset.id] = time.monotonic()
+            self._remove(asset.id)
+            self._add(asset)
+
+    def remove(self, asset_id: int):
+        """
+        Removes an asset, if indexed.
+        """
+        with self.lock:
+            self.written_at[asset_id] = time.monotonic()
+            self._remove(asset_id)
+
+    def _add(self, asset: IndexedAsset):
+        self.assets[asset.id] = asset
+        self.ids_by_key[asset.customer_key] = asset.id
+
+    def _remove(self, asset_id: int):
+        previous = self.assets.pop(asset_id, None)
+        if (
+            previous is not None
+            and self.ids_by_key.get(previous.customer_key) == asset_id
+        ):
+            del self.ids_by_key[previous.customer_key]
+
+    def apply_sync(self, assets: list[IndexedAsset], full: bool, started_at: float):
+        """
+        Updates the index with the assets returned by a sync that started
+        at `started_at`, replacing all the others for a full sync. The
+        assets written since are kept as the proxy wrote them, and the
+        content hashes of the assets whose modified date didn't change
+        are kept.
+        """
+        with self.lock:
+            written = {
+                asset_id
+                for asset_id, written_at in self.written_at.items()
+                if written_at >= started_at
+            }
+            self.written_at = {
+                asset_id: self.written_at[asset_id] for asset_id in written
+            }
+            synced = []
+            for asset in assets:
+                if asset.id in written:
+                    continue
+                previous = self.assets.get(asset.id)
+                if (
+                    asset.content_hash is None
+                    and previous is not None
+                    and previous.modified_date == asset.modified_date
+                ):
+                    asset = replace(asset, content_hash=previous.content_hash)
+                synced.append(asset)
+
+            if full:
+                kept = [self.assets[i] for i in written if i in self.assets]
+                self.assets = {}
+                self.ids_by_key = {}
+                for asset in synced + kept:
+                    self._add(asset)
+            else:
+                for asset in synced:
+                    self._remove(asset.id)
+                    self._add(asset)
+
+    def get(self, asset_id: int) -> Optional[IndexedAsset]:
+        """
+        Returns the asset with the id.
+        """
+        with self.lock:
+            return self.assets.get(asset_id)
+
+    def get_by_key(self, customer_key: str) -> Optional[IndexedAsset]:
+        """
+        Returns the asset with the customer key.
+        """
+        with self.lock:
+            asset_id = self.ids_by_key.get(customer_key)
+            return None if asset_id is None else self.assets[asset_id]
+
+    def list_category(
+        self, category_id: Optional[int], category_name: Optional[str]
+    ) -> list[IndexedAsset]:
+        """
+        Returns the assets of the category, by id or name, ordered by id.
+        """
+        with self.lock:
+            assets = [
+                asset
+                for asset in self.assets.values()
+                if (category_id is None or asset.category_id == category_id)
+                and (category_name is None or asset.category_name == category_name)
+            ]
+        return sorted(assets, key=lambda asset: asset.id)
+
+
+_lock = threading.Lock()
+_indexes: "OrderedDict[str, AssetIndex]" = OrderedDict()
+# The business unit and user of each access token, by token scope.
+_owners: "OrderedDict[str, str]" = OrderedDict()
+
+
+def get_owner(
+    tenant_subdomain: str,
+    access_token: str,
+    fetch: bool = True,
+    deadline: Optional[float] = None,
+) -> Optional[str]:
+    """
+    Returns the ids of the business unit and of the user of the access
+    token, from its user info, as `member_id/user_id`. With `fetch`
+    false, only returns the ids already known.
+    """
+    scope = response_cache.token_scope(access_token)
+    with _lock:
+        if scope in _owners:
+            return _owners[scope]
+    if not fetch:
+        return None
+
+    url = upstream.sfmc_auth_url(tenant_subdomain, USER_INFO_PATH)
+    cached = response_cache.get(response_cache.make_key(access_token, url))
+    try:
+        if cached is not None and cached.status_code == 200:
+            content = cached.content
+        else:
+            http_resp = deadlines.send(
+                "GET",
+                url,
+                "asset_index_userinfo",
+                env_config.UPSTREAM_TIMEOUT,
+                deadline,
+                headers={"Authorization": f"Bearer {access_token}"},
+            )
+            if http_resp.status_code != 200:
+                return None
+            content = http_resp.content
+        user_info = json_codec.loads(content)
+        owner = f"{user_info['organization']['member_id']}/{user_info['user']['sub']}"
+    except (requests.RequestException, ValueError, KeyError, TypeError) as ex:
+        logger.error("Could not get the business unit of a user: %s", ex)
+        return None
+
+    with _lock:
+        _owners[scope] = owner
+        while len(_owners) > MAX_KNOWN_TOKENS:
+            _owners.popitem(last=False)
+    return owner
+
+
+def find_index(
+    tenant_subdomain: str,
+    access_token: str,
+    create: bool = False,
+    deadline: Optional[float] = None,
+) -> Optional[AssetIndex]:
+    """
+    Returns the index of the access token's user in its business unit.
+    With `create`, creates it if needed, fetching the user info if the
+    user isn't known yet.
+    """
+    owner = get_owner(tenant_subdomain, access_token, create, deadline)
+    if owner is None:
+        return None
+    key = f"{tenant_subdomain}/{owner}"
+    with _lock:
+        index = _indexes.get(key)
+        if index is None and create:
+            index = AssetIndex()
+            _indexes[key] = index
+            while len(_indexes) > env_config.ASSET_INDEX_MAX_TENANTS:
+                _indexes.popitem(last=False)
+        if index is not None:
+            _indexes.move_to_end(key)
+    return index
+
+
+def get_fresh_index(
+    tenant_subdomain: str, access_token: str, deadline: Optional[float] = None
+) -> Optional[AssetIndex]:
+    """
+    Returns the index of the access token's user if it has been
+    synced within `ASSET_INDEX_MAX_STALENESS` seconds, starting a sync
+    in the background or syncing it first, by the deadline of the
+    request, as needed. Returns None if the index isn't ready.
+    """
+    index = find_index(tenant_subdomain, access_token, True, deadline)
+    if index is None:
+        return None
+    if not index.complete:
+        start_sync(index, tenant_subdomain, access_token, full=True)
+        return None
+
+    now = time.monotonic()
+    full = now - index.full_synced_at > env_config.ASSET_INDEX_FULL_SYNC_INTERVAL
+    if now - index.synced_at > env_config.ASSET_INDEX_MAX_STALENESS:
+        wait = deadlines.remaining(deadline, env_config.UPSTREAM_TIMEOUT)
+        if not index.sync_lock.acquire(timeout=max(0.0, wait)):
+            return None
+        try:
+            if (
+                time.monotonic() - index.synced_at
+                > env_config.ASSET_INDEX_MAX_STALENESS
+            ):
+                if not sync(index, tenant_subdomain, access_token, False, deadline):
+                    return None
+        finally:
+            index.sync_lock.release()
+    elif now - index.synced_at > env_config.ASSET_INDEX_SYNC_INTERVAL or full:
+        start_sync(index, tenant_subdomain, access_token, full)
+    return index
+
+
+def start_sync(index: AssetIndex, tenant_subdomain: str, access_token: str, full: bool):
+    """
+    Syncs the index in a background thread, unless a sync is running.
+    """
+    with index.lock:
+        if index.syncing:
+            return
+        index.syncing = True
+
+    def run():
+        try:
+            with index.sync_lock:
+                sync(index, tenant_subdomain, access_token, full)
+        finally:
+            with index.lock:
+                index.syncing = False
+
+    threading.Thread(target=run, name="asset-index-sync", daemon=True).start()
+
+
+def get_sync_query(watermark: Optional[str]) -> dict[str, Any]:
+    """
+    Returns the asset query of the HTML blocks modified since the
+    watermark, or of all of them.
+    """
+    query = {
+        "property": "assetType.name",
+        "simpleOperator": "equal",
+        "value": HTML_BLOCK,
+    }
+    if watermark is None:
+        return query
+    return {
+        "leftOperand": query,
+        "logicalOperator": "AND",
+        "rightOperand": {
+            "property": "modifiedDate",
+            "simpleOperator": "greaterThanOrEqual",
+            "value": watermark,
+        },
+    }
+
+
+def sync(
+    index: AssetIndex,
+    tenant_subdomain: str,
+    access_token: str,
+    full: bool,
+    deadline: Optional[float] = None,
+) -> bool:
+    """
+    Fetches the HTML blocks modified since the last sync, or all of them
+    for a full sync, into the index, by the deadline if given. Returns
+    whether the sync succeeded.
+    """
+    kind = "full" if full or not index.complete else "delta"
+    started_at = time.monotonic()
+    url = upstream.sfmc_rest_url(tenant_subdomain, ASSETS_QUERY_PATH)
+    query = get_sync_query(None if kind == "full" else index.watermark)
+    assets: list[IndexedAsset] = []
+    try:
+        page = 1
+        while True:
+            http_resp = deadlines.send(
+                "POST",
+                url,
+                "asset_index_sync",
+                env_config.UPSTREAM_TIMEOUT,
+                deadline,
+                data=json_codec.dumps(
+                    {
+                        "page": {"page": page, "pageSize": SYNC_PAGE_SIZE},
+                        "query": query,
+                        "sort": [{"property": "modifiedDate", "direction": "ASC"}],
+                        "fields": SYNC_FIELDS,
+                    }
+                ),
+                headers={
+                    "Authorization": f"Bearer {access_token}",
+                    "Content-Type": "application/json",
+                },
+            )
+            if http_resp.status_code != 200:
+                raise ValueError(f"SFMC returned a {http_resp.status_code}")
+            listing = json_codec.loads(http_resp.content)
+            if not isinstance(listing, dict):
+                raise ValueError("SFMC returned an invalid listing")
+            items = listing.get("items") or []
+            assets += [asset for asset in map(from_item, items) if asset is not None]
+            if len(assets) > env_config.ASSET_INDEX_MAX_ASSETS:
+                raise ValueError(
+                    f"more than {env_config.ASSET_INDEX_MAX_ASSETS} assets"
+                )
+            count = listing.get("count")
+            if len(items) < SYNC_PAGE_SIZE or (
+                isinstance(count, int) and page * SYNC_PAGE_SIZE >= count
+            ):
+                break
+            page += 1
+    except (requests.RequestException, ValueError) as ex:
+        syncs_total.inc(kind=kind, outcome="failed")
+        logger.error(
+            "%s sync of the assets of %s failed: %s", kind, tenant_subdomain, ex
+        )
+        return False
+
+    index.apply_sync(assets, kind == "full", started_at)
+    if kind == "full":
+        index.watermark = None
+
+    watermark = parse_date(index.watermark) if index.watermark else None
+    for asset in assets:
+        modified_at = parse_date(asset.modified_date)
+        if modified_at is not None and (watermark is None or modified_at > watermark):
+            watermark = modified_at
+            index.watermark = asset.modified_date
+    index.synced_at = started_at
+    if kind == "full":
+        index.full_synced_at = started_at
+        index.complete = True
+    syncs_total.inc(kind=kind, outcome="ok")
+    sync_duration.observe(time.monotonic() - started_at, kind=kind)
+    return True
+
+
+def get_listing(
+    assets: list[IndexedAsset], page: int = 1, page_size: int = 50
+) -> UpstreamResponse:
+    """
+    Returns a page of the assets as an SFMC asset listing.
+    """
+    start = (page - 1) * page_size
+    return UpstreamResponse(
+        200,
+        "application/json",
+        json_codec.dumps(
+            {
+                "count": len(assets),
+                "page": page,
+                "pageSize": page_size,
+                "items": [
+                    asset.to_item() for asset in assets[start : start + page_size]
+                ],
+            }
+        ),
+    )
+
+
+def is_answerable(proxy_request: ProxyRequest) -> bool:
+    """
+    Returns whether the request only asks for indexed fields.
+    """
+    return proxy_request.fields is not None and projection.covers(
+        INDEXED_FIELDS, proxy_request.fields
+    )
+
+
+def answer_key_lookup(proxy_request: ProxyRequest) -> Optional[UpstreamResponse]:
+    """
+    Answers a `customerKey eq '...'` filter of the assets from the index.
+    Blocks that aren't indexed are looked up in SFMC, since the key may
+    belong to another type of asset.
+    """
+    if not is_answerable(proxy_request) or set(proxy_request.params) != {"$filter"}:
+        return None
+    match = CUSTOMER_KEY_FILTER.fullmatch(proxy_request.params["$filter"])
+    if match is None:
+        return None
+
+    index = get_fresh_index(
+        proxy_request.tenant_subdomain,
+        proxy_request.access_token,
+        proxy_request.deadline,
+    )
+    if index is None:
+        lookups_total.inc(kind="key", result="unavailable")
+        return None
+    asset = index.get_by_key(match.group(1).replace("''", "'"))
+    if asset is None:
+        lookups_total.inc(kind="key", result="miss")
+        return None
+    lookups_total.inc(kind="key", result="hit")
+    return get_listing([asset])
+
+
+def parse_category_query(body: Any) -> Optional[tuple[Optional[int], Optional[str]]]:
+    """
+    Returns the category id and name of an asset query for the HTML
+    blocks of a category, or None if the body is another query.
+    """
+    if not isinstance(body, dict) or not set(body) <= {"page", "query"}:
+        return None
+    query = body.get("query")
+    if not isinstance(query, dict) or query.get("logicalOperator") != "AND":
+        return None
+
+    conditions = {}
+    for operand in (query.get("leftOperand"), query.get("rightOperand")):
+        if not isinstance(operand, dict) or operand.get("simpleOperator") != "equal":
+            return None
+        conditions[operand.get("property")] = operand.get("value")
+    if conditions.pop("assetType.name", None) != HTML_BLOCK or len(conditions) != 1:
+        return None
+
+    if isinstance(conditions.get("category.id"), int):
+        return conditions["category.id"], None
+    if isinstance(conditions.get("category.name"), str):
+        return None, conditions["category.name"]
+    return None
+
+
+def answer_category_listing(proxy_request: ProxyRequest) -> Optional[UpstreamResponse]:
+    """
+    Answers an asset query for the HTML blocks of a category from the
+    index.
+    """
+    if not is_answerable(proxy_request) or not isinstance(proxy_request.body, bytes):
+        return None
+    try:
+        body = json_codec.loads(proxy_request.body)
+    except ValueError:
+        return None
+    category = parse_category_query(body)
+    if category is None:
+        return None
+    page = body.get("page") or {}
+    page_number, page_size = page.get("page", 1), page.get("pageSize", 50)
+    if not (isinstance(page_number, int) and isinstance(page_size, int)):
+        return None
+    if page_number < 1 or page_size < 1:
+        return None
+
+    index = get_fresh_index(
+        proxy_request.tenant_subdomain,
+        proxy_request.access_token,
+        proxy_request.deadline,
+    )
+    if index is None:
+        lookups_total.inc(kind="category", result="unavailable")
+        return None
+    lookups_total.inc(kind="category", result="hit")
+    return get_listing(index.list_category(*category), page_number, page_size)
+
+
+def get_content_hash(
+    tenant_subdomain: str, access_token: str, asset_id: int, max_age: float
+) -> Optional[str]:
+    """
+    Returns the hash of the content of an indexed asset, if the index of
+    the access token's user was synced in the last `max_age` seconds,
+    without syncing it.
+    """
+    if not env_config.ASSET_INDEX_ENABLED:
+        return None
+    index = find_index(tenant_subdomain, access_token)
+    if index is None or not index.complete:
+        return None
+    if time.monotonic() - index.synced_at > max_age:
+        return None
+    asset = index.get(asset_id)
+    return None if asset is None else asset.content_hash
+
+
+def write_through(proxy_request: ProxyRequest, upstream_resp: UpstreamResponse):
+    """
+    Updates the index with an asset created or updated by the proxy.
+    """
+    index = find_index(proxy_request.tenant_subdomain, proxy_request.access_token)
+    if index is None:
+        return
+    asset_id = proxy_request.path_args.get("asset_id")
+    if upstream_resp.status_code == 404 and asset_id is not None and asset_id.isdigit():
+        index.remove(int(asset_id))
+        return
+    if upstream_resp.status_code not in (200, 201) or not isinstance(
+        upstream_resp.content, bytes
+    ):
+        return
+    try:
+        asset = from_item(json_codec.loads(upstream_resp.content))
+    except ValueError:
+        return
+    if asset is not None:
+        index.upsert(asset)
+
+
+def reset():
+    """
+    Discards all indexes.
+    """
+    with _lock:
+        _indexes.clear()
+        _owners.clear()
@@ -0,0 +1,357 @@
+"""
+Runs a batch of requests to the proxied SFMC routes in one round trip.
+
+The UI's setup and home flows make several calls to the proxy in a row,
+each paying for a round trip, a CSRF check and the verification of the
+cookies. A batch is a JSON object with a list of sub-requests, each with
+the method and the path, under `/api/sfmc`, of a proxied route:
+
+    {"requests": [
+        {"id": "user", "method": "GET", "path": "/userinfo"},
+        {"id": "categories", "method": "GET",
+         "path": "/asset/v1/content/categories"},
+        {"id": "blocks", "method": "POST",
+         "path": "/asset/v1/content/assets/query?fields=id,name",
+         "body": {"page": {"page": 1, "pageSize": 50}, "query": {...}},
+         "dependsOn": ["categories"]}
+    ]}
+
+The cookies are verified once for the whole batch. Each sub-request goes
+through the policies of its route, like a request of its own, with the
+trace and the `X-Force-Write` header of the batch, and they run
+concurrently, each once the sub-requests it depends on have succeeded:
+up to `BATCH_MAX_CONCURRENCY` at a time, and no more than the admission
+slots the batch holds for its tenant. One whose dependency failed
+isn't sent and gets a 424. The response lists the `status`,
+`contentType` and `body` of each sub-request in the order of the batch;
+JSON bodies are embedded as they are.
+"""
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import time
+from typing import Any, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from flask.wrappers import Response as FlaskResponse
+import requests
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+
+from api import (
+    admission,
+    deadlines,
+    json_codec,
+    projection,
+    proxy_engine,
+    tracing,
+    unchanged_writes,
+)
+from api.app_logger import get_logger
+from api.proxy_engine import ProxyRequest, ProxyRoute
+from . import env_config
+
+logger = get_logger("batch")
+
+BODY_METHODS = ("POST", "PUT", "PATCH")
+
+
+@dataclass
+class SubResponse:
+    """
+    The response to a sub-request, read into memory.
+    """
+
+    status: int
+    content_type: str
+    content: bytes
+    headers: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def failed(self) -> bool:
+        # pylint: disable=missing-function-docstring
+        return self.status >= 400
+
+
+@dataclass
+class SubRequest:
+    """
+    A sub-request of a batch, with its response if it can't be sent.
+    """
+
+    id: str
+    depends_on: tuple[str, ...] = ()
+    proxy_request: Optional[ProxyRequest] = None
+    response: Optional[SubResponse] = None
+
+
+def error(status: int, error_code: str, description: str) -> SubResponse:
+    """
+    Returns a JSON error response to a sub-request.
+    """
+    return SubResponse(
+        status,
+        "application/json",
+        json_codec.dumps({"error": error_code, "error_description": description}),
+    )
+
+
+class Router:
+    """
+    Finds the proxied route of a method and path.
+    """
+
+    def __init__(self, routes: list[ProxyRoute]) -> None:
+        self.routes = {route.name: route for route in routes}
+        self._adapter = Map(
+            [
+                Rule(route.path, endpoint=route.name, methods=[route.method])
+                for route in routes
+            ]
+        ).bind("localhost")
+
+    def match(self, method: str, path: str) -> Optional[tuple[ProxyRoute, dict]]:
+        """
+        Returns the route of the method and path and its path variables,
+        or None if no route matches.
+        """
+        try:
+            name, path_args = self._adapter.match(path, method)
+        except HTTPException:
+            return None
+        return self.routes[name], path_args
+
+
+def parse_sub_request(
+    router: Router, number: int, item: Any, tenant_subdomain: str, access_token: str
+) -> SubRequest:
+    """
+    Returns the sub-request of an item of the batch. Raises a
+    `ValueError` if the item isn't a valid sub-request.
+    """
+    if not isinstance(item, dict):
+        raise ValueError(f"Sub-request {number} isn't an object.")
+    sub_id = str(item.get("id", number))
+    method, path = item.get("method", "GET"), item.get("path")
+    depends_on = item.get("dependsOn", [])
+    if not isinstance(method, str) or not isinstance(path, str):
+        raise ValueError(f"Sub-request {sub_id} has no valid method and path.")
+    if not isinstance(depends_on, list) or not all(
+        isinstance(dependency, str) for dependency in depends_on
+    ):
+        raise ValueError(f"The dependencies of sub-request {sub_id} aren't a list.")
+    sub_request = SubRequest(sub_id, tuple(depends_on))
+
+    url = urlsplit(path)
+    matched = router.match(method.upper(), url.path)
+    if matched is None:
+        sub_request.response = error(
+            404, "not_found", f"No proxied route matches {method} {url.path}."
+        )
+        return sub_request
+    route, path_args = matched
+
+    params = dict(parse_qsl(url.query, keep_blank_values=True))
+    fields = None
+    if route.projectable:
+        fields = projection.parse_fields(params.pop(projection.FIELDS_PARAM, None))
+    body = None
+    if route.method in BODY_METHODS and item.get("body") is not None:
+        body = json_codec.dumps(item["body"])
+        if len(body) > (route.max_body_size or env_config.MAX_PROXY_BODY_SIZE):
+            sub_request.response = error(
+                413, "request_too_large", "The body of the sub-request is too large."
+            )
+            return sub_request
+
+    sub_request.proxy_request = ProxyRequest(
+        route=route,
+        tenant_subdomain=tenant_subdomain,
+        access_token=access_token,
+        path_args=path_args,
+        params=params,
+        body=body,
+        fields=fields,
+        deadline=deadlines.current(),
+        trace=tracing.current(),
+        force_write=unchanged_writes.is_forced(),
+    )
+    return sub_request
+
+
+def check_dependencies(sub_requests: list[SubRequest]):
+    """
+    Raises a `ValueError` if the ids of the sub-requests aren't unique or
+    their dependencies are unknown or circular.
+    """
+    dependencies = {}
+    for sub_request in sub_requests:
+        if sub_request.id in dependencies:
+            raise ValueError(f"Sub-request id {sub_request.id} isn't unique.")
+        dependencies[sub_request.id] = set(sub_request.depends_on)
+    for sub_id, depends_on in dependencies.items():
+        unknown = depends_on - dependencies.keys()
+        if unknown:
+            raise ValueError(f"Sub-request {sub_id} depends on unknown {min(unknown)}.")
+
+    resolved: set[str] = set()
+    while len(resolved) < len(dependencies):
+        ready = {
+            sub_id
+            for sub_id, depends_on in dependencies.items()
+            if sub_id not in resolved and depends_on <= resolved
+        }
+        if not ready:
+            raise ValueError("The dependencies of the sub-requests are circular.")
+        resolved |= ready
+
+
+def execute(proxy_request: ProxyRequest) -> SubResponse:
+    """
+    Sends a sub-request through the policies of its route and returns
+    its response, with the items of a listing projected if asked for.
+    """
+    started_at = time.monotonic()
+    try:
+        upstream_resp = proxy_engine.execute(proxy_request, stream=False)
+    except requests.RequestException as ex:
+        url = proxy_engine.get_upstream_url(proxy_request)
+        if isinstance(ex, requests.Timeout):
+            logger.error("Request to %s timed out.", url)
+            response = error(504, "upstream_timeout", "SFMC did not respond in time.")
+        else:
+            logger.error("Request to %s failed: %s", url, ex)
+            response = error(502, "upstream_error", "Could not reach SFMC.")
+        proxy_engine.capture_read(proxy_request, response.status, b"", started_at)
+    else:
+        content = upstream_resp.content
+        if not isinstance(content, bytes):
+            content = b"".join(content)
+        response = SubResponse(
+            upstream_resp.status_code,
+            upstream_resp.content_type,
+            content,
+            upstream_resp.headers,
+        )
+        proxy_engine.capture_read(proxy_request, response.status, content, started_at)
+        if proxy_request.fields is not None and response.status == 200:
+            try:
+                response.content = b"".join(
+                    projection.project_listing(iter([content]), proxy_request.fields)
+                )
+            except ValueError:
+                logger.warning("Could not project the listing of a sub-request.")
+    proxy_engine.observe(proxy_request.route, response.status, started_at)
+    return response
+
+
+def run(sub_requests: list[SubRequest], concurrency: int) -> dict[str, SubResponse]:
+    """
+    Sends the sub-requests, each once its dependencies have succeeded,
+    with at most `concurrency` in flight, and returns their responses by
+    id.
+    """
+    responses: dict[str, SubResponse] = {}
+    waiting = list(sub_requests)
+    pending: dict[Future, SubRequest] = {}
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="batch") as executor:
+        while waiting or pending:
+            ready = [
+                sub_request
+                for sub_request in waiting
+                if all(sub_id in responses for sub_id in sub_request.depends_on)
+            ]
+            for sub_request in ready:
+                waiting.remove(sub_request)
+                failed = [
+                    sub_id
+                    for sub_id in sub_request.depends_on
+                    if responses[sub_id].failed
+                ]
+                if sub_request.response is not None:
+                    responses[sub_request.id] = sub_request.response
+                elif failed:
+                    responses[sub_request.id] = error(
+                        424, "failed_dependency", f"Sub-request {failed[0]} failed."
+                    )
+                else:
+                    future = executor.submit(execute, sub_request.proxy_request)
+                    pending[future] = sub_request
+            if not pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                responses[pending.pop(future).id] = future.result()
+    return responses
+
+
+def is_json(response: SubResponse) -> bool:
+    """
+    Returns whether the body of a response is a valid JSON document.
+    """
+    if not response.content_type.startswith("application/json"):
+        return False
+    try:
+        json_codec.validate(response.content)
+    except ValueError:
+        return False
+    return True
+
+
+def encode(sub_id: str, response: SubResponse) -> bytes:
+    """
+    Returns the JSON of a sub-request's response. A JSON body is
+    embedded as it is, other bodies as strings.
+    """
+    meta = {
+        "id": sub_id,
+        "status": response.status,
+        "contentType": response.content_type,
+    }
+    if response.headers:
+        meta["headers"] = response.headers
+    body = response.content
+    if not is_json(response):
+        body = json_codec.dumps(body.decode("utf-8", "replace") if body else None)
+    return json_codec.dumps(meta)[:-1] + b',"body":' + body + b"}"
+
+
+def respond(
+    router: Router, batch: Any, tenant_subdomain: str, access_token: str
+) -> FlaskResponse:
+    """
+    Runs a batch and returns the response with the result of each of
+    its sub-requests.
+    """
+    items = batch.get("requests") if isinstance(batch, dict) else None
+    if not isinstance(items, list) or not items:
+        return proxy_engine.error_response(
+            400, "invalid_request", "The batch has no list of requests."
+        )
+    if len(items) > env_config.BATCH_MAX_REQUESTS:
+        return proxy_engine.error_response(
+            400,
+            "invalid_request",
+            f"A batch has at most {env_config.BATCH_MAX_REQUESTS} requests.",
+        )
+    try:
+        sub_requests = [
+            parse_sub_request(router, number, item, tenant_subdomain, access_token)
+            for number, item in enumerate(items, start=1)
+        ]
+        check_dependencies(sub_requests)
+    except ValueError as ex:
+        return proxy_engine.error_response(400, "invalid_request", str(ex))
+
+    # The sub-requests run in the slot of the batch, plus the free ones of
+    # its tenant, which are held until the response has been sent.
+    concurrency = 1 + admission.hold_more_slots(env_config.BATCH_MAX_CONCURRENCY - 1)
+    responses = run(sub_requests, concurrency)
+    return FlaskResponse(
+        b'{"responses":['
+        + b",".join(
+            encode(sub_request.id, responses[sub_request.id])
+            for sub_request in sub_requests
+        )
+        + b"]}",
+        mimetype="application/json",
+    )
@@ -0,0 +1,534 @@
+"""
+Bulk export and import of a tenant's Laasie HTML blocks.
+
+The export pages through the HTML blocks of a Content Builder category
+(the Laasie Collection Templates by default) and streams them as they
+arrive, either as NDJSON, one block per line, or as a ZIP archive with
+the HTML of each block next to its metadata. No more than a page of
+blocks is held in memory. If SFMC fails after the first page, the
+NDJSON ends with an error line and the ZIP archive is left without its
+central directory, so that neither passes for a complete export.
+
+The import takes either kind of archive, spooled to disk, and creates
+or updates each block by its customer key in the category, with a
+bounded number of blocks in flight: at most `BULK_IMPORT_CONCURRENCY`,
+and no more than the admission slots the import holds for its tenant,
+since each block is a call to SFMC. The result of each block is
+streamed back as an NDJSON line as soon as it is known, followed by a
+summary. The blocks are looked up and saved through the same proxy
+routes as the UI's, so the imports answer from and update the asset
+index and invalidate the cached listings.
+"""
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import io
+import itertools
+import tempfile
+import time
+from typing import IO, Any, Iterator, Optional, Union
+import zipfile
+
+from flask import request as flask_request
+from flask.wrappers import Response as FlaskResponse
+import requests
+
+from api import (
+    admission,
+    json_codec,
+    metrics,
+    projection,
+    proxy_engine,
+    tracing,
+    unchanged_writes,
+)
+from api.app_logger import get_logger
+from api.proxy_engine import ProxyRequest, ProxyRoute, UpstreamResponse
+from . import env_config
+
+logger = get_logger("bulk-transfer")
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+ZIP_SIGNATURE = b"PK\x03\x04"
+EXPORT_PAGE_SIZE = 50
+EXPORT_FIELDS = [
+    "id",
+    "customerKey",
+    "name",
+    "description",
+    "content",
+    "category",
+    "modifiedDate",
+]
+# Uploads larger than this are spooled to a temporary file.
+SPOOL_MEMORY_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
+# The fields of a block that are imported.
+IMPORTED_FIELDS = ("name", "description", "content")
+# The statuses of the imported blocks, counted in the summary.
+RESULT_STATUSES = ("created", "updated", "unchanged", "failed")
+
+blocks_total = metrics.counter(
+    "bulk_transfer_blocks_total", "Blocks exported and imported, by outcome."
+)
+
+# A block read from an archive: a line of NDJSON, the block from a ZIP
+# archive or the reason it couldn't be read.
+ImportItem = Union[bytes, dict[str, Any], ValueError]
+
+
+class TransferError(Exception):
+    """
+    Raised when SFMC fails a request that a transfer can't go on without.
+    """
+
+
+@dataclass
+class Transfer:
+    """
+    The proxy routes, tenant and access token of a bulk transfer, and
+    the trace and `X-Force-Write` header of its request.
+    """
+
+    routes: dict[str, ProxyRoute]
+    tenant_subdomain: str
+    access_token: str
+    trace: Optional[tracing.Trace] = None
+    force_write: bool = False
+
+    def make_request(self, route_name: str, **kwargs: Any) -> ProxyRequest:
+        """
+        Returns a request to the route with the tenant and token.
+        """
+        return ProxyRequest(
+            route=self.routes[route_name],
+            tenant_subdomain=self.tenant_subdomain,
+            access_token=self.access_token,
+            trace=self.trace,
+            force_write=self.force_write,
+            **kwargs,
+        )
+
+    def execute(self, route_name: str, **kwargs: Any) -> UpstreamResponse:
+        """
+        Sends a request through the route's policies and returns the
+        response read into memory.
+        """
+        started_at = time.monotonic()
+        proxy_request = self.make_request(route_name, **kwargs)
+        try:
+            upstream_resp = proxy_engine.execute(proxy_request, False)
+        except requests.RequestException as ex:
+            status_code = 504 if isinstance(ex, requests.Timeout) else 502
+            proxy_engine.capture_read(proxy_request, status_code, b"", started_at)
+            raise
+        proxy_engine.capture_read(
+            proxy_request, upstream_resp.status_code, upstream_resp.content, started_at
+        )
+        return upstream_resp
+
+
+def get_listing(upstream_resp: UpstreamResponse) -> tuple[list[dict[str, Any]], int]:
+    """
+    Returns the items of an SFMC listing and the count of all its items.
+    Raises `TransferError` if the response isn't a listing.
+    """
+    if upstream_resp.status_code != 200 or not isinstance(upstream_resp.content, bytes):
+        raise TransferError(f"SFMC returned a {upstream_resp.status_code}")
+    try:
+        listing = json_codec.loads(upstream_resp.content)
+    except ValueError as ex:
+        raise TransferError("SFMC returned an invalid listing") from ex
+    items = listing.get("items") if isinstance(listing, dict) else None
+    if not isinstance(items, list):
+        raise TransferError("SFMC returned an invalid listing")
+    count = listing.get("count")
+    return items, count if isinstance(count, int) else len(items)
+
+
+def iter_blocks(transfer: Transfer, category_name: str) -> Iterator[dict[str, Any]]:
+    """
+    Yields the HTML blocks of the category, a page at a time, ordered by
+    id. Raises `TransferError` if a page can't be fetched.
+    """
+    for page in itertools.count(1):
+        proxy_request = transfer.make_request(
+            "advanced_filter_assets",
+            body=json_codec.dumps(
+                {
+                    "page": {"page": page, "pageSize": EXPORT_PAGE_SIZE},
+                    "query": {
+                        "leftOperand": {
+                            "property": "assetType.name",
+                            "simpleOperator": "equal",
+                            "value": "htmlblock",
+                        },
+                        "logicalOperator": "AND",
+                        "rightOperand": {
+                            "property": "category.name",
+                            "simpleOperator": "equal",
+                            "value": category_name,
+                        },
+                    },
+                    "sort": [{"property": "id", "direction": "ASC"}],
+                    "fields": EXPORT_FIELDS,
+                }
+            ),
+        )
+        # The pages are fetched without the response cache, which would
+        # otherwise fill up with the content of the blocks.
+        try:
+            items, count = get_listing(
+                proxy_engine.fetch(
+                    proxy_request, proxy_engine.get_upstream_url(proxy_request)
+                )
+            )
+        except (requests.RequestException, TransferError) as ex:
+            logger.error("Export of the blocks of %s failed: %s", category_name, ex)
+            if isinstance(ex, TransferError):
+                raise
+            raise TransferError("Could not reach SFMC") from ex
+        for item in items:
+            blocks_total.inc(outcome="exported")
+            yield {name: item[name] for name in EXPORT_FIELDS if name in item}
+        if len(items) < EXPORT_PAGE_SIZE or page * EXPORT_PAGE_SIZE >= count:
+            return
+
+
+class ZipStream(io.RawIOBase):
+    """
+    A write-only stream that `zipfile` writes an archive to, whose bytes
+    are taken out as they are written.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:  # type: ignore[override]
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        """
+        Returns the bytes written since the last call.
+        """
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_ndjson(blocks: Iterator[dict[str, Any]]) -> Iterator[bytes]:
+    """
+    Yields a line for each block, and an error line if SFMC fails before
+    the last one.
+    """
+    try:
+        for block in blocks:
+            yield json_codec.dumps(block) + b"\n"
+    except TransferError as ex:
+        logger.error("Ending the NDJSON export with an error: %s", ex)
+        error = {"error": "upstream_error", "error_description": str(ex)}
+        yield json_codec.dumps(error) + b"\n"
+
+
+def iter_zip(blocks: Iterator[dict[str, Any]]) -> Iterator[bytes]:
+    """
+    Yields a ZIP archive with the HTML of each block in
+    `blocks/<id>.html` and the rest of it in `blocks/<id>.json`, which
+    is left invalid if SFMC fails before the last block.
+    """
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED)
+    try:
+        for block in blocks:
+            stem = f"blocks/{block.get('id')}"
+            archive.writestr(f"{stem}.html", block.get("content") or "")
+            metadata = {
+                name: value for name, value in block.items() if name != "content"
+            }
+            archive.writestr(f"{stem}.json", json_codec.dumps(metadata))
+            yield stream.take()
+    except TransferError as ex:
+        # Without its central directory, the archive can't be opened,
+        # rather than silently missing blocks.
+        logger.error("Ending the ZIP export without its directory: %s", ex)
+        return
+    archive.close()
+    yield stream.take()
+
+
+def export_blocks(
+    transfer: Transfer, category_name: str, archive_format: str
+) -> FlaskResponse:
+    """
+    Returns the response that streams the HTML blocks of the category
+    as NDJSON, or as a ZIP archive if `archive_format` is "zip".
+    """
+    if archive_format not in ("ndjson", "zip"):
+        return proxy_engine.error_response(
+            400, "invalid_request", "The format must be ndjson or zip."
+        )
+
+    # The first page is fetched before responding, so that SFMC errors
+    # are reported with a status. Errors after that end the NDJSON with
+    # an error line, or leave the ZIP archive invalid.
+    blocks = iter_blocks(transfer, category_name)
+    try:
+        first = list(itertools.islice(blocks, 1))
+    except TransferError as ex:
+        return proxy_engine.error_response(502, "upstream_error", str(ex))
+    blocks = itertools.chain(first, blocks)
+
+    if archive_format == "zip":
+        resp = FlaskResponse(iter_zip(blocks), mimetype="application/zip")
+    else:
+        resp = FlaskResponse(iter_ndjson(blocks), mimetype=NDJSON_CONTENT_TYPE)
+    resp.headers[
+        "Content-Disposition"
+    ] = f'attachment; filename="{transfer.tenant_subdomain}-blocks.{archive_format}"'
+    return resp
+
+
+def get_category_id(transfer: Transfer, category_name: str) -> int:
+    """
+    Returns the id of the category, creating it at the root of Content
+    Builder if it doesn't exist, as the UI does.
+    """
+    try:
+        categories, _ = get_listing(transfer.execute("list_categories"))
+        for category in categories:
+            if category.get("name") == category_name:
+                return category["id"]
+        root = next((c for c in categories if c.get("parentId") == 0), None)
+        if root is None:
+            raise TransferError("SFMC returned no root category")
+        created = transfer.execute(
+            "create_category",
+            body=json_codec.dumps(
+                {
+                    "parentId": root["id"],
+                    "name": category_name,
+                    "categoryType": "asset-shared",
+                    "sharingProperties": {"sharedWith": [0], "sharingType": "edit"},
+                }
+            ),
+        )
+    except requests.RequestException as ex:
+        raise TransferError("Could not reach SFMC") from ex
+    if created.status_code not in (200, 201) or not isinstance(created.content, bytes):
+        raise TransferError(f"SFMC returned a {created.status_code}")
+    try:
+        return json_codec.loads(created.content)["id"]
+    except (ValueError, TypeError, KeyError) as ex:
+        raise TransferError("SFMC returned an invalid category") from ex
+
+
+def spool_upload() -> IO[bytes]:
+    """
+    Copies the body of the incoming request to a temporary file, which
+    is kept in memory while it is small.
+    """
+    content_length = proxy_engine.get_request_content_length(
+        env_config.BULK_IMPORT_MAX_BYTES
+    )
+    upload = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+    remaining = content_length
+    while remaining > 0:
+        chunk = flask_request.stream.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        upload.write(chunk)
+        remaining -= len(chunk)
+    upload.seek(0)
+    return upload  # type: ignore[return-value]
+
+
+def iter_zip_items(archive: zipfile.ZipFile) -> Iterator[ImportItem]:
+    """
+    Yields the blocks of an archive written by `iter_zip`.
+    """
+    names = set(archive.namelist())
+    for name in sorted(names):
+        if not name.endswith(".json"):
+            continue
+        html_name = name[: -len(".json")] + ".html"
+        sizes = [archive.getinfo(n).file_size for n in (name, html_name) if n in names]
+        if sum(sizes) > env_config.MAX_PROXY_BODY_SIZE:
+            yield ValueError(f"{name} is too large.")
+            continue
+        try:
+            block = json_codec.loads(archive.read(name))
+        except ValueError as ex:
+            yield ex
+            continue
+        if isinstance(block, dict) and html_name in names:
+            block["content"] = archive.read(html_name).decode("utf-8", "replace")
+        yield block
+
+
+def iter_items(upload: IO[bytes]) -> Iterator[ImportItem]:
+    """
+    Yields the blocks of an uploaded NDJSON or ZIP archive. Raises
+    `zipfile.BadZipFile` if the upload looks like a ZIP but isn't one.
+    """
+    if upload.read(len(ZIP_SIGNATURE)) == ZIP_SIGNATURE:
+        upload.seek(0)
+        return iter_zip_items(zipfile.ZipFile(upload))
+    upload.seek(0)
+    return (line for line in upload if line.strip())
+
+
+def parse_block(item: ImportItem) -> dict[str, Any]:
+    """
+    Returns an imported block. Raises `ValueError` if it isn't valid.
+    """
+    if isinstance(item, ValueError):
+        raise item
+    block = json_codec.loads(item) if isinstance(item, bytes) else item
+    if not isinstance(block, dict):
+        raise ValueError("The block isn't a JSON object.")
+    if not isinstance(block.get("customerKey"), str) or not block["customerKey"]:
+        raise ValueError("The block has no customerKey.")
+    if not isinstance(block.get("content"), str):
+        raise ValueError("The block has no content.")
+    return block
+
+
+def import_block(
+    transfer: Transfer, category_id: int, number: int, item: ImportItem
+) -> dict[str, Any]:
+    """
+    Creates or updates a block by its customer key and returns the
+    result, with the number of the block in the archive.
+    """
+    try:
+        block = parse_block(item)
+    except ValueError as ex:
+        return {"item": number, "status": "failed", "error": str(ex)}
+
+    key = block["customerKey"]
+    result = {"item": number, "customerKey": key}
+    fields = {name: block[name] for name in IMPORTED_FIELDS if name in block}
+    try:
+        found, _ = get_listing(
+            transfer.execute(
+                "filter_assets",
+                params={
+                    "$filter": "customerKey eq '{}'".format(key.replace("'", "''"))
+                },
+                fields=projection.parse_fields("id,customerKey"),
+            )
+        )
+        if found:
+            status = "updated"
+            upstream_resp = transfer.execute(
+                "update_asset",
+                path_args={"asset_id": str(found[0].get("id"))},
+                body=json_codec.dumps(fields),
+            )
+        else:
+            status = "created"
+            upstream_resp = transfer.execute(
+                "create_asset",
+                body=json_codec.dumps(
+                    {
+                        "name": key,
+                        **fields,
+                        "customerKey": key,
+                        "assetType": {"id": 197, "name": "htmlblock"},
+                        "category": {"id": category_id},
+                        "channels": {"email": True, "web": False},
+                        "sharingProperties": {"sharedWith": [0], "sharingType": "edit"},
+                    }
+                ),
+            )
+    except (requests.RequestException, TransferError) as ex:
+        return {**result, "status": "failed", "error": str(ex)}
+
+    if upstream_resp.status_code not in (200, 201):
+        return {
+            **result,
+            "status": "failed",
+            "error": f"SFMC returned a {upstream_resp.status_code}",
+        }
+    if unchanged_writes.SKIPPED_HEADER in upstream_resp.headers:
+        status = "unchanged"
+    result["status"] = status
+    try:
+        result["id"] = json_codec.loads(upstream_resp.content)["id"]
+    except (ValueError, TypeError, KeyError):
+        pass
+    return result
+
+
+def iter_results(
+    transfer: Transfer,
+    category_id: int,
+    upload: IO[bytes],
+    items: Iterator[ImportItem],
+    concurrency: int,
+) -> Iterator[bytes]:
+    """
+    Imports the blocks with at most `concurrency` in flight and yields
+    the result of each as an NDJSON line, in the order they complete,
+    followed by a summary line.
+    """
+    executor = ThreadPoolExecutor(concurrency, thread_name_prefix="bulk-import")
+    counts: Counter = Counter()
+    pending: set[Future] = set()
+
+    def report(done: set[Future]) -> Iterator[bytes]:
+        for future in done:
+            result = future.result()
+            counts[result["status"]] += 1
+            blocks_total.inc(outcome=result["status"])
+            yield json_codec.dumps(result) + b"\n"
+
+    try:
+        for number, item in enumerate(items, start=1):
+            if len(pending) >= 2 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from report(done)
+            pending.add(
+                executor.submit(import_block, transfer, category_id, number, item)
+            )
+        done, _ = wait(pending)
+        yield from report(done)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        upload.close()
+    logger.info("Imported blocks of %s: %s", transfer.tenant_subdomain, dict(counts))
+    yield json_codec.dumps(
+        {"summary": {name: counts[name] for name in RESULT_STATUSES}}
+    ) + b"\n"
+
+
+def import_blocks(transfer: Transfer, category_name: str) -> FlaskResponse:
+    """
+    Returns the response that imports the blocks of the uploaded archive
+    into the category and streams the results.
+    """
+    upload = spool_upload()
+    try:
+        items = iter_items(upload)
+        category_id = get_category_id(transfer, category_name)
+    except zipfile.BadZipFile:
+        upload.close()
+        return proxy_engine.error_response(
+            400, "invalid_request", "The archive isn't a valid ZIP file."
+        )
+    except TransferError as ex:
+        upload.close()
+        logger.error("Could not find or create the category %s: %s", category_name, ex)
+        return proxy_engine.error_response(502, "upstream_error", str(ex))
+    # The import runs in the slot of its request, plus the free ones of
+    # its tenant, which are held until the response has been sent.
+    concurrency = 1 + admission.hold_more_slots(env_config.BULK_IMPORT_CONCURRENCY - 1)
+    return FlaskResponse(
+        iter_results(transfer, category_id, upload, items, concurrency),
+        mimetype=NDJSON_CONTENT_TYPE,
+    )
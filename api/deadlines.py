@@ -0,0 +1,244 @@
+"""
+Timeouts and deadlines of the calls to SFMC and Laasie.
+
+Every upstream call is bounded by a timeout and, while serving a
+request from the UI, by the end-to-end deadline of that request: the UI
+gives up on SFMC calls after `SFMC_CLIENT_TIMEOUT` seconds and on Laasie
+calls after `LAASIE_CLIENT_TIMEOUT` seconds, so there is no point in
+keeping a worker thread waiting for an answer nobody will read. A call
+that would start after the deadline isn't sent.
+
+With `ADAPTIVE_TIMEOUTS_ENABLED`, the timeout of each route and
+upstream host follows the latencies recently seen for it: it is the
+`ADAPTIVE_TIMEOUT_PERCENTILE` of the latencies of the last one or two
+`ADAPTIVE_TIMEOUT_WINDOW` seconds, times `ADAPTIVE_TIMEOUT_MULTIPLIER`,
+bounded by `ADAPTIVE_TIMEOUT_FLOOR` and by the fixed timeout of the
+call. Calls that time out are counted at their timeout so that the
+timeout grows again when the upstream slows down.
+
+The latencies are kept in sketches with logarithmic buckets, which
+estimate a percentile to within `SKETCH_ACCURACY` of its value in
+constant memory.
+"""
+from collections import OrderedDict
+import math
+import threading
+import time
+from typing import Any, Optional
+from urllib.parse import urlsplit
+
+from flask import Flask, g, has_request_context, request as flask_request
+import requests
+
+from api import metrics, upstream
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("deadlines")
+
+# The relative accuracy of the percentiles estimated by the sketches.
+SKETCH_ACCURACY = 0.05
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# The smallest latency, in seconds, told apart by the sketches.
+SKETCH_MIN_LATENCY = 0.001
+# The most routes and hosts whose latencies are kept.
+MAX_SKETCHES = 1024
+
+exceeded_total = metrics.counter(
+    "upstream_deadline_exceeded_total",
+    "Upstream calls that ran out of time, by route and by the bound that was hit:"
+    " adaptive, timeout or deadline.",
+)
+timeout_seconds = metrics.gauge(
+    "upstream_timeout_seconds", "The latest timeout of an upstream call, by route."
+)
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    Raised instead of sending a call after the deadline of the request.
+    """
+
+
+def get_budget(path: str) -> Optional[float]:
+    """
+    Returns the seconds the UI waits for a response to the path, or None
+    if it isn't requested by one of the UI's API clients.
+    """
+    if path.startswith(("/api/sfmc", "/oauth2/sfmc/refresh_token")):
+        return env_config.SFMC_CLIENT_TIMEOUT
+    if path.startswith(("/api/laasie", "/auth/laasie")):
+        return env_config.LAASIE_CLIENT_TIMEOUT
+    return None
+
+
+def init_app(app: Flask):
+    """
+    Starts the end-to-end deadline of each request from the UI as soon
+    as it is received, before the time spent in the admission queue.
+    """
+
+    @app.before_request
+    def start_deadline():
+        budget = get_budget(flask_request.path)
+        if budget is not None:
+            g.deadline = time.monotonic() + budget
+
+
+def current() -> Optional[float]:
+    """
+    Returns the deadline, on the monotonic clock, of the request being
+    served, or None.
+    """
+    if not has_request_context():
+        return None
+    return g.get("deadline")
+
+
+def remaining(deadline: Optional[float], timeout: float) -> float:
+    """
+    Returns the timeout, cut short to the time left until the deadline.
+    """
+    if deadline is None:
+        return timeout
+    return min(timeout, deadline - time.monotonic())
+
+
+class LatencySketch:
+    """
+    The latencies of the last one or two windows, counted in buckets
+    whose bounds grow by `SKETCH_GAMMA`.
+    """
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self.current: dict[int, int] = {}
+        self.previous: dict[int, int] = {}
+        self.rotated_at = time.monotonic()
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.rotated_at < self.window:
+            return
+        # The previous window is dropped as well if no latency was
+        # added for more than a window.
+        self.previous = self.current if now - self.rotated_at < 2 * self.window else {}
+        self.current = {}
+        self.rotated_at = now
+
+    def add(self, latency: float):
+        """
+        Counts a latency, in seconds.
+        """
+        self._rotate()
+        index = math.ceil(math.log(max(latency, SKETCH_MIN_LATENCY), SKETCH_GAMMA))
+        self.current[index] = self.current.get(index, 0) + 1
+
+    def count(self) -> int:
+        """
+        Returns the number of latencies counted.
+        """
+        self._rotate()
+        return sum(self.current.values()) + sum(self.previous.values())
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Returns the estimate of a percentile of the latencies, given as
+        a fraction, or 0 if none were counted.
+        """
+        self._rotate()
+        counts = dict(self.previous)
+        for index, count in self.current.items():
+            counts[index] = counts.get(index, 0) + count
+        rank = fraction * (sum(counts.values()) - 1)
+        seen = 0
+        for index in sorted(counts):
+            seen += counts[index]
+            if seen > rank:
+                return 2 * SKETCH_GAMMA**index / (SKETCH_GAMMA + 1)
+        return 0.0
+
+
+_lock = threading.Lock()
+_sketches: "OrderedDict[tuple[str, str], LatencySketch]" = OrderedDict()
+
+
+def record(key: tuple[str, str], latency: float):
+    """
+    Counts the latency of a call of a route to a host.
+    """
+    with _lock:
+        sketch = _sketches.get(key)
+        if sketch is None:
+            sketch = _sketches[key] = LatencySketch(env_config.ADAPTIVE_TIMEOUT_WINDOW)
+        _sketches.move_to_end(key)
+        while len(_sketches) > MAX_SKETCHES:
+            _sketches.popitem(last=False)
+        sketch.add(latency)
+
+
+def get_timeout(key: tuple[str, str], limit: float) -> tuple[float, str]:
+    """
+    Returns the timeout of a call of a route to a host, at most `limit`
+    seconds, and whether it is the "adaptive" one or the "timeout".
+    """
+    if not env_config.ADAPTIVE_TIMEOUTS_ENABLED:
+        return limit, "timeout"
+    with _lock:
+        sketch = _sketches.get(key)
+        if sketch is None or sketch.count() < env_config.ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return limit, "timeout"
+        latency = sketch.percentile(env_config.ADAPTIVE_TIMEOUT_PERCENTILE)
+    adaptive = max(
+        latency * env_config.ADAPTIVE_TIMEOUT_MULTIPLIER,
+        env_config.ADAPTIVE_TIMEOUT_FLOOR,
+    )
+    if adaptive >= limit:
+        return limit, "timeout"
+    return adaptive, "adaptive"
+
+
+def send(
+    method: str,
+    url: str,
+    route: str,
+    timeout: float,
+    deadline: Optional[float] = None,
+    **kwargs: Any,
+) -> requests.Response:
+    """
+    Sends a call of a route with the shared upstream session, waiting at
+    most `timeout` seconds, or less if the latencies of the route allow,
+    and never past the deadline. Raises `DeadlineExceeded` if the
+    deadline has passed.
+    """
+    key = (route, urlsplit(url).hostname or "")
+    call_timeout, bound = get_timeout(key, timeout)
+    if deadline is not None and deadline - time.monotonic() < call_timeout:
+        call_timeout, bound = deadline - time.monotonic(), "deadline"
+    if call_timeout <= 0:
+        exceeded_total.inc(route=route, bound="deadline")
+        logger.error("Not sending the %s call: its deadline has passed.", route)
+        raise DeadlineExceeded(f"The deadline of the {route} call has passed.")
+    timeout_seconds.set(round(call_timeout, 3), route=route)
+
+    started_at = time.monotonic()
+    try:
+        resp = upstream.get_session().request(
+            method, url, timeout=call_timeout, **kwargs
+        )
+    except requests.Timeout:
+        exceeded_total.inc(route=route, bound=bound)
+        if bound != "deadline":
+            record(key, call_timeout)
+        raise
+    record(key, time.monotonic() - started_at)
+    return resp
+
+
+def reset():
+    """
+    Forgets the latencies.
+    """
+    with _lock:
+        _sketches.clear()
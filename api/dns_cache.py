@@ -0,0 +1,181 @@
+"""
+A cache of the IP addresses of the upstream hosts.
+
+Each tenant has its own SFMC REST and auth hosts, and without a cache
+every new upstream connection does a blocking DNS lookup on the request
+thread. Cached addresses are kept for the TTL of their DNS records when
+`dnspython` is installed, and for `DNS_CACHE_TTL` seconds otherwise.
+Once expired, an entry is still served while it is refreshed in the
+background, and it keeps being served if the refresh fails, for up to
+`DNS_CACHE_MAX_STALE` seconds.
+"""
+import ipaddress
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from api import metrics
+from api.app_logger import get_logger
+from . import env_config
+
+try:
+    import dns.exception  # type: ignore
+    import dns.resolver  # type: ignore
+except ImportError:
+    dns = None  # pylint: disable=invalid-name
+
+logger = get_logger("dns-cache")
+
+if dns is None and env_config.DNS_CACHE_ENABLED:
+    logger.warning(
+        "dnspython is not installed. DNS lookups are cached for"
+        " DNS_CACHE_TTL seconds instead of the TTL of their records."
+    )
+
+# A resolver returns the addresses of a host and how long, in seconds,
+# they may be cached for.
+Resolver = Callable[[str], tuple[list[str], float]]
+
+lookups_total = metrics.counter(
+    "dns_cache_lookups_total", "Upstream host lookups by result."
+)
+resolve_duration = metrics.histogram(
+    "dns_resolve_duration_seconds", "Time taken by DNS lookups of upstream hosts."
+)
+
+
+def system_resolver(host: str) -> tuple[list[str], float]:
+    """
+    Resolves the host with the system resolver, which doesn't report
+    TTLs.
+    """
+    infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    return addresses, env_config.DNS_CACHE_TTL
+
+
+def dnspython_resolver(host: str) -> tuple[list[str], float]:
+    """
+    Resolves the host's A records with `dnspython`, honoring their TTL.
+    Hosts that aren't in the DNS, such as `localhost`, are resolved
+    with the system resolver.
+    """
+    try:
+        answer = dns.resolver.resolve(host, "A", lifetime=env_config.DNS_TIMEOUT)
+    except dns.exception.DNSException:
+        return system_resolver(host)
+    return [record.address for record in answer], answer.rrset.ttl
+
+
+@dataclass
+class Entry:
+    """
+    The cached addresses of a host.
+    """
+
+    addresses: list[str]
+    expires_at: float
+    refreshing: bool = False
+
+
+class DNSCache:
+    """
+    Caches the addresses returned by a resolver.
+    """
+
+    def __init__(self, resolver: Resolver, max_stale: float) -> None:
+        self.resolver = resolver
+        self.max_stale = max_stale
+        self._lock = threading.Lock()
+        self._entries: dict[str, Entry] = {}
+
+    def resolve(self, host: str) -> list[str]:
+        """
+        Returns the addresses of the host. Raises `socket.gaierror` if
+        the host can't be resolved and there is no usable stale entry.
+        """
+        if is_ip_address(host):
+            return [host]
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None and now < entry.expires_at:
+                lookups_total.inc(result="hit")
+                return entry.addresses
+            usable = entry is not None and now < entry.expires_at + self.max_stale
+            if usable and not entry.refreshing:
+                entry.refreshing = True
+                threading.Thread(
+                    target=self._refresh, args=(host,), name="dns-refresh", daemon=True
+                ).start()
+        if usable:
+            lookups_total.inc(result="stale")
+            return entry.addresses
+
+        lookups_total.inc(result="miss")
+        return self._refresh(host)
+
+    def _refresh(self, host: str) -> list[str]:
+        started_at = time.monotonic()
+        try:
+            addresses, ttl = self.resolver(host)
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME, f"no addresses for {host}")
+        except OSError as ex:
+            lookups_total.inc(result="error")
+            logger.error("Could not resolve %s: %s", host, ex)
+            with self._lock:
+                entry = self._entries.get(host)
+                if entry is not None:
+                    entry.refreshing = False
+                    if time.time() < entry.expires_at + self.max_stale:
+                        return entry.addresses
+            raise
+        finally:
+            resolve_duration.observe(time.monotonic() - started_at)
+
+        with self._lock:
+            self._entries[host] = Entry(addresses, time.time() + ttl)
+        return addresses
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+def is_ip_address(host: str) -> bool:
+    # pylint: disable=missing-function-docstring
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+_cache: Optional[DNSCache] = None
+
+
+def get_cache() -> DNSCache:
+    """
+    Returns the process-wide cache, creating it if needed.
+    """
+    global _cache  # pylint: disable=global-statement
+    if _cache is None:
+        resolver = system_resolver if dns is None else dnspython_resolver
+        _cache = DNSCache(resolver, env_config.DNS_CACHE_MAX_STALE)
+    return _cache
+
+
+def reset():
+    """
+    Discards the process-wide cache, and with it the state of refreshes
+    that were running in the parent of a forked process.
+    """
+    global _cache  # pylint: disable=global-statement
+    _cache = None
@@ -53,3 +53,210 @@ redirectUiToLocalhost = os.getenv("REDIRECT_UI_TO_LOCALHOST", "")
 REDIRECT_UI_TO_LOCALHOST = False
 if redirectUiToLocalhost == "" or redirectUiToLocalhost == "False":
     REDIRECT_UI_TO_LOCALHOST = False
+
+# The largest request body, in bytes, that the API proxies will forward
+# upstream. Bodies are streamed from the WSGI input to the upstream
+# connection, so this bounds the upload size rather than memory use.
+MAX_PROXY_BODY_SIZE = int(os.getenv("MAX_PROXY_BODY_SIZE", str(10 * 1024 * 1024)))
+
+# When enabled, `/api/laasie/sfmc` spools payloads to a local SQLite
+# database and returns a 202 while a background thread delivers them
+# to Laasie in batches. Requires `SERVER_SIDE_SESSIONS`: payloads are
+# delivered with the access token of the sender's session, which is
+# not stored in the spool.
+LAASIE_ASYNC_DELIVERY = os.getenv("LAASIE_ASYNC_DELIVERY", "False") == "True"
+LAASIE_SPOOL_BATCH_SIZE = int(os.getenv("LAASIE_SPOOL_BATCH_SIZE", "20"))
+LAASIE_SPOOL_POLL_INTERVAL = float(os.getenv("LAASIE_SPOOL_POLL_INTERVAL", "1.0"))
+LAASIE_SPOOL_MAX_ATTEMPTS = int(os.getenv("LAASIE_SPOOL_MAX_ATTEMPTS", "10"))
+
+# The bearer token Prometheus scrapes `/metrics` with. The metrics name
+# the tenants and their volumes, so the route is not found unless a
+# token is set.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Connection pooling for the upstream SFMC and Laasie hosts. The number
+# of hosts to keep pools for and the connections kept open per host.
+UPSTREAM_POOL_HOSTS = int(os.getenv("UPSTREAM_POOL_HOSTS", "32"))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv("UPSTREAM_POOL_MAXSIZE", "8"))
+
+# The server-side cache of upstream responses that are requested right
+# after login (user info, categories and the Laasie HTML blocks.)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+
+# Prefetching of the above into the cache after login and token refresh.
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "True") == "True"
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+WARMUP_MAX_WORKERS = int(os.getenv("WARMUP_MAX_WORKERS", "2"))
+WARMUP_MAX_PENDING = int(os.getenv("WARMUP_MAX_PENDING", "16"))
+
+# When enabled, the SFMC and Laasie tokens are kept in a server-side
+# session store and the browser only gets an opaque session id cookie.
+SERVER_SIDE_SESSIONS = os.getenv("SERVER_SIDE_SESSIONS", "False") == "True"
+# Sessions live as long as the SFMC refresh token (14 days.)
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(14 * 24 * 60 * 60)))
+# Refresh the SFMC access token of a session when it expires within
+# this many seconds.
+SESSION_REFRESH_MARGIN = float(os.getenv("SESSION_REFRESH_MARGIN", "300"))
+
+# The base URLs of the customer's SFMC REST and auth hosts. `{tssd}` is
+# replaced with the tenant sub-domain. Override these to point the API at
+# a local stand-in upstream, e.g. `api/tools/stub_upstream.py`.
+SFMC_REST_BASE_URL = os.getenv(
+    "SFMC_REST_BASE_URL", "https://{tssd}.rest.marketingcloudapis.com"
+)
+SFMC_AUTH_BASE_URL = os.getenv(
+    "SFMC_AUTH_BASE_URL", "https://{tssd}.auth.marketingcloudapis.com"
+)
+
+# The default timeout, in seconds, of proxied SFMC requests. It matches
+# the timeout of the UI's SFMC client. Routes may declare their own.
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "20"))
+# The timeout, in seconds, of the calls to Laasie.
+LAASIE_UPSTREAM_TIMEOUT = float(os.getenv("LAASIE_UPSTREAM_TIMEOUT", "30"))
+# The timeouts of the UI's SFMC and Laasie clients. The upstream calls
+# made for a request from the UI never outlast them.
+SFMC_CLIENT_TIMEOUT = float(os.getenv("SFMC_CLIENT_TIMEOUT", "20"))
+LAASIE_CLIENT_TIMEOUT = float(os.getenv("LAASIE_CLIENT_TIMEOUT", "30"))
+# Shorten the timeout of each route and upstream host to
+# ADAPTIVE_TIMEOUT_MULTIPLIER times the ADAPTIVE_TIMEOUT_PERCENTILE of
+# its latencies over the last ADAPTIVE_TIMEOUT_WINDOW seconds, once
+# ADAPTIVE_TIMEOUT_MIN_SAMPLES calls were made, but never below
+# ADAPTIVE_TIMEOUT_FLOOR seconds.
+ADAPTIVE_TIMEOUTS_ENABLED = os.getenv("ADAPTIVE_TIMEOUTS_ENABLED", "False") == "True"
+ADAPTIVE_TIMEOUT_PERCENTILE = float(os.getenv("ADAPTIVE_TIMEOUT_PERCENTILE", "0.99"))
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "3"))
+ADAPTIVE_TIMEOUT_FLOOR = float(os.getenv("ADAPTIVE_TIMEOUT_FLOOR", "2"))
+ADAPTIVE_TIMEOUT_WINDOW = float(os.getenv("ADAPTIVE_TIMEOUT_WINDOW", "300"))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.getenv("ADAPTIVE_TIMEOUT_MIN_SAMPLES", "20"))
+# How many times idempotent proxied requests are retried when SFMC
+# can't be reached or returns a 502, 503 or 504, and the delay between
+# attempts in seconds.
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "1"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.2"))
+
+# Admission control of requests that call an upstream, per worker
+# process. At most ADMISSION_MAX_INFLIGHT of them are served at once and
+# at most ADMISSION_MAX_QUEUE wait for up to ADMISSION_MAX_QUEUE_WAIT
+# seconds; the rest are rejected with a 503. The OAuth2 callbacks have a
+# separate cap. The defaults leave one of the worker's threads free for
+# health checks and static files. Waiting requests hold a worker thread,
+# so the queue can only be as long as the spare threads allow: it is
+# disabled by default and meant to shed load on workers with many
+# threads.
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "4"))
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "False") == "True"
+ADMISSION_MAX_INFLIGHT = int(
+    os.getenv("ADMISSION_MAX_INFLIGHT", str(max(1, GUNICORN_THREADS - 3)))
+)
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1"))
+ADMISSION_MAX_QUEUE_WAIT = float(os.getenv("ADMISSION_MAX_QUEUE_WAIT", "2"))
+ADMISSION_OAUTH_MAX_INFLIGHT = int(os.getenv("ADMISSION_OAUTH_MAX_INFLIGHT", "1"))
+# The upstream requests in flight of a single tenant, which by default
+# leaves a slot for the other tenants, and the weights of the tenants'
+# shares of the slots as comma-separated `tssd=weight` pairs (1 if not
+# listed.) The weights are parsed by `admission.parse_tenant_weights`,
+# which skips the invalid pairs.
+ADMISSION_TENANT_MAX_INFLIGHT = int(
+    os.getenv("ADMISSION_TENANT_MAX_INFLIGHT", str(max(1, ADMISSION_MAX_INFLIGHT - 1)))
+)
+ADMISSION_TENANT_WEIGHTS = os.getenv("ADMISSION_TENANT_WEIGHTS", "")
+
+# Caching of the IP addresses of the upstream hosts. Addresses are kept
+# for the TTL of their DNS records if `dnspython` is installed, else for
+# DNS_CACHE_TTL seconds, and served for up to DNS_CACHE_MAX_STALE more
+# seconds while they are refreshed or when the resolver fails.
+DNS_CACHE_ENABLED = os.getenv("DNS_CACHE_ENABLED", "True") == "True"
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", "60"))
+DNS_CACHE_MAX_STALE = float(os.getenv("DNS_CACHE_MAX_STALE", "3600"))
+DNS_TIMEOUT = float(os.getenv("DNS_TIMEOUT", "5"))
+
+# The upstreams to send requests to over HTTP/2, comma-separated, out of
+# `sfmc_rest`, `sfmc_auth` and `laasie`. Requires httpx[http2].
+UPSTREAM_HTTP2 = [
+    name.strip() for name in os.getenv("UPSTREAM_HTTP2", "").split(",") if name.strip()
+]
+
+# Report the time taken by the phases of each request in a Server-Timing
+# response header and, with TRACE_LOG, as a JSON log line per request.
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "True") == "True"
+TRACE_LOG = os.getenv("TRACE_LOG", "False") == "True"
+
+# The JSON implementation used for upstream payloads: `auto` (orjson if
+# it is installed, else the standard library), `orjson` or `stdlib`.
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")
+
+# An in-memory index of the HTML blocks of each user of a business unit
+# (at most ASSET_INDEX_MAX_TENANTS of them), which answers the
+# customerKey lookups and category listings of the assets that only ask
+# for indexed fields. It is synced in the background once
+# ASSET_INDEX_SYNC_INTERVAL seconds old, and never answers with data
+# older than ASSET_INDEX_MAX_STALENESS seconds, apart from deletions,
+# which are only seen by the full syncs every
+# ASSET_INDEX_FULL_SYNC_INTERVAL seconds.
+ASSET_INDEX_ENABLED = os.getenv("ASSET_INDEX_ENABLED", "False") == "True"
+ASSET_INDEX_SYNC_INTERVAL = float(os.getenv("ASSET_INDEX_SYNC_INTERVAL", "10"))
+ASSET_INDEX_MAX_STALENESS = float(os.getenv("ASSET_INDEX_MAX_STALENESS", "30"))
+ASSET_INDEX_FULL_SYNC_INTERVAL = float(
+    os.getenv("ASSET_INDEX_FULL_SYNC_INTERVAL", "3600")
+)
+ASSET_INDEX_MAX_ASSETS = int(os.getenv("ASSET_INDEX_MAX_ASSETS", "10000"))
+ASSET_INDEX_MAX_TENANTS = int(os.getenv("ASSET_INDEX_MAX_TENANTS", "64"))
+
+# The thumbnails served as images by the thumbnail image route. They are
+# encoded in the first of THUMBNAIL_FORMATS, out of `avif` and `webp`,
+# that the browser accepts and Pillow can encode, else in JPEG, and
+# never larger than THUMBNAIL_MAX_SIZE pixels wide or high. AVIF is
+# about half the size of WebP but several times slower to encode.
+THUMBNAIL_FORMATS = [
+    name.strip()
+    for name in os.getenv("THUMBNAIL_FORMATS", "webp").split(",")
+    if name.strip()
+]
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", "1024"))
+THUMBNAIL_CACHE_MAX_BYTES = int(
+    os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(32 * 1024 * 1024))
+)
+# Seconds that browsers may use a thumbnail before revalidating it.
+THUMBNAIL_MAX_AGE = int(os.getenv("THUMBNAIL_MAX_AGE", "3600"))
+
+# Bulk export and import of the Laasie HTML blocks. The most blocks an
+# import saves to SFMC at once, within the admission slots free for its
+# tenant, and the largest archive it accepts.
+BULK_IMPORT_CONCURRENCY = int(os.getenv("BULK_IMPORT_CONCURRENCY", "4"))
+BULK_IMPORT_MAX_BYTES = int(os.getenv("BULK_IMPORT_MAX_BYTES", str(100 * 1024 * 1024)))
+
+# Capture the metadata of the proxied SFMC calls, without tokens,
+# cookies or bodies, to CAPTURE_FILE (by default, a file in the instance
+# folder) for `tools/replay_capture.py`. CAPTURE_SAMPLE_RATE is the
+# fraction of the calls captured.
+CAPTURE_ENABLED = os.getenv("CAPTURE_ENABLED", "False") == "True"
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "")
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "1.0"))
+
+# Answer the asset updates that wouldn't change the asset, as far as the
+# assets read and written with the same access token (or the asset index
+# synced) in the last UNCHANGED_WRITE_TTL seconds tell, without sending
+# them to SFMC. Keep the TTL to a few seconds, the time between the UI's
+# lookup of an asset and its update, since the asset may have changed in
+# SFMC since. The hashes of at most UNCHANGED_WRITE_MAX_ASSETS assets
+# are kept. It is off by default: the updates are then streamed to SFMC,
+# while skipping them reads each update and its response into memory.
+SKIP_UNCHANGED_WRITES = os.getenv("SKIP_UNCHANGED_WRITES", "False") == "True"
+UNCHANGED_WRITE_TTL = float(os.getenv("UNCHANGED_WRITE_TTL", "5"))
+UNCHANGED_WRITE_MAX_ASSETS = int(os.getenv("UNCHANGED_WRITE_MAX_ASSETS", "10000"))
+
+# The batch route: the most sub-requests a batch may have and how many of
+# them are sent to SFMC at once, within the admission slots free for its
+# tenant.
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "20"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+# Keep the cached SFMC responses and thumbnails in a SQLite database in
+# the instance folder too, so that they survive restarts and deploys,
+# for as long as they would be cached in memory. The database holds at
+# most PERSISTENT_CACHE_MAX_BYTES of content.
+PERSISTENT_CACHE_ENABLED = os.getenv("PERSISTENT_CACHE_ENABLED", "False") == "True"
+PERSISTENT_CACHE_MAX_BYTES = int(
+    os.getenv("PERSISTENT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))
+)
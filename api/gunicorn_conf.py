@@ -0,0 +1,45 @@
+"""
+The gunicorn configuration used by the Dockerfile.
+
+    gunicorn --config python:api.gunicorn_conf "api:create_app()"
+
+The number of worker processes defaults to the number of CPU cores
+available to the container and can be overridden with
+`GUNICORN_WORKERS`. Set `GUNICORN_WORKERS=1` for the previous
+single-process profile. The app is preloaded in the master process so
+that the workers share the imported code copy-on-write, and each
+worker recreates its connection pools, caches and background threads
+after it is forked (see `api.lifecycle`.)
+"""
+import os
+
+from api import lifecycle
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = f":{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("GUNICORN_WORKERS", str(_available_cores())))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+# Timeout is set to 0 to disable the timeouts of the workers to allow
+# AWS to handle instance scaling.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "0"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "True") == "True"
+accesslog = "-"
+errorlog = "-"
+
+
+def pre_fork(server, worker):
+    # pylint: disable=missing-function-docstring,unused-argument
+    lifecycle.before_fork()
+
+
+def post_fork(server, worker):
+    # pylint: disable=missing-function-docstring,unused-argument
+    lifecycle.after_fork()
+    server.log.info("Worker %s initialized its per-process resources", worker.pid)
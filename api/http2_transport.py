@@ -0,0 +1,184 @@
+"""
+An optional HTTP/2 transport for the upstream session.
+
+With HTTP/2, concurrent requests to the same upstream host are
+multiplexed over a single connection instead of each needing their
+own. The transport is a `requests` adapter backed by an `httpx` client,
+so callers keep using the shared `requests` session and only the
+upstreams listed in `UPSTREAM_HTTP2` are routed through it. HTTP/2 is
+negotiated with ALPN, and connections to hosts that don't support it,
+or that use plain HTTP, fall back to HTTP/1.1.
+
+Requires `httpx[http2]`, which isn't installed by default. Connections
+made by this transport don't use the DNS cache or the environment's
+proxy settings.
+"""
+import re
+from typing import Iterator, Optional, Pattern
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from api.app_logger import get_logger
+from . import env_config
+
+try:
+    import httpx
+except ImportError:
+    httpx = None  # pylint: disable=invalid-name
+
+logger = get_logger("http2-transport")
+
+if httpx is None and env_config.UPSTREAM_HTTP2:
+    logger.warning(
+        "UPSTREAM_HTTP2 is set but httpx[http2] is not installed."
+        " The upstreams are used over HTTP/1.1."
+    )
+
+# Headers that are specific to an HTTP/1.1 connection and are not
+# allowed in HTTP/2 requests.
+HOP_BY_HOP_HEADERS = ("connection", "keep-alive", "proxy-connection", "upgrade")
+REQUEST_BODY_BLOCK_SIZE = 64 * 1024
+
+
+def get_base_urls() -> dict[str, str]:
+    """
+    Returns the base URL of each upstream by name. The SFMC URLs contain
+    a `{tssd}` placeholder.
+    """
+    return {
+        "sfmc_rest": env_config.SFMC_REST_BASE_URL,
+        "sfmc_auth": env_config.SFMC_AUTH_BASE_URL,
+        "laasie": env_config.LAASIE_API_BASE_URL,
+    }
+
+
+def get_url_pattern(upstream_names: list[str]) -> Optional[Pattern[str]]:
+    """
+    Returns a pattern that matches the URLs of the named upstreams, or
+    None if no upstream is named.
+    """
+    base_urls = get_base_urls()
+    prefixes = []
+    for name in upstream_names:
+        if name not in base_urls:
+            logger.error("Unknown upstream for HTTP/2: %s", name)
+        elif base_urls[name]:
+            prefixes.append(re.escape(base_urls[name]).replace(r"\{tssd\}", r"[^./]+"))
+    if not prefixes:
+        return None
+    return re.compile(f"(?:{'|'.join(prefixes)})(?:[/?]|$)", re.IGNORECASE)
+
+
+class HTTP2ResponseBody:
+    """
+    Exposes the body of an `httpx` response as the `raw` body of a
+    `requests` response.
+    """
+
+    def __init__(self, response: "httpx.Response") -> None:
+        self._response = response
+        self.reason = response.reason_phrase
+
+    def stream(self, chunk_size: int, decode_content: bool = True) -> Iterator[bytes]:
+        # pylint: disable=missing-function-docstring,unused-argument
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except httpx.TransportError as ex:
+            raise requests.ConnectionError(ex) from ex
+        finally:
+            self._response.close()
+
+    def close(self):
+        # pylint: disable=missing-function-docstring
+        self._response.close()
+
+
+class HTTP2Adapter(BaseAdapter):
+    """
+    A `requests` transport adapter that sends requests with `httpx`,
+    over HTTP/2 when the upstream supports it.
+    """
+
+    def __init__(self, max_connections: int) -> None:
+        super().__init__()
+        self._client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        # pylint: disable=too-many-arguments
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+            timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+        headers = [
+            (key, value)
+            for key, value in request.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS
+        ]
+        content = request.body
+        if hasattr(content, "read"):
+            body = content
+            content = iter(lambda: body.read(REQUEST_BODY_BLOCK_SIZE), b"")
+
+        try:
+            http_resp = self._client.send(
+                self._client.build_request(
+                    request.method,
+                    request.url,
+                    headers=headers,
+                    content=content,
+                    timeout=timeout,
+                ),
+                stream=True,
+            )
+        except httpx.ConnectTimeout as ex:
+            raise requests.ConnectTimeout(ex, request=request) from ex
+        except httpx.TimeoutException as ex:
+            raise requests.ReadTimeout(ex, request=request) from ex
+        except httpx.TransportError as ex:
+            raise requests.ConnectionError(ex, request=request) from ex
+
+        return self.build_response(request, http_resp)
+
+    def build_response(self, request, http_resp: "httpx.Response"):
+        """
+        Returns the `requests` response for an `httpx` response.
+        """
+        resp = requests.Response()
+        resp.status_code = http_resp.status_code
+        # httpx decodes compressed bodies.
+        resp.headers = CaseInsensitiveDict(
+            (key, value)
+            for key, value in http_resp.headers.items()
+            if key.lower() != "content-encoding"
+        )
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.raw = HTTP2ResponseBody(http_resp)
+        resp.reason = resp.raw.reason
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def close(self):
+        self._client.close()
+
+
+def make_adapter() -> Optional[HTTP2Adapter]:
+    """
+    Returns an HTTP/2 adapter, or None if `httpx` isn't installed.
+    """
+    if httpx is None:
+        logger.error("UPSTREAM_HTTP2 is set but httpx[http2] is not installed.")
+        return None
+    return HTTP2Adapter(env_config.UPSTREAM_POOL_HOSTS)
@@ -0,0 +1,99 @@
+"""
+The JSON codec used to parse and serialize upstream payloads.
+
+`orjson` is used when it is installed, as it is several times faster
+than the standard library's `json` on the asset listings and token
+responses the API handles, and `json` otherwise. `JSON_CODEC` forces
+either one.
+"""
+from dataclasses import dataclass
+import json
+from typing import Any, Callable, Union
+
+from api.app_logger import get_logger
+from . import env_config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # pylint: disable=invalid-name
+
+logger = get_logger("json-codec")
+
+
+@dataclass(frozen=True)
+class Codec:
+    """
+    A JSON implementation.
+    """
+
+    name: str
+    loads: Callable[[Union[bytes, str]], Any]
+    dumps: Callable[[Any], bytes]
+    # Serializes with sorted keys, so equal objects give equal bytes.
+    dumps_canonical: Callable[[Any], bytes]
+
+
+STDLIB = Codec(
+    "stdlib",
+    json.loads,
+    lambda obj: json.dumps(obj, separators=(",", ":")).encode(),
+    lambda obj: json.dumps(obj, sort_keys=True, separators=(",", ":")).encode(),
+)
+
+CODECS = {"stdlib": STDLIB}
+if orjson is not None:
+    CODECS["orjson"] = Codec(
+        "orjson",
+        orjson.loads,
+        orjson.dumps,
+        lambda obj: orjson.dumps(obj, option=orjson.OPT_SORT_KEYS),
+    )
+
+
+def get_codec(name: str) -> Codec:
+    """
+    Returns the codec with the given name, or the fastest available one
+    for `auto`.
+    """
+    if name == "auto":
+        if "orjson" not in CODECS:
+            logger.warning("orjson is not installed. Using stdlib.")
+        return CODECS.get("orjson", STDLIB)
+    if name not in CODECS:
+        logger.error("JSON codec %s is not available. Using stdlib.", name)
+        return STDLIB
+    return CODECS[name]
+
+
+codec = get_codec(env_config.JSON_CODEC)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Parses a JSON document. Raises a `ValueError` if it is invalid.
+    """
+    return codec.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serializes the object to compact JSON.
+    """
+    return codec.dumps(obj)
+
+
+def dumps_canonical(obj: Any) -> bytes:
+    """
+    Serializes the object to compact JSON with sorted keys.
+    """
+    return codec.dumps_canonical(obj)
+
+
+def validate(data: bytes):
+    """
+    Raises a `ValueError` if the data isn't a valid JSON document. Use
+    it for payloads that are passed on as-is, so that they aren't
+    serialized again.
+    """
+    codec.loads(data)
@@ -5,6 +5,7 @@ from typing import Any, Union
 from flask.wrappers import Response
 from flask import (
     Blueprint,
+    jsonify,
     make_response,
 )
 
@@ -12,6 +13,7 @@ from itsdangerous import want_bytes
 import requests
 from werkzeug import wrappers
 
+from api import deadlines, json_codec, session_store
 from api.app_logger import get_logger
 from api.cookies import get_signer
 
@@ -42,7 +44,7 @@ def from_json_dict(obj: dict[Any, Any]) -> AccessTokenResponse:
     if the provided dict contains known properties. Otherwise,
     returns the dict as-is.
     """
-    if obj.get("token", None) is not None:
+    if isinstance(obj, dict) and obj.get("token", None) is not None:
         return AccessTokenResponse(
             access_token=obj["token"],
         )
@@ -71,14 +73,34 @@ def access_token() -> Union[str, Response, wrappers.Response]:
     In this case, SFMC is the OAuth2 server that redirects the user's browser
     to this endpoint upon the user's successful authentication.
     """
-    access_token_resp = requests.post(
-        f"{AUTH_BASE_URL}/auth",
-        json={
-            "api_id": env_config.LAASIE_API_USERNAME,
-            "api_key": env_config.LAASIE_API_PASSWORD,
-        },
-        headers={"Content-Type": "application/json"},
-    )
+    try:
+        access_token_resp = deadlines.send(
+            "POST",
+            f"{AUTH_BASE_URL}/auth",
+            "laasie_token",
+            env_config.LAASIE_UPSTREAM_TIMEOUT,
+            deadlines.current(),
+            json={
+                "api_id": env_config.LAASIE_API_USERNAME,
+                "api_key": env_config.LAASIE_API_PASSWORD,
+            },
+            headers={"Content-Type": "application/json"},
+        )
+    except requests.Timeout:
+        logger.error("Request for an access token from Laasie timed out.")
+        resp = jsonify(
+            error="upstream_timeout",
+            error_description="Laasie did not respond in time.",
+        )
+        resp.status_code = 504
+        return resp
+    except requests.RequestException as ex:
+        logger.error("Failed to fetch access token from Laasie: %s", ex)
+        resp = jsonify(
+            error="upstream_error", error_description="Could not reach Laasie."
+        )
+        resp.status_code = 502
+        return resp
 
     if access_token_resp.status_code != 200:
         logger.error(
@@ -88,12 +110,12 @@ def access_token() -> Union[str, Response, wrappers.Response]:
         )
         return error_response()
 
+    token_resp = json_codec.loads(access_token_resp.content)
     try:
-        token = access_token_resp.json(object_hook=from_json_dict)
+        token = from_json_dict(token_resp)
     except InvalidTokenResponse as ex:
-        error_resp = access_token_resp.json()
         logger.error("Error parsing JSON response from token endpoint %s", ex.message)
-        logger.error(error_resp)
+        logger.error(token_resp)
         return error_response()
 
     resp = make_response()
@@ -106,8 +128,15 @@ def access_token() -> Union[str, Response, wrappers.Response]:
 
 def set_cookies(http_resp: Response, token: AccessTokenResponse):
     """
-    Sets the cookies for the external API.
+    Sets the cookies for the external API, or stores the token in the
+    request's server-side session if those are enabled.
     """
+    if session_store.get_store() is not None:
+        session_store.save_current_session(
+            http_resp, {"external_access_token": token.access_token}
+        )
+        return
+
     signer = get_signer()
     # Access tokens are valid for 20 minutes but we'll expire the cookie
     # before then.
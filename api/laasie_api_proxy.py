@@ -1,6 +1,11 @@
+import hashlib
+import time
+
 from flask import (
     Blueprint,
+    abort,
     g,
+    jsonify,
     request as flask_request,
     make_response,
 )
@@ -8,7 +13,15 @@ from flask.wrappers import Response as FlaskResponse
 
 import requests
 
-from api import sfmc_oauth2
+from api import (
+    deadlines,
+    json_codec,
+    laasie_spool,
+    session_store,
+    sfmc_oauth2,
+    tracing,
+    traffic_capture,
+)
 from api.app_logger import get_logger
 from api.cookies import verify_signature
 from . import env_config
@@ -16,6 +29,8 @@ from . import env_config
 API_BASE_URL = env_config.LAASIE_API_BASE_URL
 bp = Blueprint("laasie_api_proxy", __name__, url_prefix="/api/laasie")
 logger = get_logger(bp.name)
+# The route of the payloads, in the timeouts and the traffic capture.
+PAYLOAD_ROUTE_NAME = "laasie_sfmc_payload"
 
 
 def bp_url_prefix() -> str:
@@ -34,6 +49,23 @@ def get_request_url(request_path: str) -> str:
     return f"{API_BASE_URL}{request_path}"
 
 
+def get_json_body() -> bytes:
+    """
+    Returns the body of the incoming request after checking that it is a
+    JSON document. The body is forwarded as-is instead of being decoded
+    and encoded again. Aborts the request with a 400 if it isn't JSON.
+    """
+    if not flask_request.is_json:
+        abort(400)
+    body = flask_request.get_data()
+    try:
+        json_codec.validate(body)
+    except ValueError:
+        logger.error("Refusing to forward a request body that isn't valid JSON.")
+        abort(400)
+    return body
+
+
 def get_content_type(http_resp: requests.Response) -> str:
     """
     Returns the content-type header value from the response, if set,
@@ -47,12 +79,21 @@ def get_content_type(http_resp: requests.Response) -> str:
 
 
 @bp.before_request
+@tracing.traced("verify")
 def before_request():
     """
     Middleware that executes before every request in this blueprint.
     Checks for the tenant sub-domain and the SFMC access token cookies
     and that the access token passes signature verification.
+    With server-side sessions, the tokens come from the session instead.
     """
+    if session_store.get_store() is not None:
+        session_tokens = sfmc_oauth2.get_session_tokens()
+        if session_tokens is None:
+            return FlaskResponse(status=401)
+        g.tenant_subdomain, g.decoded_token = session_tokens
+        return None
+
     if sfmc_oauth2.ACCESS_TOKEN_COOKIE_NAME not in flask_request.cookies:
         return FlaskResponse(status=401)
 
@@ -66,21 +107,105 @@ def before_request():
     g.decoded_token = decoded_token
 
 
+def get_tenant() -> str:
+    """
+    Returns the SFMC tenant of the request, or a hash of the user's
+    token if it has none.
+    """
+    return (
+        g.get("tenant_subdomain")
+        or flask_request.cookies.get(sfmc_oauth2.TSSD_COOKIE_NAME)
+        or hashlib.sha256(g.decoded_token.encode()).hexdigest()
+    )
+
+
 @bp.route("/sfmc", methods=["POST"])
 def save_sfmc_payload():
     """
     Post the server-to-server credentials to Laasie.
     """
-    decoded_token = g.decoded_token
-
+    started_at = time.monotonic()
     url = get_request_url(flask_request.path.replace(bp_url_prefix(), ""))
-    logger.info("proxying request to %s", url)
-    http_resp = requests.post(
-        url,
-        json=flask_request.get_json(),
-        headers={"Authorization": f"Bearer {decoded_token}"},
+    call = traffic_capture.Call(
+        route=PAYLOAD_ROUTE_NAME,
+        tenant_subdomain=get_tenant(),
+        url=url,
+        request_bytes=flask_request.content_length or 0,
+        upstream_seconds=0.0,
+        projected=False,
+    )
+    resp = send_sfmc_payload(call)
+    traffic_capture.capture(call, resp, started_at)
+    return resp
+
+
+def get_upstream_error_response(
+    url: str, ex: requests.RequestException
+) -> FlaskResponse:
+    """
+    Returns the response for a request to Laasie that failed: 504 if it
+    timed out, 502 otherwise.
+    """
+    if isinstance(ex, requests.Timeout):
+        logger.error("Request to %s timed out.", url)
+        resp = jsonify(
+            error="upstream_timeout",
+            error_description="Laasie did not respond in time.",
+        )
+        resp.status_code = 504
+        return resp
+    logger.error("Request to %s failed: %s", url, ex)
+    resp = jsonify(
+        error="upstream_error",
+        error_description="Could not reach Laasie.",
     )
+    resp.status_code = 502
+    return resp
+
 
+def send_sfmc_payload(call: traffic_capture.Call) -> FlaskResponse:
+    """
+    Spools or sends the payload to Laasie and returns the response for
+    the client, adding the time spent waiting for Laasie to the call.
+    """
+    decoded_token = g.decoded_token
+    url = call.url
+
+    spool = laasie_spool.get_spool()
+    # Spooled payloads are delivered with the token of the user's
+    # server-side session.
+    if spool is not None and g.get("session_id"):
+        # Validate the payload before accepting it for delivery.
+        body = get_json_body()
+        # Payloads are de-duplicated per tenant. Requests without a
+        # tenant fall back to the user's token so they are never merged.
+        spool.enqueue(call.tenant_subdomain, url, g.session_id, body)
+        logger.info("spooled request to %s", url)
+        resp = jsonify(status="queued")
+        resp.status_code = 202
+        return resp
+
+    logger.info("proxying request to %s", url)
+    body = get_json_body()
+    started_at = time.monotonic()
+    try:
+        http_resp = deadlines.send(
+            "POST",
+            url,
+            PAYLOAD_ROUTE_NAME,
+            env_config.LAASIE_UPSTREAM_TIMEOUT,
+            deadlines.current(),
+            data=body,
+            headers={
+                "Authorization": f"Bearer {decoded_token}",
+                "Content-Type": "application/json",
+            },
+        )
+    except requests.RequestException as ex:
+        call.upstream_seconds = time.monotonic() - started_at
+        return get_upstream_error_response(url, ex)
+
+    call.upstream_seconds = time.monotonic() - started_at
     resp = make_response()
     resp.set_data(http_resp.content)
     resp.headers.add("Content-Type", get_content_type(http_resp))
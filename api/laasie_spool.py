@@ -0,0 +1,311 @@
+"""
+A durable local spool for payloads that are delivered to Laasie
+asynchronously.
+
+Payloads are appended to a SQLite database (in WAL mode) under the
+app's instance folder and delivered in batches by a background thread.
+Only the most recent pending payload of a tenant is kept, so a tenant
+that saves its settings several times while Laasie is unavailable
+only results in a single delivery. Failed deliveries are retried with
+an exponential backoff.
+
+Access tokens are not written to the spool. Each payload refers to the
+server-side session of the user who sent it, and is delivered with the
+session's current access token, so the spool needs server-side
+sessions. Payloads whose session or access token has expired are
+dropped.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from api import deadlines, metrics, session_store
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("laasie-spool")
+
+SPOOL_FILE_NAME = "laasie_spool.sqlite3"
+# How long a worker may hold a batch before other workers consider
+# its entries abandoned and deliver them again.
+CLAIM_TIMEOUT_SECONDS = 60
+MAX_BACKOFF_SECONDS = 300
+
+spool_depth = metrics.gauge(
+    "laasie_spool_depth", "Number of payloads waiting to be delivered to Laasie."
+)
+delivery_latency = metrics.histogram(
+    "laasie_spool_delivery_latency_seconds",
+    "Time from spooling a payload to its delivery to Laasie.",
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600),
+)
+deliveries = metrics.counter(
+    "laasie_spool_deliveries_total", "Delivery attempts of spooled payloads."
+)
+
+
+class LaasieSpool:
+    """
+    Stores payloads on disk and delivers them to Laasie in the background.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 20,
+        poll_interval: float = 1.0,
+        max_attempts: int = 10,
+    ) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant TEXT NOT NULL,
+                url TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                body BLOB NOT NULL,
+                enqueued_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claimed_until REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS spool_tenant ON spool (tenant)")
+        self._update_depth()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _update_depth(self) -> int:
+        (depth,) = self._connection().execute("SELECT COUNT(*) FROM spool").fetchone()
+        spool_depth.set(depth)
+        return depth
+
+    def depth(self) -> int:
+        """
+        Returns the number of payloads waiting to be delivered.
+        """
+        return self._update_depth()
+
+    def enqueue(self, tenant: str, url: str, session_id: str, body: bytes):
+        """
+        Durably stores a payload for delivery with the access token of a
+        server-side session, replacing any payload of the same tenant
+        that has not been delivered yet.
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM spool WHERE tenant = ?", (tenant,))
+            conn.execute(
+                "INSERT INTO spool"
+                " (tenant, url, session_id, body, enqueued_at, next_attempt_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (tenant, url, session_id, body, now, now),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        self._update_depth()
+        self.start()
+        self._wakeup.set()
+
+    def _claim_batch(self) -> list[tuple]:
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, tenant, url, session_id, body, enqueued_at, attempts"
+                " FROM spool"
+                " WHERE next_attempt_at <= ? AND claimed_until <= ?"
+                " ORDER BY id LIMIT ?",
+                (now, now, self.batch_size),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE spool SET claimed_until = ? WHERE id = ?",
+                [(now + CLAIM_TIMEOUT_SECONDS, row[0]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def deliver_batch(self) -> int:
+        """
+        Delivers a batch of due payloads and returns the number of
+        payloads that were attempted.
+        """
+        rows = self._claim_batch()
+        if not rows:
+            return 0
+
+        conn = self._connection()
+        for entry_id, tenant, url, session_id, body, enqueued_at, attempts in rows:
+            token = get_access_token(session_id)
+            if token is None:
+                deliveries.inc(outcome="expired")
+                logger.error(
+                    "Dropping spooled payload for tenant %s: its access token"
+                    " has expired.",
+                    tenant,
+                )
+                conn.execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+                continue
+
+            try:
+                http_resp = deadlines.send(
+                    "POST",
+                    url,
+                    "laasie_spool_delivery",
+                    env_config.LAASIE_UPSTREAM_TIMEOUT,
+                    data=body,
+                    headers={
+                        "Authorization": f"Bearer {token}",
+                        "Content-Type": "application/json",
+                    },
+                )
+                status_code = http_resp.status_code
+            except requests.RequestException as ex:
+                logger.error("Failed to deliver spooled payload: %s", ex)
+                status_code = None
+
+            retryable = status_code is None or status_code == 429 or status_code >= 500
+            if status_code is not None and status_code < 400:
+                deliveries.inc(outcome="delivered")
+                delivery_latency.observe(time.time() - enqueued_at)
+                conn.execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+            elif retryable and attempts + 1 < self.max_attempts:
+                deliveries.inc(outcome="retried")
+                backoff = min(2 ** (attempts + 1), MAX_BACKOFF_SECONDS)
+                conn.execute(
+                    "UPDATE spool SET attempts = ?, next_attempt_at = ?,"
+                    " claimed_until = 0 WHERE id = ?",
+                    (attempts + 1, time.time() + backoff, entry_id),
+                )
+            else:
+                deliveries.inc(outcome="dropped")
+                logger.error(
+                    "Dropping spooled payload for tenant %s after %d attempt(s)"
+                    " (status: %s)",
+                    tenant,
+                    attempts + 1,
+                    status_code,
+                )
+                conn.execute("DELETE FROM spool WHERE id = ?", (entry_id,))
+
+        self._update_depth()
+        return len(rows)
+
+    def start(self):
+        """
+        Starts the delivery thread if it is not already running in this process.
+        """
+        with self._worker_lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stopped.clear()
+            self._worker = threading.Thread(
+                target=self._run, name="laasie-spool", daemon=True
+            )
+            self._worker.start()
+
+    def stop(self):
+        """
+        Stops the delivery thread.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+
+    def reopen(self):
+        """
+        Discards the database connections and the delivery thread
+        inherited from a parent process and resumes delivery, if needed,
+        in this process.
+        """
+        self._local = threading.local()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        if self.depth() > 0:
+            self.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                attempted = self.deliver_batch()
+            except sqlite3.Error as ex:
+                logger.error("Failed to read the Laasie spool: %s", ex)
+                attempted = 0
+            # Keep draining while there is work, otherwise wait for new
+            # payloads or for retries to become due.
+            if attempted < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+
+def get_access_token(session_id: str) -> Optional[str]:
+    """
+    Returns the access token of a server-side session, or None if the
+    session or its access token has expired.
+    """
+    store = session_store.get_store()
+    session_data = store.get(session_id) if store is not None else None
+    if session_data is None or "access_token" not in session_data:
+        return None
+    if session_data["access_token_expires_at"] <= time.time():
+        return None
+    return session_data["access_token"]
+
+
+_spool: Optional[LaasieSpool] = None
+
+
+def init_spool(instance_path: str) -> LaasieSpool:
+    """
+    Opens the spool in the given instance folder and starts delivering
+    any payloads left over from a previous run.
+    """
+    global _spool  # pylint: disable=global-statement
+    _spool = LaasieSpool(
+        os.path.join(instance_path, SPOOL_FILE_NAME),
+        batch_size=env_config.LAASIE_SPOOL_BATCH_SIZE,
+        poll_interval=env_config.LAASIE_SPOOL_POLL_INTERVAL,
+        max_attempts=env_config.LAASIE_SPOOL_MAX_ATTEMPTS,
+    )
+    if _spool.depth() > 0:
+        _spool.start()
+    return _spool
+
+
+def get_spool() -> Optional[LaasieSpool]:
+    """
+    Returns the spool if asynchronous delivery is enabled.
+    """
+    return _spool
@@ -0,0 +1,65 @@
+"""
+Hooks for running the app in a pre-forking server such as gunicorn.
+
+When the app is preloaded in the master process, its module state is
+shared copy-on-write with the workers. Sockets, database connections,
+locks held by other threads and the threads themselves don't survive
+the fork, so each worker recreates them after it is forked, along with
+the handlers of its loggers.
+"""
+from api import (
+    app_logger,
+    asset_index,
+    deadlines,
+    dns_cache,
+    laasie_spool,
+    persistent_cache,
+    response_cache,
+    session_store,
+    thumbnails,
+    unchanged_writes,
+    upstream,
+    warmup,
+)
+from api.app_logger import get_logger
+
+logger = get_logger("lifecycle")
+
+
+def before_fork():
+    """
+    Stops the background work of the master process so that it isn't
+    duplicated by, or racing with, the workers.
+    """
+    spool = laasie_spool.get_spool()
+    if spool is not None:
+        spool.stop()
+    warmup.reset()
+    upstream.reset()
+
+
+def after_fork():
+    """
+    Recreates the per-process resources in a newly forked worker.
+    """
+    app_logger.reset()
+    upstream.reset()
+    dns_cache.reset()
+    warmup.reset()
+    response_cache.clear()
+    asset_index.reset()
+    thumbnails.clear()
+    deadlines.reset()
+    unchanged_writes.reset()
+
+    store = session_store.get_store()
+    if store is not None:
+        store.reopen()
+
+    cache = persistent_cache.get_cache()
+    if cache is not None:
+        cache.reopen()
+
+    spool = laasie_spool.get_spool()
+    if spool is not None:
+        spool.reopen()
@@ -0,0 +1,217 @@
+"""
+In-process metrics for the API, exposed in the Prometheus text format
+at `/metrics` to the scrapers that send the `METRICS_TOKEN` as a bearer
+token.
+
+Metrics are kept per worker process. Each metric is identified by its
+name and an optional set of labels passed as keyword arguments, e.g.
+`counter("laasie_spool_deliveries_total").inc(outcome="delivered")`.
+"""
+from bisect import bisect_left
+import hmac
+import threading
+from typing import Iterable, Optional, Union
+
+from flask import Blueprint, request
+from flask.wrappers import Response
+
+from . import env_config
+
+bp = Blueprint("metrics", __name__)
+
+# Latency buckets, in seconds, used by histograms unless others are provided.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+_lock = threading.Lock()
+_registry: dict[str, Union["Counter", "Gauge", "Histogram"]] = {}
+
+
+def _label_key(labels: dict[str, object]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = list(key)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    formatted = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + formatted + "}"
+
+
+class Counter:
+    """
+    A monotonically increasing value.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values: dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        """
+        Increments the counter for the given labels.
+        """
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: object) -> float:
+        """
+        Returns the current value for the given labels.
+        """
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        # pylint: disable=missing-function-docstring
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    """
+    A value that can go up and down.
+    """
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        """
+        Sets the gauge for the given labels.
+        """
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels: object) -> None:
+        """
+        Decrements the gauge for the given labels.
+        """
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """
+    Counts observations, such as latencies, into cumulative buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # Per label set: the per-bucket counts (the last one is +Inf),
+        # the sum and the count of all observations.
+        self._values: dict[LabelKey, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        """
+        Records an observation for the given labels.
+        """
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self.buckets) + 1), [0.0, 0.0])
+            counts, totals = self._values[key]
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def count(self, **labels: object) -> int:
+        """
+        Returns the number of observations for the given labels.
+        """
+        with self._lock:
+            values = self._values.get(_label_key(labels))
+            return 0 if values is None else int(values[1][1])
+
+    def samples(self) -> Iterable[str]:
+        # pylint: disable=missing-function-docstring
+        with self._lock:
+            values = [(key, list(c), list(t)) for key, (c, t) in self._values.items()]
+        for key, counts, totals in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                yield f"{self.name}_bucket{_format_labels(key, ('le', le))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {totals[0]}"
+            yield f"{self.name}_count{_format_labels(key)} {int(totals[1])}"
+
+
+def _get_or_create(name: str, factory):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = factory()
+            _registry[name] = metric
+        return metric
+
+
+def counter(name: str, description: str = "") -> Counter:
+    """
+    Returns the counter registered with the given name, creating it if needed.
+    """
+    return _get_or_create(name, lambda: Counter(name, description))
+
+
+def gauge(name: str, description: str = "") -> Gauge:
+    """
+    Returns the gauge registered with the given name, creating it if needed.
+    """
+    return _get_or_create(name, lambda: Gauge(name, description))
+
+
+def histogram(
+    name: str, description: str = "", buckets: tuple[float, ...] = DEFAULT_BUCKETS
+) -> Histogram:
+    """
+    Returns the histogram registered with the given name, creating it if needed.
+    """
+    return _get_or_create(name, lambda: Histogram(name, description, buckets))
+
+
+def render() -> str:
+    """
+    Returns all registered metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        if metric.description:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+@bp.route("/metrics")
+def export_metrics():
+    """
+    Returns the metrics of this worker process, which name the tenants
+    and their volumes, to the bearer of the `METRICS_TOKEN`. The route is
+    not found if no token is set.
+    """
+    if not env_config.METRICS_TOKEN:
+        return Response(status=404)
+    authorization = request.headers.get("Authorization", "")
+    expected = f"Bearer {env_config.METRICS_TOKEN}"
+    if not hmac.compare_digest(authorization.encode(), expected.encode()):
+        return Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,249 @@
+"""
+An optional disk-backed tier under the response and thumbnail caches.
+
+The in-memory caches are empty after every restart and deploy, so the
+first requests of each user pay for the SFMC calls again. When enabled,
+the entries put in those caches are also written, with their expiry, to
+a SQLite database (in WAL mode) under the app's instance folder, which
+is shared by all worker processes and survives restarts. Nothing is
+loaded at startup: a miss in memory looks the entry up on disk and, if
+it hasn't expired, promotes it back into memory.
+
+The database is kept under `PERSISTENT_CACHE_MAX_BYTES` of content by
+removing the expired entries, then those closest to expiring. Errors of
+the database are logged and treated as misses.
+"""
+from dataclasses import dataclass
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from api import metrics
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("persistent-cache")
+
+CACHE_FILE_NAME = "cache.sqlite3"
+# How many bytes of content, at most, are written between evictions.
+EVICTION_CHECK_BYTES = 4 * 1024 * 1024
+
+lookups = metrics.counter(
+    "persistent_cache_lookups_total", "Lookups in the disk-backed cache."
+)
+size_bytes = metrics.gauge(
+    "persistent_cache_bytes", "Bytes of content in the disk-backed cache."
+)
+
+
+@dataclass
+class Entry:
+    """
+    An entry read from the disk-backed cache.
+    """
+
+    meta: dict[str, Any]
+    content: bytes
+    # Seconds until the entry expires.
+    ttl: float
+
+
+class PersistentCache:
+    """
+    Stores content, keyed by namespace and key, with an expiry.
+    """
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._written = 0
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                url TEXT NOT NULL,
+                meta TEXT NOT NULL,
+                content BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_url ON entries (namespace, scope, url)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[Entry]:
+        """
+        Returns the entry for the key, or None if it doesn't exist or
+        has expired.
+        """
+        try:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT meta, content, expires_at FROM entries"
+                    " WHERE namespace = ? AND key = ? AND expires_at > ?",
+                    (namespace, key, time.time()),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as ex:
+            logger.error("Could not read the %s cache: %s", namespace, ex)
+            row = None
+        lookups.inc(namespace=namespace, result="miss" if row is None else "hit")
+        if row is None:
+            return None
+        meta, content, expires_at = row
+        return Entry(json.loads(meta), content, expires_at - time.time())
+
+    def put(
+        self,
+        namespace: str,
+        key: str,
+        scope: str,
+        url: str,
+        meta: dict[str, Any],
+        content: bytes,
+        ttl: float,
+    ):
+        """
+        Stores an entry that expires in `ttl` seconds.
+        """
+        if ttl <= 0 or len(content) > self.max_bytes:
+            return
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO entries"
+                " (namespace, key, scope, url, meta, content, size, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    namespace,
+                    key,
+                    scope,
+                    url,
+                    json.dumps(meta),
+                    content,
+                    len(content),
+                    time.time() + ttl,
+                ),
+            )
+        except sqlite3.Error as ex:
+            logger.error("Could not write to the %s cache: %s", namespace, ex)
+            return
+        with self._lock:
+            self._written += len(content)
+            due = self._written >= EVICTION_CHECK_BYTES
+            if due:
+                self._written = 0
+        if due:
+            self.evict()
+
+    def invalidate(self, namespace: str, scope: str, url_prefix: str):
+        """
+        Removes the entries of the scope whose URL starts with the prefix.
+        """
+        try:
+            self._connection().execute(
+                "DELETE FROM entries WHERE namespace = ? AND scope = ?"
+                " AND substr(url, 1, ?) = ?",
+                (namespace, scope, len(url_prefix), url_prefix),
+            )
+        except sqlite3.Error as ex:
+            logger.error("Could not invalidate the %s cache: %s", namespace, ex)
+
+    def size(self) -> int:
+        """
+        Returns the bytes of content stored.
+        """
+        row = (
+            self._connection()
+            .execute("SELECT COALESCE(SUM(size), 0) FROM entries")
+            .fetchone()
+        )
+        return row[0]
+
+    def evict(self):
+        """
+        Removes the expired entries, then those closest to expiring
+        until the cache is within its size.
+        """
+        try:
+            conn = self._connection()
+            conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+            excess = self.size() - self.max_bytes
+            evicted = []
+            if excess > 0:
+                for rowid, size in conn.execute(
+                    "SELECT rowid, size FROM entries ORDER BY expires_at"
+                ):
+                    if excess <= 0:
+                        break
+                    evicted.append((rowid,))
+                    excess -= size
+                conn.executemany("DELETE FROM entries WHERE rowid = ?", evicted)
+            size_bytes.set(self.size())
+        except sqlite3.Error as ex:
+            logger.error("Could not evict entries from the cache: %s", ex)
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        self._connection().execute("DELETE FROM entries")
+        size_bytes.set(0)
+
+    def reopen(self):
+        """
+        Discards the database connections inherited from a parent process.
+        """
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+
+_cache: Optional[PersistentCache] = None
+
+
+def init_cache(instance_path: str) -> PersistentCache:
+    """
+    Creates the disk-backed cache in the instance folder and evicts its
+    expired entries in the background, so that startup isn't delayed.
+    """
+    global _cache  # pylint: disable=global-statement
+    _cache = PersistentCache(
+        os.path.join(instance_path, CACHE_FILE_NAME),
+        env_config.PERSISTENT_CACHE_MAX_BYTES,
+    )
+    threading.Thread(
+        target=_cache.evict, name="persistent-cache-evict", daemon=True
+    ).start()
+    return _cache
+
+
+def get_cache() -> Optional[PersistentCache]:
+    """
+    Returns the disk-backed cache, or None if it isn't enabled.
+    """
+    return _cache
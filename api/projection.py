@@ -0,0 +1,255 @@
+"""
+Server-side projection of the items of SFMC asset listings.
+
+SFMC returns every field of each asset, including its full content,
+while the UI only needs a few of them. With a `fields` query parameter
+such as `fields=id,name,customerKey,category.name,thumbnail`, the
+proxy only returns those fields of each item. The other members of
+the listing, such as `count`, `page` and `pageSize`, are returned
+unchanged, so pagination works as before.
+
+The listing is transformed as it streams from the upstream: one item is
+decoded at a time, projected and sent on, so memory use doesn't grow
+with the size of the listing.
+"""
+import codecs
+import json
+import re
+from typing import Any, Iterator, Optional
+
+from api import json_codec
+
+FIELDS_PARAM = "fields"
+ITEMS_KEY = "items"
+# The largest number of fields a projection may name.
+MAX_FIELDS = 64
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# The characters that may start a number, and those that may continue
+# one, in the JSON text.
+NUMBER_START = "-0123456789"
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+# The characters that may end a string, and those that open or close a
+# string, object or array, in the JSON text.
+STRING_SPECIAL = re.compile(r'["\\]')
+STRUCTURAL = re.compile(r'["{}\[\]]')
+
+# A projection maps each field name to the projection of its value, or
+# to None to keep the whole value.
+Projection = dict[str, Optional["Projection"]]
+
+
+def parse_fields(value: Optional[str]) -> Optional[Projection]:
+    """
+    Returns the projection for a comma-separated list of dotted field
+    paths, or None if no field is given.
+    """
+    if not value:
+        return None
+    paths = [path.strip() for path in value.split(",") if path.strip()]
+    if not paths or len(paths) > MAX_FIELDS:
+        return None
+
+    projection: Projection = {}
+    for path in paths:
+        node = projection
+        *parents, leaf = path.split(".")
+        for name in parents:
+            child = node.setdefault(name, {})
+            if child is None:
+                # The whole value is already kept.
+                break
+            node = child
+        else:
+            node[leaf] = None
+    return projection
+
+
+def project(value: Any, projection: Projection) -> Any:
+    """
+    Returns the fields of the value that are in the projection.
+    """
+    if isinstance(value, list):
+        return [project(item, projection) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {
+        name: value[name] if child is None else project(value[name], child)
+        for name, child in projection.items()
+        if name in value
+    }
+
+
+def covers(available: Projection, requested: Projection) -> bool:
+    """
+    Returns whether all the fields of the requested projection are in
+    the available one.
+    """
+    for name, child in requested.items():
+        if name not in available:
+            return False
+        if available[name] is None:
+            continue
+        if child is None or not covers(available[name], child):
+            return False
+    return True
+
+
+class StreamReader:
+    """
+    Decodes JSON values one at a time from a stream of chunks.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self._chunks = chunks
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        # Drop the consumed text before reading more.
+        self._buffer = self._buffer[self._pos :]
+        self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += self._text_decoder.decode(chunk)
+                return True
+        self._buffer += self._text_decoder.decode(b"", final=True)
+        self._eof = True
+        return False
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character, or "" at the end.
+        """
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos : self._pos + 1]
+
+    def expect(self, char: str):
+        """
+        Consumes the next character, which must be `char`.
+        """
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} at offset {self._pos}")
+        self._pos += 1
+
+    def _read_whole(self):
+        """
+        Reads chunks until the string, object or array at the current
+        position is whole in the buffer, or the stream ends. Its text is
+        scanned once, however many chunks it spans.
+        """
+        depth = 0
+        in_string = False
+        scanned = self._pos
+        while True:
+            buffer = self._buffer
+            while True:
+                if in_string:
+                    match = STRING_SPECIAL.search(buffer, scanned)
+                    if match is None:
+                        scanned = len(buffer)
+                        break
+                    if match.group() == "\\":
+                        if match.end() == len(buffer):
+                            # The escaped character is in the next chunk.
+                            scanned = match.start()
+                            break
+                        scanned = match.end() + 1
+                        continue
+                    in_string = False
+                    scanned = match.end()
+                    if depth == 0:
+                        return
+                    continue
+                match = STRUCTURAL.search(buffer, scanned)
+                if match is None:
+                    scanned = len(buffer)
+                    break
+                scanned = match.end()
+                char = match.group()
+                if char == '"':
+                    in_string = True
+                elif char in "{[":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return
+            offset = scanned - self._pos
+            if not self._fill():
+                return
+            scanned = self._pos + offset
+
+    def read_value(self) -> tuple[Any, str]:
+        """
+        Decodes the next value and returns it with its JSON text.
+        """
+        if self.peek() in ('"', "{", "["):
+            self._read_whole()
+            value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+            text = self._buffer[self._pos : end]
+            self._pos = end
+            return value, text
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next
+            # chunk, even after a partial fraction or exponent such as
+            # "1." that was left out of the decoded value.
+            if (
+                not self._eof
+                and self._buffer[self._pos] in NUMBER_START
+                and NUMBER_TAIL.fullmatch(self._buffer, end)
+            ):
+                self._fill()
+                continue
+            text = self._buffer[self._pos : end]
+            self._pos = end
+            return value, text
+
+
+def project_listing(chunks: Iterator[bytes], projection: Projection) -> Iterator[bytes]:
+    """
+    Yields the JSON listing read from the chunks with each of its items
+    projected.
+    """
+    reader = StreamReader(chunks)
+    reader.expect("{")
+    yield b"{"
+    first_member = True
+    while reader.peek() != "}":
+        if not first_member:
+            reader.expect(",")
+            yield b","
+        first_member = False
+
+        key, key_text = reader.read_value()
+        reader.expect(":")
+        yield f"{key_text}:".encode()
+        if key != ITEMS_KEY or reader.peek() != "[":
+            yield reader.read_value()[1].encode()
+            continue
+
+        reader.expect("[")
+        yield b"["
+        first_item = True
+        while reader.peek() != "]":
+            if not first_item:
+                reader.expect(",")
+                yield b","
+            first_item = False
+            item, _ = reader.read_value()
+            yield json_codec.dumps(project(item, projection))
+        reader.expect("]")
+        yield b"]"
+    reader.expect("}")
+    yield b"}"
@@ -0,0 +1,607 @@
+"""
+The generic forwarding engine of the SFMC API proxy.
+
+Each proxied endpoint is declared as a `ProxyRoute` with its upstream
+path and its policies (timeout, retries, caching, collapsing,
+invalidation, body handling). `forward` executes a request for any
+route, so tuning an endpoint is a matter of changing its declaration.
+Every route reports its request count and latency to the metrics under
+its name.
+"""
+from dataclasses import dataclass, field
+import re
+import time
+from typing import IO, Callable, Iterator, Optional, Union
+from urllib.parse import quote, urlencode
+
+from flask import abort, g, jsonify, request as flask_request, make_response
+from flask.wrappers import Response as FlaskResponse
+import requests
+
+from api import (
+    deadlines,
+    metrics,
+    projection,
+    request_collapsing,
+    response_cache,
+    tracing,
+    traffic_capture,
+    upstream,
+)
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("proxy-engine")
+
+PATH_VARIABLE = re.compile(r"<(?:\w+:)?(\w+)>")
+RESPONSE_CHUNK_SIZE = 64 * 1024
+# Upstream statuses that are worth retrying for idempotent requests.
+RETRY_STATUS_CODES = (502, 503, 504)
+
+UPSTREAM_HOSTS: dict[str, Callable[[str, str], str]] = {
+    "rest": upstream.sfmc_rest_url,
+    "auth": upstream.sfmc_auth_url,
+}
+
+requests_total = metrics.counter(
+    "proxy_requests_total", "Proxied requests by route and status code."
+)
+request_duration = metrics.histogram(
+    "proxy_request_duration_seconds", "Time taken to proxy a request, by route."
+)
+retries_total = metrics.counter(
+    "proxy_upstream_retries_total", "Retried upstream requests by route."
+)
+
+
+@dataclass(frozen=True)
+class ProxyRoute:
+    """
+    A proxied SFMC endpoint and the policies used to forward it.
+
+    `path` is the Flask rule under the blueprint's prefix and
+    `upstream_path` the path on the upstream host, which defaults to
+    `path`. Both may use the same `<variables>`.
+    """
+
+    name: str
+    method: str
+    path: str
+    upstream_path: str = ""
+    # The upstream host: "rest" or "auth".
+    upstream: str = "rest"
+    # Seconds to wait for the upstream, at most. Defaults to
+    # UPSTREAM_TIMEOUT. See `deadlines` for how it is shortened.
+    timeout: Optional[float] = None
+    # Whether the request is idempotent and may be retried, up to
+    # UPSTREAM_RETRIES times, when the upstream fails.
+    retry: bool = False
+    # Seconds to cache successful responses for, per access token.
+    cache_ttl: float = 0
+    # Upstream path prefixes whose cached responses a successful
+    # request invalidates.
+    invalidates: tuple[str, ...] = ()
+    # Whether the request and response bodies are relayed as streams
+    # instead of being read into memory.
+    streaming: bool = True
+    # The largest accepted request body. Defaults to MAX_PROXY_BODY_SIZE.
+    max_body_size: Optional[int] = None
+    # Whether identical concurrent requests (same URL, query and access
+    # token) share a single upstream request. Collapsed responses are
+    # read into memory instead of being streamed.
+    collapse: bool = False
+    # Whether the response is an asset listing whose items can be
+    # trimmed with the `fields` query parameter (see `projection`.)
+    projectable: bool = False
+    # Returns the response to a request without calling the upstream,
+    # e.g. from the asset index, or None to forward it.
+    answer: Optional[Callable[["ProxyRequest"], Optional["UpstreamResponse"]]] = None
+    # Called with each upstream response, e.g. to update the asset index.
+    # The responses of the route are read into memory instead of being
+    # streamed.
+    on_response: Optional[Callable[["ProxyRequest", "UpstreamResponse"], None]] = None
+
+    def get_upstream_path(self, path_args: dict[str, str]) -> str:
+        """
+        Returns the upstream path with the path variables filled in.
+        """
+        template = self.upstream_path or self.path
+        return PATH_VARIABLE.sub(
+            lambda m: quote(str(path_args[m.group(1)]), safe=""), template
+        )
+
+    def get_upstream_url(self, tenant_subdomain: str, upstream_path: str) -> str:
+        """
+        Returns the URL of an upstream path on the route's upstream host.
+        """
+        return UPSTREAM_HOSTS[self.upstream](tenant_subdomain, upstream_path)
+
+
+class RequestBodyStream:
+    """
+    A file-like wrapper around the incoming request body that reports
+    its length. `requests` treats it as a file, so it sends the body
+    with a Content-Length header and reads it in blocks while writing
+    to the upstream connection instead of buffering it in memory.
+    """
+
+    def __init__(self, stream: IO[bytes], length: int) -> None:
+        self._stream = stream
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        # pylint: disable=missing-function-docstring
+        return self._stream.read(size)
+
+
+RequestBody = Union[None, bytes, RequestBodyStream]
+
+
+@dataclass
+class UpstreamResponse:
+    """
+    The status, content type and body of an upstream response.
+    """
+
+    status_code: int
+    content_type: str
+    content: Union[bytes, Iterator[bytes]]
+    # Headers to send to the client, e.g. for responses answered locally.
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class ProxyRequest:
+    """
+    A request to forward to the upstream of a route.
+    """
+
+    route: ProxyRoute
+    tenant_subdomain: str
+    access_token: str
+    path_args: dict[str, str] = field(default_factory=dict)
+    params: dict[str, str] = field(default_factory=dict)
+    body: RequestBody = None
+    content_type: str = "application/json"
+    # The fields of the listing's items to return, or None for all.
+    fields: Optional[projection.Projection] = None
+    # Seconds spent waiting for the upstream, over all the attempts.
+    upstream_seconds: float = 0.0
+    # When, on the monotonic clock, the client gives up on the request.
+    deadline: Optional[float] = None
+    # The trace of the client's request, carried on by the requests sent
+    # outside of its context, such as the sub-requests of a batch.
+    trace: Optional[tracing.Trace] = None
+    # Whether the client asked for the write to be sent even if it
+    # wouldn't change anything (see `unchanged_writes`.)
+    force_write: bool = False
+
+
+def get_request_content_length(max_body_size: Optional[int] = None) -> int:
+    """
+    Returns the length of the body of the incoming request.
+    Aborts the request with a 411 if the length of the body is unknown
+    and with a 413 if it is larger than the maximum body size.
+    """
+    if max_body_size is None:
+        max_body_size = env_config.MAX_PROXY_BODY_SIZE
+
+    content_length = flask_request.content_length
+    if content_length is None:
+        if flask_request.headers.get("Transfer-Encoding") is None:
+            return 0
+        logger.error("Refusing to proxy a request body without a Content-Length.")
+        abort(411)
+
+    if content_length > max_body_size:
+        logger.error(
+            "Request body of %d bytes exceeds the limit of %d bytes.",
+            content_length,
+            max_body_size,
+        )
+        abort(413)
+
+    return content_length
+
+
+def get_request_body(
+    max_body_size: Optional[int] = None,
+) -> Optional[RequestBodyStream]:
+    """
+    Returns the body of the incoming request as a stream that can be
+    forwarded upstream, or None if the request has no body.
+    """
+    content_length = get_request_content_length(max_body_size)
+    if content_length == 0:
+        return None
+
+    return RequestBodyStream(flask_request.stream, content_length)
+
+
+def get_buffered_request_body(max_body_size: Optional[int] = None) -> Optional[bytes]:
+    """
+    Returns the body of the incoming request read into memory, or None
+    if the request has no body.
+    """
+    if get_request_content_length(max_body_size) == 0:
+        return None
+
+    return flask_request.get_data()
+
+
+def from_flask_request(route: ProxyRoute, path_args: dict[str, str]) -> ProxyRequest:
+    """
+    Returns the proxy request for the incoming Flask request, which must
+    have been authenticated by the blueprint's `before_request`.
+    """
+    body: RequestBody = None
+    if route.method in ("POST", "PUT", "PATCH"):
+        if route.streaming:
+            body = get_request_body(route.max_body_size)
+        else:
+            body = get_buffered_request_body(route.max_body_size)
+
+    params = flask_request.args.to_dict()
+    fields = None
+    if route.projectable:
+        fields = projection.parse_fields(params.pop(projection.FIELDS_PARAM, None))
+
+    return ProxyRequest(
+        route=route,
+        tenant_subdomain=g.tenant_subdomain,
+        access_token=g.decoded_token,
+        path_args=path_args,
+        params=params,
+        body=body,
+        content_type=flask_request.headers.get("Content-Type", "application/json"),
+        fields=fields,
+        deadline=deadlines.current(),
+        trace=tracing.current(),
+    )
+
+
+def get_content_type(http_resp: requests.Response) -> str:
+    """
+    Returns the content-type header value from the response, if set,
+    otherwise, returns `application/json`.
+    """
+    return http_resp.headers.get("Content-Type", "application/json")
+
+
+def make_proxy_response(
+    status_code: int,
+    content_type: str,
+    content: Union[bytes, Iterator[bytes]],
+    headers: Optional[dict[str, str]] = None,
+) -> FlaskResponse:
+    """
+    Returns the response to send to the client for an upstream response.
+    """
+    resp = make_response(content)
+    resp.headers.update(headers or {})
+    resp.headers["Content-Type"] = content_type
+    resp.status_code = status_code
+    return resp
+
+
+def error_response(status_code: int, error: str, description: str) -> FlaskResponse:
+    """
+    Returns a JSON error response for a failed upstream request.
+    """
+    resp = jsonify(error=error, error_description=description)
+    resp.status_code = status_code
+    return resp
+
+
+def relay(
+    http_resp: requests.Response, trace: Optional[tracing.Trace] = None
+) -> Iterator[bytes]:
+    """
+    Yields the body of a streamed upstream response in chunks and
+    releases its connection when done. The body is sent after the
+    request's context is gone, so the transfer is recorded in the trace
+    given by the caller.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield from http_resp.iter_content(RESPONSE_CHUNK_SIZE)
+    finally:
+        http_resp.close()
+        if trace is not None:
+            trace.record("transfer", time.perf_counter() - started_at)
+
+
+def send_upstream(
+    proxy_request: ProxyRequest, url: str, stream: bool
+) -> requests.Response:
+    """
+    Sends the request upstream, retrying once if the route allows it
+    and the body can be sent again.
+    """
+    route = proxy_request.route
+    headers = {"Authorization": f"Bearer {proxy_request.access_token}"}
+    if proxy_request.body is not None:
+        headers["Content-Type"] = proxy_request.content_type
+    if proxy_request.trace is not None:
+        headers["traceparent"] = proxy_request.trace.get_traceparent()
+
+    can_retry = route.retry and not isinstance(proxy_request.body, RequestBodyStream)
+    attempts = 1 + (env_config.UPSTREAM_RETRIES if can_retry else 0)
+    timeout = route.timeout or env_config.UPSTREAM_TIMEOUT
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        started_at = time.monotonic()
+        try:
+            http_resp = deadlines.send(
+                route.method,
+                url,
+                route.name,
+                timeout,
+                proxy_request.deadline,
+                params=proxy_request.params,
+                data=proxy_request.body,
+                headers=headers,
+                stream=stream,
+            )
+        except requests.RequestException as ex:
+            proxy_request.upstream_seconds += time.monotonic() - started_at
+            if last_attempt or isinstance(ex, deadlines.DeadlineExceeded):
+                raise
+        else:
+            proxy_request.upstream_seconds += time.monotonic() - started_at
+            if last_attempt or http_resp.status_code not in RETRY_STATUS_CODES:
+                return http_resp
+            http_resp.close()
+
+        retries_total.inc(route=route.name)
+        logger.info("retrying request to %s", url)
+        time.sleep(env_config.UPSTREAM_RETRY_BACKOFF)
+
+    raise AssertionError("unreachable")
+
+
+def forward(proxy_request: ProxyRequest) -> FlaskResponse:
+    """
+    Forwards the request to the route's upstream according to the
+    route's policies and returns the response for the client.
+    """
+    started_at = time.monotonic()
+    resp = _forward(proxy_request)
+    observe(proxy_request.route, resp.status_code, started_at)
+    if traffic_capture.get_capture() is not None:
+        traffic_capture.capture(describe(proxy_request), resp, started_at)
+    return resp
+
+
+def capture_read(
+    proxy_request: ProxyRequest,
+    status_code: int,
+    content: Union[bytes, Iterator[bytes]],
+    started_at: float,
+):
+    """
+    Captures a request that was executed for a batch or a bulk transfer,
+    once its response has been read, as a call of its route.
+    """
+    if traffic_capture.get_capture() is not None:
+        traffic_capture.capture_read(
+            describe(proxy_request),
+            status_code,
+            len(content) if isinstance(content, bytes) else 0,
+            started_at,
+        )
+
+
+def describe(proxy_request: ProxyRequest) -> traffic_capture.Call:
+    """
+    Returns the description of a forwarded request for the capture.
+    """
+    url = get_upstream_url(proxy_request)
+    if proxy_request.params:
+        url += "?" + urlencode(sorted(proxy_request.params.items()))
+    body = proxy_request.body
+    return traffic_capture.Call(
+        route=proxy_request.route.name,
+        tenant_subdomain=proxy_request.tenant_subdomain,
+        url=url,
+        request_bytes=0 if body is None else len(body),
+        upstream_seconds=proxy_request.upstream_seconds,
+        projected=proxy_request.fields is not None,
+    )
+
+
+def observe(route: ProxyRoute, status_code: int, started_at: float):
+    """
+    Reports a request of the route to the metrics.
+    """
+    request_duration.observe(time.monotonic() - started_at, route=route.name)
+    requests_total.inc(route=route.name, status=status_code)
+
+
+def get_upstream_url(proxy_request: ProxyRequest) -> str:
+    """
+    Returns the upstream URL of the request.
+    """
+    route = proxy_request.route
+    return route.get_upstream_url(
+        proxy_request.tenant_subdomain,
+        route.get_upstream_path(proxy_request.path_args),
+    )
+
+
+def get_upstream_error_response(
+    url: str, ex: requests.RequestException
+) -> FlaskResponse:
+    """
+    Returns the response for an upstream request that failed.
+    """
+    if isinstance(ex, requests.Timeout):
+        logger.error("Request to %s timed out.", url)
+        return error_response(504, "upstream_timeout", "SFMC did not respond in time.")
+    logger.error("Request to %s failed: %s", url, ex)
+    return error_response(502, "upstream_error", "Could not reach SFMC.")
+
+
+def _forward(proxy_request: ProxyRequest) -> FlaskResponse:
+    try:
+        upstream_resp = execute(proxy_request)
+    except requests.RequestException as ex:
+        return get_upstream_error_response(get_upstream_url(proxy_request), ex)
+    return respond(proxy_request, upstream_resp)
+
+
+def execute(proxy_request: ProxyRequest, stream: bool = True) -> UpstreamResponse:
+    """
+    Runs the request through the policies of its route and returns the
+    upstream response, or the one answered locally or from the cache.
+    The body is relayed as a stream if the route allows it and `stream`
+    is True, and read into memory otherwise. Raises
+    `requests.RequestException` if the upstream can't be reached.
+    """
+    route = proxy_request.route
+    url = get_upstream_url(proxy_request)
+
+    if route.answer is not None:
+        answered = route.answer(proxy_request)
+        if answered is not None:
+            logger.info("answering request for %s locally", url)
+            return answered
+
+    cache_key = None
+    if route.cache_ttl > 0 and not isinstance(proxy_request.body, RequestBodyStream):
+        cache_key = response_cache.make_key(
+            proxy_request.access_token, url, proxy_request.params, proxy_request.body
+        )
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("serving cached response for %s", url)
+            return UpstreamResponse(
+                cached.status_code, cached.content_type, cached.content
+            )
+
+    logger.info("proxying request to %s", url)
+    if (
+        stream
+        and route.streaming
+        and cache_key is None
+        and not route.collapse
+        and route.on_response is None
+    ):
+        http_resp = send_upstream(proxy_request, url, stream=True)
+        upstream_resp = UpstreamResponse(
+            http_resp.status_code,
+            get_content_type(http_resp),
+            relay(http_resp, tracing.current()),
+        )
+    else:
+        upstream_resp = read(proxy_request, url, cache_key)
+
+    if upstream_resp.status_code < 400:
+        for prefix in route.invalidates:
+            response_cache.invalidate(
+                proxy_request.access_token,
+                route.get_upstream_url(proxy_request.tenant_subdomain, prefix),
+            )
+    if route.on_response is not None:
+        route.on_response(proxy_request, upstream_resp)
+    return upstream_resp
+
+
+def read(
+    proxy_request: ProxyRequest, url: str, cache_key: Optional[tuple] = None
+) -> UpstreamResponse:
+    """
+    Returns the upstream response read into memory, shared with the
+    identical concurrent requests if the route collapses them. Caches a
+    successful response under `cache_key`, if given.
+    """
+    route = proxy_request.route
+    if not route.collapse or proxy_request.body is not None:
+        return fetch(proxy_request, url, cache_key)
+    return request_collapsing.collapse(
+        response_cache.make_key(proxy_request.access_token, url, proxy_request.params),
+        lambda: fetch(proxy_request, url, cache_key),
+        lambda shared: shared.status_code < 500,
+        timeout=deadlines.remaining(
+            proxy_request.deadline,
+            (route.timeout or env_config.UPSTREAM_TIMEOUT)
+            * (1 + env_config.UPSTREAM_RETRIES),
+        ),
+        name=route.name,
+    )
+
+
+def respond(
+    proxy_request: ProxyRequest, upstream_resp: UpstreamResponse
+) -> FlaskResponse:
+    """
+    Returns the response for the client, with the items of a listing
+    projected if the request asks for it.
+    """
+    content = upstream_resp.content
+    if (
+        proxy_request.fields is not None
+        and upstream_resp.status_code == 200
+        and upstream_resp.content_type.startswith("application/json")
+    ):
+        if isinstance(content, bytes):
+            content = project_content(content, proxy_request.fields)
+        else:
+            content = projection.project_listing(content, proxy_request.fields)
+    return make_proxy_response(
+        upstream_resp.status_code,
+        upstream_resp.content_type,
+        content,
+        upstream_resp.headers,
+    )
+
+
+def project_content(content: bytes, fields: projection.Projection) -> bytes:
+    """
+    Returns the listing with its items projected, or unchanged if it
+    can't be projected. A body in memory is projected before the
+    response starts, so that an invalid listing isn't cut short after
+    its 200.
+    """
+    try:
+        return b"".join(projection.project_listing(iter([content]), fields))
+    except ValueError as ex:
+        logger.error("Could not project the listing, returning all fields: %s", ex)
+        return content
+
+
+def fetch(
+    proxy_request: ProxyRequest, url: str, cache_key: Optional[tuple] = None
+) -> UpstreamResponse:
+    """
+    Sends the request upstream and reads the response into memory.
+    Caches a successful response under `cache_key`, if given.
+    """
+    http_resp = send_upstream(proxy_request, url, stream=False)
+    upstream_resp = UpstreamResponse(
+        http_resp.status_code, get_content_type(http_resp), http_resp.content
+    )
+    if cache_key is not None and http_resp.status_code == 200:
+        response_cache.put(
+            cache_key,
+            upstream_resp.status_code,
+            upstream_resp.content_type,
+            upstream_resp.content,
+            ttl=proxy_request.route.cache_ttl,
+        )
+    return upstream_resp
+
+
+def make_view(route: ProxyRoute) -> Callable[..., FlaskResponse]:
+    """
+    Returns a Flask view function that forwards requests for the route.
+    """
+
+    def view(**path_args: str) -> FlaskResponse:
+        return forward(from_flask_request(route, path_args))
+
+    view.__name__ = route.name
+    return view
@@ -0,0 +1,88 @@
+"""
+Collapses identical concurrent upstream requests into one.
+
+The first request for a key becomes the leader and calls the upstream.
+Requests for the same key that arrive while the leader is in flight
+wait for it and share its response instead of calling the upstream
+themselves. Nothing is kept once the leader is done, so this is not a
+cache. If the leader fails, or its response may not be shared, the
+first waiting request to notice becomes the new leader and the others
+wait for it, so that a failure doesn't send them all upstream at once.
+A request that waited too long calls the upstream on its own.
+"""
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+from api import metrics
+
+T = TypeVar("T")
+
+collapsed_total = metrics.counter(
+    "collapsed_requests_total",
+    "Collapsible requests by role: leader, follower or fallback.",
+)
+
+
+@dataclass
+class Flight(Generic[T]):
+    """
+    An upstream request in flight and its shareable result, once done.
+    """
+
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Optional[T] = None
+
+
+_lock = threading.Lock()
+_flights: dict[Hashable, Flight] = {}
+
+
+def collapse(
+    key: Hashable,
+    fetch: Callable[[], T],
+    shareable: Callable[[T], bool],
+    timeout: float,
+    name: str = "",
+) -> T:
+    """
+    Returns the result of `fetch`, sharing it with the concurrent calls
+    for the same key. Followers wait up to `timeout` seconds in all for a
+    leader's result before calling `fetch` themselves. If a leader fails
+    or its result may not be shared, one of its followers becomes the
+    leader and the others wait for it instead.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        with _lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                _flights[key] = flight
+
+        if leader:
+            collapsed_total.inc(route=name, role="leader")
+            result = None
+            try:
+                result = fetch()
+                return result
+            finally:
+                with _lock:
+                    del _flights[key]
+                if result is not None and shareable(result):
+                    flight.result = result
+                flight.done.set()
+
+        remaining = deadline - time.monotonic()
+        if not flight.done.wait(max(0.0, remaining)):
+            break
+        if flight.result is not None:
+            collapsed_total.inc(route=name, role="follower")
+            return flight.result
+        if remaining <= 0:
+            break
+
+    collapsed_total.inc(route=name, role="fallback")
+    return fetch()
@@ -0,0 +1,175 @@
+"""
+A short-lived, in-memory cache of upstream responses.
+
+Entries are scoped to the access token that fetched them, so a cached
+response is only ever returned to the user it was fetched for. When the
+disk-backed cache is enabled, entries are also kept there so that they
+survive restarts.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import json
+import threading
+import time
+from typing import Optional
+
+from api import json_codec, metrics, persistent_cache
+from . import env_config
+
+CacheKey = tuple[str, str, str, str]
+
+# The namespace of the entries in the disk-backed cache.
+PERSISTENT_NAMESPACE = "response"
+
+lookups = metrics.counter(
+    "response_cache_lookups_total", "Lookups in the upstream response cache."
+)
+
+
+@dataclass
+class CachedResponse:
+    """
+    An upstream response that can be replayed to the client.
+    """
+
+    status_code: int
+    content_type: str
+    content: bytes
+    expires_at: float
+
+
+_lock = threading.Lock()
+_entries: "OrderedDict[CacheKey, CachedResponse]" = OrderedDict()
+
+
+def token_scope(access_token: str) -> str:
+    """
+    Returns a digest of the access token used to scope cache entries.
+    """
+    return hashlib.sha256(access_token.encode()).hexdigest()[:32]
+
+
+def canonical_body(body: Optional[bytes]) -> str:
+    """
+    Returns a canonical form of a JSON request body so that equivalent
+    bodies map to the same cache entry.
+    """
+    if not body:
+        return ""
+    try:
+        return json_codec.dumps_canonical(json_codec.loads(body)).decode()
+    except ValueError:
+        return hashlib.sha256(body).hexdigest()
+
+
+def make_key(
+    access_token: str,
+    url: str,
+    params: Optional[dict[str, str]] = None,
+    body: Optional[bytes] = None,
+) -> CacheKey:
+    """
+    Returns the cache key for a request.
+    """
+    query = "&".join(f"{k}={v}" for k, v in sorted((params or {}).items()))
+    return (token_scope(access_token), url, query, canonical_body(body))
+
+
+def get_persistent(key: CacheKey) -> Optional[CachedResponse]:
+    """
+    Returns the response for the key from the disk-backed cache, if it
+    is enabled, and promotes it into memory.
+    """
+    cache = persistent_cache.get_cache()
+    if cache is None:
+        return None
+    stored = cache.get(PERSISTENT_NAMESPACE, json.dumps(key))
+    if stored is None:
+        return None
+    entry = CachedResponse(
+        stored.meta["status_code"],
+        stored.meta["content_type"],
+        stored.content,
+        time.monotonic() + stored.ttl,
+    )
+    with _lock:
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        while len(_entries) > env_config.RESPONSE_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+    return entry
+
+
+def get(key: CacheKey) -> Optional[CachedResponse]:
+    """
+    Returns the cached response for the key if it has not expired.
+    """
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            del _entries[key]
+            entry = None
+        if entry is not None:
+            _entries.move_to_end(key)
+    if entry is None:
+        entry = get_persistent(key)
+    lookups.inc(result="miss" if entry is None else "hit")
+    return entry
+
+
+def put(
+    key: CacheKey,
+    status_code: int,
+    content_type: str,
+    content: bytes,
+    ttl: Optional[float] = None,
+):
+    """
+    Caches a response, evicting the least recently used entries if the
+    cache is full.
+    """
+    if ttl is None:
+        ttl = env_config.RESPONSE_CACHE_TTL
+    if ttl <= 0:
+        return
+    entry = CachedResponse(status_code, content_type, content, time.monotonic() + ttl)
+    with _lock:
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        while len(_entries) > env_config.RESPONSE_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+    cache = persistent_cache.get_cache()
+    if cache is not None:
+        cache.put(
+            PERSISTENT_NAMESPACE,
+            json.dumps(key),
+            key[0],
+            key[1],
+            {"status_code": status_code, "content_type": content_type},
+            content,
+            ttl,
+        )
+
+
+def invalidate(access_token: str, url_prefix: str):
+    """
+    Removes the entries of the access token whose URL starts with the prefix.
+    """
+    scope = token_scope(access_token)
+    with _lock:
+        for key in [
+            k for k in _entries if k[0] == scope and k[1].startswith(url_prefix)
+        ]:
+            del _entries[key]
+    cache = persistent_cache.get_cache()
+    if cache is not None:
+        cache.invalidate(PERSISTENT_NAMESPACE, scope, url_prefix)
+
+
+def clear():
+    """
+    Removes all entries from memory. The disk-backed cache is kept.
+    """
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,249 @@
+"""
+An optional server-side store for the SFMC and Laasie tokens.
+
+When enabled, the browser only carries a single opaque session id
+cookie instead of the signed token cookies. The tokens are kept in a
+SQLite database (in WAL mode) under the app's instance folder, which
+is shared by all worker processes. Session ids are random and
+unguessable, so they don't need to be signed and requests don't pay
+for an HMAC verification of every token cookie.
+
+Sessions expire after `SESSION_TTL` seconds without a token refresh.
+"""
+from datetime import timedelta
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from flask import g, request as flask_request
+from flask.wrappers import Response
+
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("session-store")
+
+SESSION_ID_COOKIE_NAME = "laasie_sid"
+STORE_FILE_NAME = "sessions.sqlite3"
+# How often, at most, expired sessions are purged from the store.
+EVICTION_INTERVAL_SECONDS = 60
+# How long a worker may take to refresh the tokens of a session before
+# other workers are allowed to try again.
+REFRESH_CLAIM_SECONDS = 30
+
+
+class SessionStore:
+    """
+    Stores session data, keyed by session id, with a TTL.
+    """
+
+    def __init__(self, path: str, ttl: float) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_eviction = 0.0
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                refreshing_until REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, data: dict[str, Any]) -> str:
+        """
+        Stores the data in a new session and returns its id.
+        """
+        session_id = secrets.token_urlsafe(24)
+        self._connection().execute(
+            "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(data), time.time() + self.ttl),
+        )
+        self._evict_expired()
+        return session_id
+
+    def get(self, session_id: str) -> Optional[dict[str, Any]]:
+        """
+        Returns the data of the session, or None if it doesn't exist
+        or has expired.
+        """
+        row = (
+            self._connection()
+            .execute(
+                "SELECT data FROM sessions WHERE id = ? AND expires_at > ?",
+                (session_id, time.time()),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def update(self, session_id: str, data: dict[str, Any]) -> bool:
+        """
+        Merges the data into the session and extends its lifetime.
+        Returns False if the session doesn't exist.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE id = ? AND expires_at > ?",
+                (session_id, time.time()),
+            ).fetchone()
+            if row is not None:
+                merged = {**json.loads(row[0]), **data}
+                conn.execute(
+                    "UPDATE sessions SET data = ?, expires_at = ?, refreshing_until = 0"
+                    " WHERE id = ?",
+                    (json.dumps(merged), time.time() + self.ttl, session_id),
+                )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return row is not None
+
+    def claim_refresh(self, session_id: str) -> bool:
+        """
+        Marks the session as being refreshed by the caller. Returns False
+        if another thread or worker is already refreshing it.
+        """
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE sessions SET refreshing_until = ?"
+            " WHERE id = ? AND refreshing_until <= ?",
+            (now + REFRESH_CLAIM_SECONDS, session_id, now),
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, session_id: str):
+        """
+        Deletes the session.
+        """
+        self._connection().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def reopen(self):
+        """
+        Discards the database connections inherited from a parent process.
+        """
+        self._local = threading.local()
+
+    def _evict_expired(self):
+        now = time.time()
+        if now - self._last_eviction < EVICTION_INTERVAL_SECONDS:
+            return
+        self._last_eviction = now
+        self._connection().execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+
+_store: Optional[SessionStore] = None
+
+
+def init_store(instance_path: str) -> SessionStore:
+    """
+    Opens the session store in the given instance folder.
+    """
+    global _store  # pylint: disable=global-statement
+    _store = SessionStore(
+        os.path.join(instance_path, STORE_FILE_NAME), env_config.SESSION_TTL
+    )
+    return _store
+
+
+def get_store() -> Optional[SessionStore]:
+    """
+    Returns the session store if server-side sessions are enabled.
+    """
+    return _store
+
+
+def get_current_session() -> Optional[dict[str, Any]]:
+    """
+    Returns the data of the session identified by the request's session
+    cookie, or None if there is no valid session.
+    """
+    if "session_data" in g:
+        return g.session_data
+
+    session_data = None
+    session_id = flask_request.cookies.get(SESSION_ID_COOKIE_NAME)
+    if _store is not None and session_id:
+        session_data = _store.get(session_id)
+    g.session_id = session_id if session_data is not None else None
+    g.session_data = session_data
+    return session_data
+
+
+def save_current_session(http_resp: Response, data: dict[str, Any]):
+    """
+    Merges the data into the request's session, creating a session if
+    the request doesn't have one, and sets the session cookie.
+    """
+    if _store is None:
+        raise RuntimeError("server-side sessions are not enabled")
+
+    get_current_session()
+    session_id = g.session_id
+    if session_id is None or not _store.update(session_id, data):
+        session_id = _store.create(data)
+        g.session_id = session_id
+    g.session_data = {**(g.session_data or {}), **data}
+    _set_session_cookie(http_resp, session_id)
+
+
+def start_new_session(http_resp: Response, data: dict[str, Any]):
+    """
+    Stores the data in a new session and sets its cookie, deleting the
+    request's session if it has one. Called on login, so that a session
+    id planted in the browser before it is never authenticated.
+    """
+    if _store is None:
+        raise RuntimeError("server-side sessions are not enabled")
+
+    old_session_id = flask_request.cookies.get(SESSION_ID_COOKIE_NAME)
+    if old_session_id:
+        _store.delete(old_session_id)
+    session_id = _store.create(data)
+    g.session_id = session_id
+    g.session_data = data
+    _set_session_cookie(http_resp, session_id)
+
+
+def _set_session_cookie(http_resp: Response, session_id: str):
+    http_resp.set_cookie(
+        SESSION_ID_COOKIE_NAME,
+        session_id,
+        httponly=True,
+        max_age=timedelta(seconds=env_config.SESSION_TTL),
+        samesite="None",
+        secure=not env_config.IS_DEV,
+    )
+
+
+def delete_current_session(http_resp: Response):
+    """
+    Deletes the request's session, if any, and its cookie.
+    """
+    session_id = flask_request.cookies.get(SESSION_ID_COOKIE_NAME)
+    if _store is not None and session_id:
+        _store.delete(session_id)
+    http_resp.delete_cookie(SESSION_ID_COOKIE_NAME)
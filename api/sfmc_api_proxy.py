@@ -1,58 +1,230 @@
+"""
+Proxies the SFMC REST and auth APIs for the UI.
+
+The proxied endpoints are declared in `ROUTES` along with their
+policies and are all served by the generic engine in `proxy_engine`.
+"""
+import dataclasses
+import time
+
 from flask import (
     Blueprint,
     g,
     jsonify,
     request as flask_request,
-    make_response,
 )
 from flask.wrappers import Response as FlaskResponse
-import requests
-from api import sfmc_oauth2
+from api import (
+    asset_index,
+    batch,
+    bulk_transfer,
+    deadlines,
+    json_codec,
+    proxy_engine,
+    session_store,
+    sfmc_oauth2,
+    thumbnails,
+    tracing,
+    traffic_capture,
+    unchanged_writes,
+    warmup,
+)
+from api.proxy_engine import ProxyRoute
 
 from api.app_logger import get_logger
 from api.cookies import verify_signature
+from . import env_config
 
 
 bp = Blueprint("sfmc_api_proxy", __name__, url_prefix="/api/sfmc")
 logger = get_logger(bp.name)
 
+# The largest query or category body that is accepted.
+MAX_SMALL_BODY_SIZE = 64 * 1024
+
+ASSETS = "/asset/v1/content/assets"
+CATEGORIES = "/asset/v1/content/categories"
+
+
+def index_hook(hook):
+    """
+    Returns the asset index hook if the index is enabled.
+    """
+    return hook if env_config.ASSET_INDEX_ENABLED else None
+
 
-def bp_url_prefix() -> str:
+def write_hook(hook):
     """
-    Retruns the URL prefix in the blueprint.
+    Returns the unchanged writes hook if skipping them is enabled.
     """
-    if bp.url_prefix is None:
-        return ""
-    return bp.url_prefix
+    return hook if env_config.SKIP_UNCHANGED_WRITES else None
 
 
-def get_request_url(tenant_subdomain: str, request_path: str) -> str:
+def chain(*hooks):
     """
-    Returns the request URL for the customer SFMC instance.
+    Returns an `on_response` hook that calls each of the hooks that is
+    set, or None if none is.
     """
-    return f"https://{tenant_subdomain}.rest.marketingcloudapis.com{request_path}"
+    hooks = tuple(hook for hook in hooks if hook is not None)
+    if len(hooks) <= 1:
+        return hooks[0] if hooks else None
+
+    def call(proxy_request, upstream_resp):
+        for hook in hooks:
+            hook(proxy_request, upstream_resp)
+
+    return call
+
+
+ROUTES = [
+    # Lists assets by using a simple filter.
+    ProxyRoute(
+        "filter_assets",
+        "GET",
+        ASSETS,
+        retry=True,
+        collapse=True,
+        projectable=True,
+        answer=index_hook(asset_index.answer_key_lookup),
+        on_response=write_hook(unchanged_writes.record_listing),
+    ),
+    # Get the currently logged-in user's info.
+    # https://developer.salesforce.com/docs/marketing/marketing-cloud/guide/getUserInfo.html
+    ProxyRoute(
+        "get_user_info",
+        "GET",
+        "/userinfo",
+        "/v2/userinfo",
+        upstream="auth",
+        retry=True,
+        cache_ttl=env_config.RESPONSE_CACHE_TTL,
+        streaming=False,
+    ),
+    # Lists assets by using an advanced filter passed in the request body.
+    ProxyRoute(
+        "advanced_filter_assets",
+        "POST",
+        f"{ASSETS}/query",
+        retry=True,
+        cache_ttl=env_config.RESPONSE_CACHE_TTL,
+        streaming=False,
+        max_body_size=MAX_SMALL_BODY_SIZE,
+        projectable=True,
+        answer=index_hook(asset_index.answer_category_listing),
+    ),
+    # Create an asset.
+    ProxyRoute(
+        "create_asset",
+        "POST",
+        ASSETS,
+        invalidates=(ASSETS,),
+        on_response=chain(
+            index_hook(asset_index.write_through),
+            write_hook(unchanged_writes.record_write),
+        ),
+    ),
+    # Update an existing asset. The body is streamed, unless it is read
+    # into memory to skip the updates that wouldn't change it.
+    ProxyRoute(
+        "update_asset",
+        "PATCH",
+        f"{ASSETS}/<asset_id>",
+        invalidates=(ASSETS,),
+        streaming=not env_config.SKIP_UNCHANGED_WRITES,
+        answer=write_hook(unchanged_writes.skip_unchanged),
+        on_response=chain(
+            index_hook(asset_index.write_through),
+            write_hook(unchanged_writes.record_write),
+        ),
+    ),
+    # Get the base64-encoded string of an asset's thumbnail.
+    ProxyRoute(
+        "get_thumbnail_base64",
+        "GET",
+        "/asset/v1/assets/<asset_id>/thumbnail",
+        retry=True,
+        collapse=True,
+    ),
+    # Lists categories.
+    ProxyRoute(
+        "list_categories",
+        "GET",
+        CATEGORIES,
+        retry=True,
+        cache_ttl=env_config.RESPONSE_CACHE_TTL,
+        streaming=False,
+        collapse=True,
+    ),
+    # Create a category in Content Builder.
+    ProxyRoute(
+        "create_category",
+        "POST",
+        CATEGORIES,
+        invalidates=(CATEGORIES,),
+        streaming=False,
+        max_body_size=MAX_SMALL_BODY_SIZE,
+    ),
+]
+
+for proxy_route in ROUTES:
+    bp.add_url_rule(
+        proxy_route.path,
+        proxy_route.name,
+        proxy_engine.make_view(proxy_route),
+        methods=[proxy_route.method],
+    )
+
+ROUTES_BY_NAME = {proxy_route.name: proxy_route for proxy_route in ROUTES}
+BATCH_ROUTER = batch.Router(ROUTES)
+THUMBNAIL_BASE64_ROUTE = ROUTES_BY_NAME["get_thumbnail_base64"]
+# The route of the thumbnail images in the traffic capture.
+THUMBNAIL_IMAGE_ROUTE_NAME = "get_thumbnail_image"
 
 
-def get_content_type(http_resp: requests.Response) -> str:
+@bp.route("/asset/v1/assets/<asset_id>/thumbnail/image")
+def get_thumbnail_image(asset_id: str):
     """
-    Returns the content-type header value from the response, if set,
-    otherwise, returns `application/json`.
+    Returns the thumbnail of an asset as an image, resized to fit the
+    `w` and `h` query parameters (see `thumbnails`.)
     """
-    sfmc_content_type = http_resp.headers.get("Content-Type")
-    if sfmc_content_type is None:
-        return "application/json"
-    else:
-        return sfmc_content_type
+    started_at = time.monotonic()
+    proxy_request = proxy_engine.ProxyRequest(
+        route=THUMBNAIL_BASE64_ROUTE,
+        tenant_subdomain=g.tenant_subdomain,
+        access_token=g.decoded_token,
+        path_args={"asset_id": asset_id},
+        deadline=deadlines.current(),
+    )
+    resp = thumbnails.serve(
+        proxy_request, flask_request.args.get("w"), flask_request.args.get("h")
+    )
+    if traffic_capture.get_capture() is not None:
+        traffic_capture.capture(
+            dataclasses.replace(
+                proxy_engine.describe(proxy_request), route=THUMBNAIL_IMAGE_ROUTE_NAME
+            ),
+            resp,
+            started_at,
+        )
+    return resp
 
 
 @bp.before_request
+@tracing.traced("verify")
 def before_request():
     """
     Middleware that executes before every request in this blueprint.
     Checks for the tenant sub-domain and the SFMC access token cookies
     and that the access token passes signature verification.
+    With server-side sessions, the tokens come from the session instead.
     """
-    
+    if session_store.get_store() is not None:
+        session_tokens = sfmc_oauth2.get_session_tokens()
+        if session_tokens is None:
+            return FlaskResponse(status=401)
+        g.tenant_subdomain, g.decoded_token = session_tokens
+        return None
+
     if sfmc_oauth2.TSSD_COOKIE_NAME not in flask_request.cookies:
         logger.error("tssd cookie was empty.")
         return FlaskResponse(status=401)
@@ -80,210 +252,58 @@ def before_request():
     g.decoded_token = decoded_token
 
 
-@bp.route("/asset/v1/content/assets")
-def filter_assets():
-    """
-    Lists assets by using a simple filter.
-    """
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    url = get_request_url(
-        tenant_subdomain, flask_request.path.replace(bp_url_prefix(), "")
-    )
-    logger.info("proxying request to %s", url)
-    http_resp = requests.get(
-        url,
-        flask_request.args.to_dict(),
-        headers={"Authorization": f"Bearer {decoded_token}"},
-    )
-
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
-
-
-@bp.route("/userinfo")
-def get_user_info():
-    """
-    Get the currently logged-in user's info.
-    """
-    
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    # https://developer.salesforce.com/docs/marketing/marketing-cloud/guide/getUserInfo.html
-    url = f"https://{tenant_subdomain}.auth.marketingcloudapis.com/v2/userinfo"
-    logger.info("proxying request to %s", url)
-    http_resp = requests.get(
-        url,
-        flask_request.args.to_dict(),
-        headers={"Authorization": f"Bearer {decoded_token}"},
-    )
-
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
-
-
-@bp.route("/asset/v1/content/assets/query", methods=["POST"])
-def advanced_filter_assets():
+def get_transfer() -> bulk_transfer.Transfer:
     """
-    Lists assets by using an advanced filter. The filter query
-    must be passed in the request body.
+    Returns the transfer of blocks for the request's tenant and token.
     """
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    url = get_request_url(
-        tenant_subdomain, flask_request.path.replace(bp_url_prefix(), "")
-    )
-    logger.info("proxying request to %s", url)
-    http_resp = requests.post(
-        url,
-        data=flask_request.data,
-        headers={
-            "Authorization": f"Bearer {decoded_token}",
-            "Content-Type": "application/json",
-        },
+    return bulk_transfer.Transfer(
+        ROUTES_BY_NAME,
+        g.tenant_subdomain,
+        g.decoded_token,
+        trace=tracing.current(),
+        force_write=unchanged_writes.is_forced(),
     )
 
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
 
-
-@bp.route("/asset/v1/content/assets", methods=["POST"])
-def create_asset():
+@bp.route("/blocks/export")
+def export_blocks():
     """
-    Create an asset.
+    Streams the HTML blocks of the `category` query parameter (the Laasie
+    Collection Templates by default) as NDJSON, or as a ZIP archive with
+    `format=zip` (see `bulk_transfer`.)
     """
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    url = get_request_url(
-        tenant_subdomain, flask_request.path.replace(bp_url_prefix(), "")
+    return bulk_transfer.export_blocks(
+        get_transfer(),
+        flask_request.args.get("category", warmup.DEFAULT_CATEGORY_NAME),
+        flask_request.args.get("format", "ndjson"),
     )
-    logger.info("proxying request to %s", url)
-    http_resp = requests.post(
-        url,
-        data=flask_request.data,
-        headers={"Authorization": f"Bearer {decoded_token}"},
-    )
-
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
 
 
-@bp.route("/asset/v1/content/assets/<asset_id>", methods=["PATCH"])
-def update_asset(asset_id: int):
+@bp.route("/blocks/import", methods=["POST"])
+def import_blocks():
     """
-    Update an existing asset.
+    Creates or updates the HTML blocks of an NDJSON or ZIP archive in the
+    `category` and streams the result of each as NDJSON.
     """
-    # pylint: disable=unused-argument
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    url = get_request_url(
-        tenant_subdomain, flask_request.path.replace(bp_url_prefix(), "")
+    return bulk_transfer.import_blocks(
+        get_transfer(),
+        flask_request.args.get("category", warmup.DEFAULT_CATEGORY_NAME),
     )
-    logger.info("proxying request to %s", url)
-    http_resp = requests.patch(
-        url,
-        data=flask_request.data,
-        headers={
-            "Authorization": f"Bearer {decoded_token}",
-            "Content-Type": "application/json",
-        },
-    )
-
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
 
 
-@bp.route("/asset/v1/assets/<asset_id>/thumbnail")
-def get_thumbnail_base64(asset_id: int):
+@bp.route("/batch", methods=["POST"])
+def run_batch():
     """
-    Get the base64-encoded string of an asset's thumbnail.
+    Runs the sub-requests of a batch to the proxied routes and returns
+    the response of each (see `batch`.)
     """
-    # pylint: disable=unused-argument
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    url = get_request_url(
-        tenant_subdomain, flask_request.path.replace(bp_url_prefix(), "")
-    )
-    logger.info("proxying request to %s", url)
-    http_resp = requests.get(
-        url,
-        data=flask_request.data,
-        headers={"Authorization": f"Bearer {decoded_token}"},
-    )
-
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
-
-
-@bp.route("/asset/v1/content/categories")
-def list_categories():
-    """
-    Lists categories.
-    """
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    url = get_request_url(
-        tenant_subdomain, flask_request.path.replace(bp_url_prefix(), "")
-    )
-    logger.info("proxying request to %s", url)
-    http_resp = requests.get(
-        url,
-        flask_request.args.to_dict(),
-        headers={"Authorization": f"Bearer {decoded_token}"},
-    )
-
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
-
-
-@bp.route("/asset/v1/content/categories", methods=["POST"])
-def create_category():
-    """
-    Create a category in Content Builder.
-    """
-    tenant_subdomain = g.tenant_subdomain
-    decoded_token = g.decoded_token
-
-    url = get_request_url(
-        tenant_subdomain, flask_request.path.replace(bp_url_prefix(), "")
-    )
-    logger.info("proxying request to %s", url)
-    http_resp = requests.post(
-        url,
-        data=flask_request.data,
-        headers={"Authorization": f"Bearer {decoded_token}"},
+    body = proxy_engine.get_buffered_request_body()
+    try:
+        sub_requests = json_codec.loads(body or b"")
+    except ValueError:
+        return proxy_engine.error_response(
+            400, "invalid_request", "The batch isn't valid JSON."
+        )
+    return batch.respond(
+        BATCH_ROUTER, sub_requests, g.tenant_subdomain, g.decoded_token
     )
-
-    resp = make_response()
-    resp.set_data(http_resp.content)
-    resp.headers.add("Content-Type", get_content_type(http_resp))
-    resp.status_code = http_resp.status_code
-    return resp
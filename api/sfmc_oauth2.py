@@ -1,12 +1,14 @@
 from dataclasses import dataclass
 from datetime import timedelta
 import re
-from typing import Any, Union
+import time
+from typing import Any, Optional, Union
 
 from flask.wrappers import Response
 from flask import (
     Blueprint,
     flash,
+    g,
     jsonify,
     redirect,
     render_template,
@@ -18,6 +20,7 @@ from itsdangerous import want_bytes
 import requests
 from werkzeug import wrappers
 
+from api import deadlines, json_codec, session_store, upstream, warmup
 from api.app_logger import get_logger
 from api.cookies import get_signer, verify_signature
 
@@ -63,7 +66,7 @@ def from_json_dict(obj: dict[Any, Any]) -> Union[AccessTokenResponse, dict]:
     if the provided dict contains known properties. Otherwise,
     returns the dict as-is.
     """
-    if obj.get("access_token", None) is not None:
+    if isinstance(obj, dict) and obj.get("access_token", None) is not None:
         return AccessTokenResponse(
             access_token=obj["access_token"],
             expires_in=obj["expires_in"],
@@ -122,19 +125,27 @@ def oauth2_callback() -> Union[str, Response, wrappers.Response]:
             return render_template("oauth2/error.html")
         tenant_subdomain = tssd
 
-    access_token_resp = requests.post(
-        f"https://{tenant_subdomain}.auth.marketingcloudapis.com/v2/token",
-        json={
-            "client_id": env_config.SFMC_CLIENT_ID,
-            "client_secret": env_config.SFMC_CLIENT_SECRET,
-            "code": code,
-            "grant_type": "authorization_code",
-            "redirect_uri": f"{env_config.SELF_DOMAIN}{bp.url_prefix}/callback",
-        },
-    )
+    try:
+        access_token_resp = deadlines.send(
+            "POST",
+            upstream.sfmc_auth_url(tenant_subdomain, "/v2/token"),
+            "sfmc_token",
+            env_config.UPSTREAM_TIMEOUT,
+            json={
+                "client_id": env_config.SFMC_CLIENT_ID,
+                "client_secret": env_config.SFMC_CLIENT_SECRET,
+                "code": code,
+                "grant_type": "authorization_code",
+                "redirect_uri": f"{env_config.SELF_DOMAIN}{bp.url_prefix}/callback",
+            },
+        )
+    except requests.RequestException as ex:
+        logger.error("Failed to fetch access token from SFMC: %s", ex)
+        flash("Could not reach SFMC. Try again later.", "error")
+        return render_template("oauth2/error.html"), get_upstream_status(ex)
 
     if access_token_resp.status_code != 200:
-        error_resp = access_token_resp.json()
+        error_resp = json_codec.loads(access_token_resp.content)
         logger.error(
             "Failed to fetch access token from SFMC. %s",
             error_resp["error_description"],
@@ -144,7 +155,7 @@ def oauth2_callback() -> Union[str, Response, wrappers.Response]:
 
     token: AccessTokenResponse
     try:
-        token = access_token_resp.json(object_hook=from_json_dict)
+        token = from_json_dict(json_codec.loads(access_token_resp.content))
     except InvalidTokenResponse as ex:
         logger.error("Parsing JSON response from token endpoint %s", ex.message)
         flash(ex.message, "error")
@@ -152,7 +163,8 @@ def oauth2_callback() -> Union[str, Response, wrappers.Response]:
 
     resp = make_response(redirect(url_for("catch_all")))
 
-    set_cookies(resp, token, tenant_subdomain)
+    set_cookies(resp, token, tenant_subdomain, new_session=True)
+    warmup.schedule(tenant_subdomain, token.access_token)
 
     return resp
 
@@ -163,7 +175,44 @@ def refresh_token():
     Called by the UI periodically to refresh its access token
     and the refresh token.
     """
-    print(flask_request.cookies)
+    store = session_store.get_store()
+    if store is not None:
+        session_data = session_store.get_current_session()
+        if session_data is None or "refresh_token" not in session_data:
+            logger.error("No session with a refresh token was found. Returning 401.")
+            return Response(status=401)
+        # SFMC only accepts a refresh token once. If another request is
+        # already refreshing the session, the UI keeps using the session
+        # that request refreshes.
+        if not store.claim_refresh(g.session_id):
+            logger.info("The tokens of the session are already being refreshed.")
+            return make_response()
+        tenant_subdomain = session_data["tssd"]
+        decoded_rt = session_data["refresh_token"]
+    else:
+        refresh_token_cookies = get_refresh_token_from_cookies()
+        if not isinstance(refresh_token_cookies, tuple):
+            return refresh_token_cookies
+        tenant_subdomain, decoded_rt = refresh_token_cookies
+
+    token = exchange_refresh_token(tenant_subdomain, decoded_rt)
+    if not isinstance(token, AccessTokenResponse):
+        return token
+
+    http_resp = make_response()
+
+    set_cookies(http_resp, token, tenant_subdomain)
+    warmup.schedule(tenant_subdomain, token.access_token)
+
+    return http_resp
+
+
+def get_refresh_token_from_cookies() -> Union[tuple[str, str], Response]:
+    """
+    Returns the tenant sub-domain and the decoded refresh token from
+    the request's cookies, or an error response if they are missing
+    or invalid.
+    """
     if TSSD_COOKIE_NAME not in flask_request.cookies:
         return Response(status=401)
     if REFRESH_TOKEN_COOKIE_NAME not in flask_request.cookies:
@@ -194,18 +243,45 @@ def refresh_token():
         logger.error("Decoded refresh token value was empty. Returning a 401.")
         return Response(status=401)
 
-    access_token_resp = requests.post(
-        f"https://{tenant_subdomain}.auth.marketingcloudapis.com/v2/token",
-        json={
-            "grant_type": "refresh_token",
-            "client_id": env_config.SFMC_CLIENT_ID,
-            "client_secret": env_config.SFMC_CLIENT_SECRET,
-            "refresh_token": decoded_rt,
-        },
-    )
+    return tenant_subdomain, decoded_rt
+
+
+def get_upstream_status(ex: requests.RequestException) -> int:
+    """
+    Returns the status of the response to a request whose call to SFMC
+    failed: a 504 if it timed out, a 502 otherwise.
+    """
+    return 504 if isinstance(ex, requests.Timeout) else 502
+
+
+def exchange_refresh_token(
+    tenant_subdomain: str, decoded_rt: str
+) -> Union[AccessTokenResponse, Response]:
+    """
+    Exchanges the refresh token for a new access token and refresh token.
+    Returns an error response if SFMC refuses the refresh token or can't
+    be reached.
+    """
+    try:
+        access_token_resp = deadlines.send(
+            "POST",
+            upstream.sfmc_auth_url(tenant_subdomain, "/v2/token"),
+            "sfmc_token_refresh",
+            env_config.UPSTREAM_TIMEOUT,
+            deadlines.current(),
+            json={
+                "grant_type": "refresh_token",
+                "client_id": env_config.SFMC_CLIENT_ID,
+                "client_secret": env_config.SFMC_CLIENT_SECRET,
+                "refresh_token": decoded_rt,
+            },
+        )
+    except requests.RequestException as ex:
+        logger.error("Failed to refresh token: %s", ex)
+        return Response(status=get_upstream_status(ex))
 
     if access_token_resp.status_code != 200:
-        error_resp = access_token_resp.json()
+        error_resp = json_codec.loads(access_token_resp.content)
         logger.error("Failed to fetch refresh token from SFMC: %s", error_resp)
         if error_resp["error"] == "invalid_request":
             return Response(status=401)
@@ -214,7 +290,7 @@ def refresh_token():
         return Response(status=500)
 
     try:
-        token = access_token_resp.json(object_hook=from_json_dict)
+        return from_json_dict(json_codec.loads(access_token_resp.content))
     except InvalidTokenResponse as ex:
         logger.error(
             "Failed to refresh token. Error parsing JSON response from token endpoint: %s",
@@ -222,17 +298,70 @@ def refresh_token():
         )
         return Response(status=500)
 
-    http_resp = make_response()
-
-    set_cookies(http_resp, token, tenant_subdomain)
-
-    return http_resp
 
-
-def set_cookies(http_resp: Response, token: AccessTokenResponse, tenant_subdomain: str):
+def get_session_tokens() -> Optional[tuple[str, str]]:
+    """
+    Returns the tenant sub-domain and the SFMC access token of the
+    request's server-side session, or None if there is no valid session.
+    Refreshes the tokens first if the access token is about to expire.
     """
-    Sets the SFMC cookies.
+    session_data = session_store.get_current_session()
+    if session_data is None or "access_token" not in session_data:
+        return None
+
+    tenant_subdomain = session_data["tssd"]
+    expires_in = session_data["access_token_expires_at"] - time.time()
+    if expires_in > env_config.SESSION_REFRESH_MARGIN:
+        return tenant_subdomain, session_data["access_token"]
+
+    store = session_store.get_store()
+    # Only one request refreshes the tokens. The others keep using the
+    # current access token while it is still valid.
+    if store is not None and store.claim_refresh(g.session_id):
+        logger.info("Refreshing the tokens of a session before they expire.")
+        token = exchange_refresh_token(tenant_subdomain, session_data["refresh_token"])
+        if isinstance(token, AccessTokenResponse):
+            session_data = get_session_data(token, tenant_subdomain)
+            store.update(g.session_id, session_data)
+            g.session_data = {**g.session_data, **session_data}
+            return tenant_subdomain, token.access_token
+
+    if expires_in <= 0:
+        return None
+    return tenant_subdomain, session_data["access_token"]
+
+
+def get_session_data(token: AccessTokenResponse, tenant_subdomain: str) -> dict:
     """
+    Returns the session data for an access token response.
+    """
+    return {
+        "tssd": tenant_subdomain,
+        "access_token": token.access_token,
+        "access_token_expires_at": time.time() + token.expires_in,
+        "refresh_token": token.refresh_token,
+    }
+
+
+def set_cookies(
+    http_resp: Response,
+    token: AccessTokenResponse,
+    tenant_subdomain: str,
+    new_session: bool = False,
+):
+    """
+    Sets the SFMC cookies, or stores the tokens in the request's
+    server-side session if those are enabled. With `new_session`, on
+    login, the tokens are stored in a new session instead.
+    """
+    if session_store.get_store() is not None:
+        session_data = get_session_data(token, tenant_subdomain)
+        if new_session:
+            session_store.start_new_session(http_resp, session_data)
+        else:
+            session_store.save_current_session(http_resp, session_data)
+        return
+
     # Set the tenant subdomain cookie again to refresh its max_age.
     http_resp.set_cookie(
         TSSD_COOKIE_NAME,
@@ -273,3 +402,4 @@ def delete_cookies(resp: Response):
     resp.delete_cookie(ACCESS_TOKEN_COOKIE_NAME)
     resp.delete_cookie(REFRESH_TOKEN_COOKIE_NAME)
     resp.delete_cookie(TSSD_COOKIE_NAME)
+    session_store.delete_current_session(resp)
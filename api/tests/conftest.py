@@ -0,0 +1,60 @@
+"""
+Fixtures shared by the API tests.
+"""
+from itsdangerous import want_bytes
+import pytest
+
+from api import create_app
+from api.cookies import get_signer
+
+
+class FakeUpstreamResponse:
+    """
+    A response of SFMC or Laasie, returned by a fake `requests.Session.request`.
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, status_code=200, content=b"{}", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+
+    def iter_content(self, chunk_size):
+        # pylint: disable=missing-function-docstring,unused-argument
+        yield self.content
+
+    def close(self):
+        # pylint: disable=missing-function-docstring
+        pass
+
+
+@pytest.fixture(name="fake_response")
+def fixture_fake_response():
+    """
+    Returns the class of the fake upstream responses.
+    """
+    return FakeUpstreamResponse
+
+
+@pytest.fixture(name="app")
+def fixture_app():
+    """
+    Returns the app, without CSRF protection.
+    """
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    return app
+
+
+@pytest.fixture(name="client")
+def fixture_client(app):
+    """
+    Returns a test client with the SFMC tenant and signed access token
+    cookies of a logged in user.
+    """
+    with app.app_context():
+        signed_token = str(get_signer().sign(want_bytes("fake_token")), "UTF-8")
+    client = app.test_client()
+    client.set_cookie("localhost", "sfmc_tssd", "mcmb4wk3d")
+    client.set_cookie("localhost", "sfmc_access_token", signed_token)
+    return client
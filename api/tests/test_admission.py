@@ -0,0 +1,151 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from api import admission, create_app, env_config
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting for the lane"
+        time.sleep(0.001)
+
+
+def test_lane_sheds_requests_over_the_caps():
+    lane = admission.Lane("test", max_inflight=1, max_queue=1, max_queue_wait=0.05)
+    assert lane.acquire()
+
+    # The waiting request times out, and with it waiting the next one
+    # is shed right away.
+    waiter = threading.Thread(target=lambda: assert_shed(lane))
+    waiter.start()
+    wait_until(lambda: lane.waiting > 0)
+    assert not lane.acquire()
+    waiter.join()
+
+    lane.release()
+    assert lane.acquire()
+    assert lane.retry_after() >= 1
+
+
+def assert_shed(lane):
+    assert not lane.acquire()
+
+
+def test_upstream_requests_are_shed_and_health_checks_are_not(monkeypatch):
+    monkeypatch.setattr(env_config, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_INFLIGHT", 0)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_QUEUE", 0)
+    client = create_app().test_client()
+
+    resp = client.get("/api/sfmc/asset/v1/content/assets")
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+
+    assert client.get("/healthcheck").status_code == 200
+
+
+@pytest.fixture(name="app")
+def fixture_app(monkeypatch):
+    """
+    Returns the app with a single upstream slot and no queue.
+    """
+    monkeypatch.setattr(env_config, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_INFLIGHT", 1)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_QUEUE", 0)
+    return create_app()
+
+
+def test_slots_are_held_until_streamed_responses_are_sent(
+    monkeypatch, fake_response, client
+):
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda *args, **kwargs: fake_response(content=b'{"count": 0, "items": []}'),
+    )
+    url = "/api/sfmc/asset/v1/content/assets"
+
+    streamed = client.get(url, buffered=False)
+    assert streamed.status_code == 200
+    assert client.get(url).status_code == 503
+    assert streamed.get_data() == b'{"count": 0, "items": []}'
+    streamed.close()
+    assert client.get(url).status_code == 200
+
+
+def test_free_slots_are_taken_without_waiting():
+    lane = admission.Lane(
+        "test", max_inflight=3, max_queue=1, max_queue_wait=5, max_tenant_inflight=2
+    )
+    assert lane.try_acquire("big")
+    assert lane.try_acquire("big")
+    # The big tenant is at its cap, but the small one gets the free slot.
+    assert not lane.try_acquire("big")
+    assert lane.try_acquire("small")
+    assert not lane.try_acquire("small")
+
+    lane.release("big", 2)
+    assert lane.inflight == 1
+    assert lane.try_acquire("small")
+
+
+def test_invalid_tenant_weights_are_skipped():
+    assert admission.parse_tenant_weights(
+        "mcmb4wk3d=2, big=0.5,nan=nan,zero=0,negative=-1,missing,=3,bad=x,"
+    ) == {"mcmb4wk3d": 2.0, "big": 0.5}
+
+
+def wait_in_line(lane, tenant, order):
+    thread = threading.Thread(
+        target=lambda: lane.acquire(tenant) and order.append(tenant)
+    )
+    waiting = lane.waiting
+    thread.start()
+    wait_until(lambda: lane.waiting != waiting)
+    return thread
+
+
+def test_slots_are_shared_fairly_between_tenants():
+    lane = admission.Lane(
+        "test", max_inflight=2, max_queue=3, max_queue_wait=5, max_tenant_inflight=1
+    )
+    assert lane.acquire("big")
+    # The big tenant is at its cap, but the small one gets the free slot.
+    assert lane.acquire("small")
+
+    order = []
+    threads = [wait_in_line(lane, "big", order), wait_in_line(lane, "big", order)]
+    threads.append(wait_in_line(lane, "small", order))
+    lane.release("small")
+    lane.release("big")
+    # The small tenant is served before the second request of the big one.
+    wait_until(lambda: len(order) >= 2)
+    assert sorted(order) == ["big", "small"]
+    lane.release(order[0])
+    lane.release(order[1])
+    for thread in threads:
+        thread.join()
+    assert order[2] == "big"
+
+
+def test_full_queue_pushes_out_the_largest_tenant():
+    lane = admission.Lane("test", max_inflight=1, max_queue=1, max_queue_wait=5)
+    assert lane.acquire("big")
+    order = []
+    pushed_out = wait_in_line(lane, "big", order)
+
+    assert not lane.acquire("big")
+    small = threading.Thread(
+        target=lambda: lane.acquire("small") and order.append("small")
+    )
+    small.start()
+    pushed_out.join()
+    lane.release("big")
+    small.join()
+
+    assert order == ["small"]
+    assert admission.shed_total.value(lane="test", tenant="big", reason="pushed_out")
@@ -0,0 +1,21 @@
+import logging
+
+from api import env_config
+from api.app_logger import get_logger
+
+
+def test_handlers_are_added_once(monkeypatch):
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    handler = logging.NullHandler()
+    gunicorn_logger.addHandler(handler)
+    try:
+        for _ in range(3):
+            logger = get_logger("test-app-logger")
+        assert logger.handlers == [handler]
+
+        monkeypatch.setattr(env_config, "FLASK_DEBUG", "1")
+        logger = get_logger("test-app-logger-debug")
+        assert get_logger("test-app-logger-debug").handlers == logger.handlers
+        assert len(logger.handlers) == 1
+    finally:
+        gunicorn_logger.removeHandler(handler)
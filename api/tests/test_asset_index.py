@@ -0,0 +1,202 @@
+import json
+import time
+
+import pytest
+
+from api import asset_index, projection
+from api.proxy_engine import ProxyRequest, UpstreamResponse
+from api.sfmc_api_proxy import ROUTES
+
+ROUTES_BY_NAME = {route.name: route for route in ROUTES}
+BLOCKS = [
+    {
+        "id": 1,
+        "customerKey": "laasie-1",
+        "name": "Block 1",
+        "category": {"id": 7, "name": "Laasie Collection Templates"},
+        "modifiedDate": "2022-06-02T10:00:00.97-06:00",
+        "content": "<p>1</p>",
+    },
+    {
+        "id": 2,
+        "customerKey": "laasie-2",
+        "name": "Block 2",
+        "category": {"id": 8, "name": "Other"},
+        "modifiedDate": "2022-06-03T10:00:00-06:00",
+        "content": "<p>2</p>",
+    },
+]
+
+
+@pytest.fixture(name="fake_sfmc")
+def fixture_fake_sfmc(monkeypatch, fake_response):
+    """
+    Returns a function that makes SFMC list the items, and returns the
+    list the queries sent to it are appended to.
+    """
+
+    def install(items):
+        queries = []
+
+        def fake_request(self, method, url, **kwargs):
+            if url.endswith("/v2/userinfo"):
+                # Each token belongs to a different user of the business unit.
+                user = kwargs["headers"]["Authorization"].split()[-1]
+                return fake_response(
+                    content=json.dumps(
+                        {"organization": {"member_id": 100}, "user": {"sub": user}}
+                    ).encode()
+                )
+            queries.append(json.loads(kwargs["data"])["query"])
+            return fake_response(
+                content=json.dumps({"count": len(items), "items": items}).encode()
+            )
+
+        monkeypatch.setattr("requests.Session.request", fake_request)
+        return queries
+
+    return install
+
+
+def make_request(route_name, fields="id,customerKey", **kwargs):
+    return ProxyRequest(
+        route=ROUTES_BY_NAME[route_name],
+        tenant_subdomain="mcmb4wk3d",
+        access_token="fake_token",
+        fields=projection.parse_fields(fields),
+        **kwargs,
+    )
+
+
+def synced_index(fake_sfmc, items):
+    asset_index.reset()
+    fake_sfmc(items)
+    index = asset_index.find_index("mcmb4wk3d", "fake_token", create=True)
+    assert asset_index.sync(index, "mcmb4wk3d", "fake_token", full=True)
+    return index
+
+
+def test_lookups_are_answered_from_the_index(fake_sfmc):
+    synced_index(fake_sfmc, BLOCKS)
+    lookup = {"$filter": "customerKey eq 'laasie-2'"}
+
+    answered = asset_index.answer_key_lookup(
+        make_request("filter_assets", params=lookup)
+    )
+    assert json.loads(answered.content)["items"][0]["id"] == 2
+    # Asking for fields that aren't indexed goes to SFMC.
+    assert (
+        asset_index.answer_key_lookup(
+            make_request("filter_assets", fields="id,content", params=lookup)
+        )
+        is None
+    )
+
+    query = {
+        "page": {"page": 1, "pageSize": 50},
+        "query": {
+            "leftOperand": {
+                "property": "assetType.name",
+                "simpleOperator": "equal",
+                "value": "htmlblock",
+            },
+            "logicalOperator": "AND",
+            "rightOperand": {
+                "property": "category.name",
+                "simpleOperator": "equal",
+                "value": "Laasie Collection Templates",
+            },
+        },
+    }
+    answered = asset_index.answer_category_listing(
+        make_request("advanced_filter_assets", body=json.dumps(query).encode())
+    )
+    listing = json.loads(answered.content)
+    assert listing["count"] == 1
+    assert listing["items"][0]["customerKey"] == "laasie-1"
+
+
+def test_delta_syncs_and_writes_update_the_index(fake_sfmc):
+    index = synced_index(fake_sfmc, BLOCKS)
+    changed = {**BLOCKS[0], "modifiedDate": "2022-06-04"}
+    del changed["content"]
+    queries = fake_sfmc([changed])
+
+    assert asset_index.sync(index, "mcmb4wk3d", "fake_token", full=False)
+    assert queries[0]["rightOperand"]["value"] == "2022-06-03T10:00:00-06:00"
+    assert index.watermark == "2022-06-04"
+    # The content is only hashed once the proxy has written it.
+    assert index.get(1).content_hash is None
+
+    created = {**BLOCKS[0], "id": 3, "customerKey": "laasie-3"}
+    created["assetType"] = {"id": 197, "name": "htmlblock"}
+    asset_index.write_through(
+        make_request("create_asset"),
+        UpstreamResponse(201, "application/json", json.dumps(created).encode()),
+    )
+    assert index.get_by_key("laasie-3").id == 3
+    assert index.get(3).content_hash == asset_index.content_hash("<p>1</p>")
+
+    asset_index.write_through(
+        make_request("update_asset", path_args={"asset_id": "2"}),
+        UpstreamResponse(404, "application/json", b"{}"),
+    )
+    assert index.get_by_key("laasie-2") is None
+
+
+def test_users_are_only_answered_from_their_own_syncs(fake_sfmc):
+    synced_index(fake_sfmc, BLOCKS)
+    other_user = ProxyRequest(
+        route=ROUTES_BY_NAME["filter_assets"],
+        tenant_subdomain="mcmb4wk3d",
+        access_token="other_token",
+        fields=projection.parse_fields("id,customerKey"),
+        params={"$filter": "customerKey eq 'laasie-2'"},
+    )
+
+    # The other user's index starts its own sync instead of answering.
+    assert asset_index.answer_key_lookup(other_user) is None
+    index = asset_index.find_index("mcmb4wk3d", "other_token")
+    assert index is not asset_index.find_index("mcmb4wk3d", "fake_token")
+    deadline = time.monotonic() + 5
+    while not index.complete:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_syncs_are_not_sent_after_the_deadline(fake_sfmc):
+    index = synced_index(fake_sfmc, BLOCKS)
+    queries = fake_sfmc(BLOCKS)
+
+    assert not asset_index.sync(
+        index, "mcmb4wk3d", "fake_token", False, deadline=time.monotonic() - 1
+    )
+    assert not queries
+
+
+def test_syncs_keep_the_assets_written_while_they_ran(
+    monkeypatch, fake_response, fake_sfmc
+):
+    index = synced_index(fake_sfmc, BLOCKS)
+    updated = {**BLOCKS[1], "name": "Renamed", "modifiedDate": "2022-06-05"}
+    updated["assetType"] = {"id": 197, "name": "htmlblock"}
+    requested_fields = []
+
+    def sync_while_writing(self, method, url, **kwargs):
+        requested_fields.append(json.loads(kwargs["data"])["fields"])
+        # The proxy updates a block while the full sync is running.
+        asset_index.write_through(
+            make_request("update_asset", path_args={"asset_id": "2"}),
+            UpstreamResponse(200, "application/json", json.dumps(updated).encode()),
+        )
+        return fake_response(
+            content=json.dumps({"count": len(BLOCKS), "items": BLOCKS}).encode()
+        )
+
+    monkeypatch.setattr("requests.Session.request", sync_while_writing)
+
+    assert asset_index.sync(index, "mcmb4wk3d", "fake_token", full=True)
+    assert "content" not in requested_fields[0]
+    assert index.get(2).name == "Renamed"
+    assert index.get(2).content_hash == asset_index.content_hash("<p>2</p>")
+    assert index.get(1).name == "Block 1"
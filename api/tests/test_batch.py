@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+
+from api import create_app, env_config, response_cache, unchanged_writes
+
+CATEGORIES = {"count": 1, "items": [{"id": 7, "name": "Laasie Collection Templates"}]}
+ASSETS = {"count": 1, "items": [{"id": 1, "name": "Block", "content": "<p>1</p>"}]}
+
+
+def test_batch_runs_sub_requests_after_their_dependencies(
+    monkeypatch, fake_response, client
+):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append((method, url.rsplit("/", 1)[-1]))
+        if url.endswith("/categories"):
+            return fake_response(content=json.dumps(CATEGORIES).encode())
+        if url.endswith("/userinfo"):
+            return fake_response(status_code=500, content=b"down")
+        return fake_response(content=json.dumps(ASSETS).encode())
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    response_cache.clear()
+
+    resp = client.post(
+        "/api/sfmc/batch",
+        json={
+            "requests": [
+                {
+                    "id": "blocks",
+                    "method": "POST",
+                    "path": "/asset/v1/content/assets/query?fields=id,name",
+                    "body": {"page": {"page": 1, "pageSize": 50}},
+                    "dependsOn": ["categories"],
+                },
+                {"id": "categories", "path": "/asset/v1/content/categories"},
+                {"id": "user", "path": "/userinfo"},
+                {"id": "after-user", "path": "/userinfo", "dependsOn": ["user"]},
+                {"id": "unknown", "path": "/nowhere"},
+            ]
+        },
+    )
+
+    assert resp.status_code == 200
+    responses = {item["id"]: item for item in resp.json["responses"]}
+    assert list(responses) == ["blocks", "categories", "user", "after-user", "unknown"]
+    assert responses["categories"]["body"] == CATEGORIES
+    assert responses["blocks"]["body"]["items"] == [{"id": 1, "name": "Block"}]
+    assert responses["user"]["status"] == 500
+    assert responses["user"]["body"] == "down"
+    assert responses["after-user"]["status"] == 424
+    assert responses["unknown"]["status"] == 404
+    assert calls.index(("GET", "categories")) < calls.index(("POST", "query"))
+    assert len(calls) == 3
+
+
+def test_batch_with_circular_dependencies_is_refused(client):
+    resp = client.post(
+        "/api/sfmc/batch",
+        json={
+            "requests": [
+                {"id": "a", "path": "/userinfo", "dependsOn": ["b"]},
+                {"id": "b", "path": "/userinfo", "dependsOn": ["a"]},
+            ]
+        },
+    )
+
+    assert resp.status_code == 400
+    assert "circular" in resp.json["error_description"]
+
+
+def test_sub_requests_carry_the_context_of_the_batch(
+    monkeypatch, fake_response, client
+):
+    lock = threading.Lock()
+    traceparents = []
+    sending = []
+    most_sending = []
+
+    def fake_request(self, method, url, **kwargs):
+        with lock:
+            traceparents.append(kwargs["headers"].get("traceparent", ""))
+            sending.append(url)
+            most_sending.append(len(sending))
+        time.sleep(0.02)
+        with lock:
+            sending.remove(url)
+        return fake_response(content=json.dumps(ASSETS["items"][0]).encode())
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    monkeypatch.setattr(env_config, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_INFLIGHT", 2)
+    monkeypatch.setattr(env_config, "ADMISSION_TENANT_MAX_INFLIGHT", 2)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_QUEUE", 0)
+    monkeypatch.setattr(env_config, "BATCH_MAX_CONCURRENCY", 4)
+    client.application = create_app()
+    client.application.config["WTF_CSRF_ENABLED"] = False
+    unchanged_writes.reset()
+    unchanged_writes.record("fake_token", ASSETS["items"][0])
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+    resp = client.post(
+        "/api/sfmc/batch",
+        json={
+            "requests": [
+                {
+                    "method": "PATCH",
+                    "path": "/asset/v1/content/assets/1",
+                    "body": {"content": "<p>1</p>"},
+                }
+            ]
+            * 6
+        },
+        headers={
+            "traceparent": f"00-{trace_id}-00f067aa0ba902b7-01",
+            "X-Force-Write": "true",
+        },
+    )
+
+    assert [item["status"] for item in resp.json["responses"]] == [200] * 6
+    # The unchanged writes were forced, under the trace of the batch.
+    assert len(traceparents) == 6
+    assert all(header.startswith(f"00-{trace_id}-") for header in traceparents)
+    # The sub-requests only ran in the two slots of the lane.
+    assert max(most_sending) == 2
@@ -0,0 +1,202 @@
+import io
+import json
+import threading
+import time
+import zipfile
+
+import pytest
+
+from api import bulk_transfer, create_app, env_config, response_cache, unchanged_writes
+
+
+def make_block(block_id):
+    return {
+        "id": block_id,
+        "customerKey": f"laasie-{block_id}",
+        "name": f"Block {block_id}",
+        "content": f"<p>{block_id}</p>",
+        "category": {"id": 7, "name": "Laasie Collection Templates"},
+        "owner": {"id": 1},
+    }
+
+
+def listing(fake_response, items, count=None):
+    return fake_response(
+        content=json.dumps(
+            {"count": len(items) if count is None else count, "items": items}
+        ).encode()
+    )
+
+
+def test_blocks_are_exported_page_by_page(monkeypatch, fake_response, client):
+    pages = []
+
+    def fake_request(self, method, url, **kwargs):
+        page = json.loads(kwargs["data"])["page"]["page"]
+        pages.append(page)
+        return listing(
+            fake_response,
+            [make_block(2 * page - 1), make_block(2 * page)][: 3 - page],
+            count=3,
+        )
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    monkeypatch.setattr(bulk_transfer, "EXPORT_PAGE_SIZE", 2)
+
+    resp = client.get("/api/sfmc/blocks/export")
+    assert resp.mimetype == "application/x-ndjson"
+    blocks = [json.loads(line) for line in resp.data.splitlines()]
+    assert [block["id"] for block in blocks] == [1, 2, 3]
+    assert "owner" not in blocks[0]
+    assert pages == [1, 2]
+
+    resp = client.get("/api/sfmc/blocks/export?format=zip")
+    archive = zipfile.ZipFile(io.BytesIO(resp.data))
+    assert archive.read("blocks/3.html") == b"<p>3</p>"
+    assert json.loads(archive.read("blocks/3.json"))["customerKey"] == "laasie-3"
+
+
+def test_exports_cut_short_by_sfmc_are_not_complete(monkeypatch, fake_response, client):
+    def fake_request(self, method, url, **kwargs):
+        if json.loads(kwargs["data"])["page"]["page"] == 2:
+            return fake_response(status_code=500)
+        return listing(fake_response, [make_block(1), make_block(2)], count=3)
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    monkeypatch.setattr(bulk_transfer, "EXPORT_PAGE_SIZE", 2)
+
+    lines = [
+        json.loads(line)
+        for line in client.get("/api/sfmc/blocks/export").data.splitlines()
+    ]
+    assert [line.get("id") for line in lines[:2]] == [1, 2]
+    assert lines[-1]["error"] == "upstream_error"
+
+    resp = client.get("/api/sfmc/blocks/export?format=zip")
+    with pytest.raises(zipfile.BadZipFile):
+        zipfile.ZipFile(io.BytesIO(resp.data))
+
+
+def test_blocks_are_imported_with_a_result_each(monkeypatch, fake_response, client):
+    saved = []
+
+    def fake_request(self, method, url, **kwargs):
+        if url.endswith("/categories"):
+            return listing(
+                fake_response, [{"id": 7, "name": "Laasie Collection Templates"}]
+            )
+        if method == "GET":
+            found = "laasie-1" in kwargs["params"]["$filter"]
+            return listing(fake_response, [make_block(1)] if found else [])
+        saved.append((method, url, json.loads(kwargs["data"])))
+        return fake_response(
+            status_code=200 if method == "PATCH" else 201, content=b'{"id": 5}'
+        )
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    response_cache.clear()
+    unchanged_writes.reset()
+    archive = b"\n".join(
+        [
+            json.dumps({**make_block(1), "content": "<p>new</p>"}).encode(),
+            json.dumps({**make_block(2), "id": None}).encode(),
+            b'{"name": "no key"}',
+        ]
+    )
+
+    resp = client.post(
+        "/api/sfmc/blocks/import",
+        data=archive,
+        content_type="application/x-ndjson",
+    )
+
+    results = [json.loads(line) for line in resp.data.splitlines()]
+    by_item = {result.get("item"): result for result in results}
+    assert by_item[1]["status"] == "updated"
+    assert by_item[2] == {
+        "item": 2,
+        "customerKey": "laasie-2",
+        "status": "created",
+        "id": 5,
+    }
+    assert by_item[3]["status"] == "failed"
+    assert results[-1] == {
+        "summary": {"created": 1, "updated": 1, "unchanged": 0, "failed": 1}
+    }
+
+    methods = {method: body for method, _, body in saved}
+    assert methods["PATCH"] == {"name": "Block 1", "content": "<p>new</p>"}
+    assert methods["POST"]["category"] == {"id": 7}
+    assert methods["POST"]["customerKey"] == "laasie-2"
+
+
+def test_imports_save_blocks_within_the_free_admission_slots(
+    monkeypatch, fake_response, client
+):
+    lock = threading.Lock()
+    saving = []
+    most_saving = []
+
+    def fake_request(self, method, url, **kwargs):
+        if url.endswith("/categories"):
+            return listing(
+                fake_response, [{"id": 7, "name": "Laasie Collection Templates"}]
+            )
+        if method == "GET":
+            return listing(fake_response, [])
+        with lock:
+            saving.append(url)
+            most_saving.append(len(saving))
+        time.sleep(0.02)
+        with lock:
+            saving.remove(url)
+        return fake_response(status_code=201, content=b'{"id": 5}')
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    monkeypatch.setattr(env_config, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_INFLIGHT", 2)
+    monkeypatch.setattr(env_config, "ADMISSION_TENANT_MAX_INFLIGHT", 2)
+    monkeypatch.setattr(env_config, "ADMISSION_MAX_QUEUE", 0)
+    monkeypatch.setattr(env_config, "BULK_IMPORT_CONCURRENCY", 4)
+    response_cache.clear()
+    unchanged_writes.reset()
+    client.application = create_app()
+    client.application.config["WTF_CSRF_ENABLED"] = False
+    archive = b"\n".join(
+        json.dumps({**make_block(number), "id": None}).encode()
+        for number in range(1, 9)
+    )
+
+    resp = client.post(
+        "/api/sfmc/blocks/import",
+        data=archive,
+        content_type="application/x-ndjson",
+        buffered=False,
+    )
+    # The import holds both slots until its response has been sent.
+    assert client.get("/api/sfmc/asset/v1/content/categories").status_code == 503
+    results = [json.loads(line) for line in resp.get_data().splitlines()]
+    resp.close()
+
+    assert results[-1]["summary"]["created"] == 8
+    assert max(most_saving) == 2
+    assert client.get("/api/sfmc/asset/v1/content/categories").status_code == 200
+
+
+def test_invalid_categories_fail_the_import(monkeypatch, fake_response, client):
+    def fake_request(self, method, url, **kwargs):
+        if method == "GET":
+            return listing(fake_response, [{"id": 1, "name": "Root", "parentId": 0}])
+        return fake_response(status_code=201, content=b"[]")
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    response_cache.clear()
+
+    resp = client.post(
+        "/api/sfmc/blocks/import",
+        data=b"{}",
+        content_type="application/x-ndjson",
+    )
+
+    assert resp.status_code == 502
+    assert resp.json["error_description"] == "SFMC returned an invalid category"
@@ -0,0 +1,71 @@
+from itsdangerous import want_bytes
+import requests
+
+from api import deadlines, env_config
+from api.cookies import get_signer
+
+
+def test_latency_sketch_estimates_percentiles():
+    sketch = deadlines.LatencySketch(60)
+    for millis in range(1, 1001):
+        sketch.add(millis / 1000)
+
+    assert sketch.count() == 1000
+    assert abs(sketch.percentile(0.5) - 0.5) <= 0.5 * deadlines.SKETCH_ACCURACY
+    assert abs(sketch.percentile(0.99) - 0.99) <= 0.99 * deadlines.SKETCH_ACCURACY
+
+
+def test_timeouts_adapt_to_latencies(monkeypatch, fake_response):
+    timeouts = []
+
+    def fake_request(self, method, url, **kwargs):
+        timeouts.append(kwargs["timeout"])
+        return fake_response(content=b"{}")
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    monkeypatch.setattr(env_config, "ADAPTIVE_TIMEOUTS_ENABLED", True)
+    monkeypatch.setattr(env_config, "ADAPTIVE_TIMEOUT_MIN_SAMPLES", 5)
+    deadlines.reset()
+
+    for _ in range(6):
+        deadlines.send("GET", "https://sfmc.test/userinfo", "userinfo", 20)
+    assert timeouts[:5] == [20] * 5
+    assert timeouts[5] == env_config.ADAPTIVE_TIMEOUT_FLOOR
+
+    deadlines.send("GET", "https://sfmc.test/userinfo", "userinfo", 1)
+    assert timeouts[6] == 1
+    deadlines.reset()
+
+
+def test_calls_are_not_sent_after_the_deadline(monkeypatch, fake_response, client):
+    calls = []
+    monkeypatch.setattr(
+        "requests.Session.request",
+        lambda *args, **kwargs: calls.append(args) or fake_response(),
+    )
+    monkeypatch.setattr(env_config, "SFMC_CLIENT_TIMEOUT", 0)
+    exceeded = deadlines.exceeded_total.value(route="get_user_info", bound="deadline")
+
+    resp = client.get("/api/sfmc/userinfo")
+
+    assert resp.status_code == 504
+    assert not calls
+    assert (
+        deadlines.exceeded_total.value(route="get_user_info", bound="deadline")
+        == exceeded + 1
+    )
+
+
+def test_token_routes_answer_when_upstreams_fail(monkeypatch, app, client):
+    def fail(self, method, url, **kwargs):
+        if url.endswith("/auth"):
+            raise requests.ConnectionError("refused")
+        raise requests.ReadTimeout("timed out")
+
+    monkeypatch.setattr("requests.Session.request", fail)
+    with app.app_context():
+        signed_token = str(get_signer().sign(want_bytes("refresh_token")), "UTF-8")
+    client.set_cookie("localhost", "sfmc_refresh_token", signed_token)
+
+    assert client.post("/auth/laasie/token").status_code == 502
+    assert client.post("/oauth2/sfmc/refresh_token").status_code == 504
@@ -0,0 +1,75 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import threading
+import time
+
+import pytest
+
+from api import dns_cache, upstream
+
+
+class StubResolver:
+    # pylint: disable=missing-class-docstring,too-few-public-methods
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lookups = []
+        self.failing = False
+
+    def __call__(self, host):
+        self.lookups.append(host)
+        if self.failing:
+            raise socket.gaierror(socket.EAI_AGAIN, "temporary failure")
+        return ["127.0.0.1"], self.ttl
+
+
+def test_addresses_are_cached_for_their_ttl():
+    resolver = StubResolver(ttl=60)
+    cache = dns_cache.DNSCache(resolver, max_stale=60)
+
+    assert cache.resolve("tenant.example") == ["127.0.0.1"]
+    assert cache.resolve("tenant.example") == ["127.0.0.1"]
+    assert cache.resolve("127.0.0.2") == ["127.0.0.2"]
+    assert resolver.lookups == ["tenant.example"]
+
+
+def test_stale_entries_are_served_when_the_resolver_fails():
+    resolver = StubResolver(ttl=0)
+    cache = dns_cache.DNSCache(resolver, max_stale=60)
+    cache.resolve("tenant.example")
+
+    resolver.failing = True
+    assert cache.resolve("tenant.example") == ["127.0.0.1"]
+    # The refresh in the background fails and the entry is kept.
+    while len(resolver.lookups) < 2:
+        time.sleep(0.01)
+    assert cache.resolve("tenant.example") == ["127.0.0.1"]
+
+    with pytest.raises(socket.gaierror):
+        cache.resolve("other.example")
+
+
+def test_upstream_connections_use_the_cache(monkeypatch):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    resolver = StubResolver()
+    monkeypatch.setattr(dns_cache, "_cache", dns_cache.DNSCache(resolver, 60))
+    upstream.reset()
+    try:
+        url = f"http://mcmb4wk3d.rest.invalid:{server.server_port}/"
+        resp = upstream.get_session().get(url, timeout=5)
+    finally:
+        upstream.reset()
+        server.shutdown()
+
+    assert resp.content == b"ok"
+    assert resolver.lookups == ["mcmb4wk3d.rest.invalid"]
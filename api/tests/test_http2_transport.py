@@ -0,0 +1,22 @@
+import pytest
+
+from api import env_config, http2_transport, upstream
+
+pytest.importorskip("httpx")
+
+
+def test_only_the_selected_upstreams_use_http2(monkeypatch):
+    monkeypatch.setattr(env_config, "UPSTREAM_HTTP2", ["sfmc_rest"])
+    session = upstream.UpstreamSession()
+    try:
+        rest_adapter = session.get_adapter(
+            "https://mcmb4wk3d.rest.marketingcloudapis.com/asset/v1/content/assets"
+        )
+        auth_adapter = session.get_adapter(
+            "https://mcmb4wk3d.auth.marketingcloudapis.com/v2/userinfo"
+        )
+    finally:
+        session.close()
+
+    assert isinstance(rest_adapter, http2_transport.HTTP2Adapter)
+    assert isinstance(auth_adapter, upstream.UpstreamAdapter)
@@ -0,0 +1,39 @@
+import pytest
+import requests
+
+from api import json_codec
+
+
+@pytest.mark.parametrize("name", sorted(json_codec.CODECS))
+def test_codecs_serialize_canonically(name):
+    codec = json_codec.get_codec(name)
+    assert codec.loads(b'{"b": [1, 2.5, null], "a": "\\u00e9"}') == {
+        "b": [1, 2.5, None],
+        "a": "é",
+    }
+    assert codec.dumps_canonical({"b": 1, "a": {"d": 2, "c": 3}}) == (
+        b'{"a":{"c":3,"d":2},"b":1}'
+    )
+    with pytest.raises(ValueError):
+        codec.loads(b'{"a": ')
+
+
+def test_laasie_payload_is_forwarded_as_is(monkeypatch, fake_response, client):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append(kwargs)
+        return fake_response()
+
+    monkeypatch.setattr(requests.Session, "request", fake_request)
+    payload = b'{ "clientId": "abc",  "clientSecret": "def" }'
+
+    resp = client.post(
+        "/api/laasie/sfmc", data=payload, content_type="application/json"
+    )
+    assert resp.status_code == 200
+    assert calls[0]["data"] == payload
+
+    resp = client.post("/api/laasie/sfmc", data=b"{", content_type="application/json")
+    assert resp.status_code == 400
+    assert len(calls) == 1
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+import requests
+
+from api import session_store
+from api.laasie_spool import LaasieSpool
+
+
+@pytest.fixture(name="session_id")
+def fixture_session_id(tmp_path, monkeypatch):
+    """
+    Returns the id of a server-side session with a valid access token.
+    """
+    store = session_store.SessionStore(str(tmp_path / "sessions.sqlite3"), 60)
+    monkeypatch.setattr(session_store, "_store", store)
+    return store.create(
+        {"access_token": "token", "access_token_expires_at": time.time() + 60}
+    )
+
+
+def test_pending_payloads_are_deduplicated_per_tenant(
+    tmp_path, monkeypatch, fake_response, session_id
+):
+    delivered = []
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda self, method, url, **kwargs: delivered.append(
+            (kwargs["headers"]["Authorization"], kwargs["data"])
+        )
+        or fake_response(200),
+    )
+    spool = LaasieSpool(str(tmp_path / "spool.sqlite3"))
+    spool.start = lambda: None  # Deliver synchronously in the test.
+    spool.enqueue("tenant-a", "https://laasie.test/sfmc", session_id, b'{"v": 1}')
+    spool.enqueue("tenant-a", "https://laasie.test/sfmc", session_id, b'{"v": 2}')
+    spool.enqueue("tenant-b", "https://laasie.test/sfmc", session_id, b'{"v": 3}')
+    assert spool.depth() == 2
+
+    assert spool.deliver_batch() == 2
+    assert delivered == [("Bearer token", b'{"v": 2}'), ("Bearer token", b'{"v": 3}')]
+    assert spool.depth() == 0
+
+
+def test_failed_delivery_is_retried_later(
+    tmp_path, monkeypatch, fake_response, session_id
+):
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda self, method, url, **kwargs: fake_response(503),
+    )
+    spool = LaasieSpool(str(tmp_path / "spool.sqlite3"))
+    spool.start = lambda: None
+    spool.enqueue("tenant-a", "https://laasie.test/sfmc", session_id, b"{}")
+
+    assert spool.deliver_batch() == 1
+    assert spool.depth() == 1
+    # The entry is backing off, so it is not due yet.
+    assert spool.deliver_batch() == 0
+
+
+def test_payloads_of_expired_sessions_are_dropped(tmp_path, monkeypatch, session_id):
+    calls = []
+    monkeypatch.setattr(
+        requests.Session, "request", lambda *args, **kwargs: calls.append(args)
+    )
+    spool = LaasieSpool(str(tmp_path / "spool.sqlite3"))
+    spool.start = lambda: None
+    spool.enqueue("tenant-a", "https://laasie.test/sfmc", session_id, b"{}")
+    session_store.get_store().update(
+        session_id, {"access_token_expires_at": time.time() - 1}
+    )
+
+    assert spool.deliver_batch() == 1
+    assert spool.depth() == 0
+    assert not calls
+
+
+def test_failed_payloads_are_answered_with_502_or_504(monkeypatch, client):
+    def fail(self, method, url, **kwargs):
+        if kwargs["data"] == b'{"v": 1}':
+            raise requests.ConnectionError("refused")
+        raise requests.ReadTimeout("timed out")
+
+    monkeypatch.setattr(requests.Session, "request", fail)
+
+    for body, status in ((b'{"v": 1}', 502), (b'{"v": 2}', 504)):
+        resp = client.post(
+            "/api/laasie/sfmc", data=body, content_type="application/json"
+        )
+        assert resp.status_code == status
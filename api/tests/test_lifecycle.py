@@ -0,0 +1,30 @@
+import logging
+
+from api import lifecycle, response_cache, upstream
+from api.app_logger import get_logger
+
+
+def test_after_fork_recreates_per_process_resources():
+    session = upstream.get_session()
+    response_cache.put(("scope", "url", "", ""), 200, "application/json", b"{}")
+
+    lifecycle.after_fork()
+
+    assert upstream.get_session() is not session
+    assert response_cache.get(("scope", "url", "", "")) is None
+
+
+def test_after_fork_replaces_the_log_handlers():
+    logger = get_logger("test-lifecycle")
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    stale = logging.NullHandler()
+    logger.addHandler(stale)
+    handler = logging.NullHandler()
+    gunicorn_logger.addHandler(handler)
+    try:
+        lifecycle.after_fork()
+
+        assert stale not in logger.handlers
+        assert handler in logger.handlers
+    finally:
+        gunicorn_logger.removeHandler(handler)
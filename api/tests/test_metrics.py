@@ -0,0 +1,13 @@
+from api import env_config
+
+
+def test_metrics_are_only_served_to_the_bearer_of_the_token(monkeypatch, client):
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(env_config, "METRICS_TOKEN", "scraper-token")
+    denied = client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+    allowed = client.get("/metrics", headers={"Authorization": "Bearer scraper-token"})
+
+    assert denied.status_code == 401
+    assert allowed.status_code == 200
+    assert b"# TYPE" in allowed.data
@@ -0,0 +1,49 @@
+import time
+
+from api import persistent_cache, response_cache
+
+CATEGORIES_URL = "/api/sfmc/asset/v1/content/categories"
+
+
+def test_cached_responses_survive_a_restart(
+    monkeypatch, tmp_path, fake_response, client
+):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append(url)
+        return fake_response(content=b'{"count": 0, "items": []}')
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    monkeypatch.setattr(persistent_cache, "_cache", None)
+    persistent_cache.init_cache(str(tmp_path))
+    response_cache.clear()
+    try:
+        assert client.get(CATEGORIES_URL).json == {"count": 0, "items": []}
+        # A new process starts with an empty memory cache.
+        response_cache.clear()
+        assert client.get(CATEGORIES_URL).json == {"count": 0, "items": []}
+        assert len(calls) == 1
+
+        client.post("/api/sfmc/asset/v1/content/categories", json={"name": "New"})
+        response_cache.clear()
+        client.get(CATEGORIES_URL)
+        assert len(calls) == 3
+    finally:
+        monkeypatch.setattr(persistent_cache, "_cache", None)
+        response_cache.clear()
+
+
+def test_entries_expire_and_are_evicted_by_size(tmp_path):
+    cache = persistent_cache.PersistentCache(str(tmp_path / "cache.sqlite3"), 8)
+    cache.put("response", "short", "scope", "/a", {}, b"12345", 0.05)
+    cache.put("response", "long", "scope", "/b", {}, b"123456", 60)
+    assert cache.get("response", "short").content == b"12345"
+    time.sleep(0.1)
+    assert cache.get("response", "short") is None
+
+    cache.put("response", "longer", "scope", "/c", {}, b"1234", 120)
+    cache.evict()
+    assert cache.get("response", "long") is None
+    assert cache.get("response", "longer").ttl > 60
+    assert cache.size() == 4
@@ -0,0 +1,118 @@
+import json
+
+import pytest
+
+from api import projection
+
+LISTING = {
+    "count": 2,
+    "page": 1,
+    "pageSize": 50,
+    "items": [
+        {
+            "id": i,
+            "name": f"Block {i}",
+            "content": "<p>é</p>" * 100,
+            "category": {"id": 1, "name": "Laasie"},
+        }
+        for i in (1, 2)
+    ],
+    "links": {},
+}
+
+
+def test_listing_is_projected_across_chunk_boundaries():
+    data = json.dumps(LISTING, indent=1).encode()
+    fields = projection.parse_fields("id,category.name,missing")
+    for size in (1, 7, len(data)):
+        projected = json.loads(
+            b"".join(projection.project_listing(chunked(data, size), fields))
+        )
+        assert projected == {
+            **LISTING,
+            "items": [
+                {"id": 1, "category": {"name": "Laasie"}},
+                {"id": 2, "category": {"name": "Laasie"}},
+            ],
+        }
+
+
+def chunked(data, size):
+    return (data[i : i + size] for i in range(0, len(data), size))
+
+
+def test_numbers_split_across_chunks_are_decoded_whole():
+    listing = {
+        "count": 12345,
+        "ratio": 1.5,
+        "items": [{"id": 1, "score": 1.5, "weight": -3.25e-2}, 2.5, -4e-3],
+        "scale": -3.25e-2,
+    }
+    data = json.dumps(listing, separators=(",", ":")).encode()
+    fields = projection.parse_fields("score,weight")
+    for size in range(1, len(data) + 1):
+        projected = b"".join(projection.project_listing(chunked(data, size), fields))
+        assert json.loads(projected) == {
+            **listing,
+            "items": [{"score": 1.5, "weight": -3.25e-2}, 2.5, -4e-3],
+        }
+
+
+def test_items_are_decoded_once_whatever_their_chunks(monkeypatch):
+    item = {"id": 1, "content": 'a "quoted" \\ {[}] "', "nested": [{"b": "}"}, []]}
+    data = json.dumps({"items": [item, item]}).encode()
+    fields = projection.parse_fields("content,nested")
+    decoded = []
+    raw_decode = json.JSONDecoder.raw_decode
+    monkeypatch.setattr(
+        json.JSONDecoder,
+        "raw_decode",
+        lambda self, text, idx=0: decoded.append(idx) or raw_decode(self, text, idx),
+    )
+    for size in range(1, len(data) + 1):
+        decoded.clear()
+        projected = b"".join(projection.project_listing(chunked(data, size), fields))
+        # The "items" key and each of the two items.
+        assert len(decoded) == 3
+        expected = {"content": item["content"], "nested": item["nested"]}
+        assert json.loads(projected) == {"items": [expected, expected]}
+
+
+def test_truncated_listings_are_rejected():
+    data = json.dumps(LISTING).encode()
+    fields = projection.parse_fields("id")
+    for end in (1, len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError):
+            b"".join(projection.project_listing(chunked(data[:end], 7), fields))
+
+
+def test_listings_that_cant_be_projected_are_returned_whole(
+    monkeypatch, fake_response, client
+):
+    truncated = json.dumps(LISTING).encode()[:-20]
+    monkeypatch.setattr(
+        "requests.Session.request",
+        lambda *args, **kwargs: fake_response(content=truncated),
+    )
+    resp = client.get("/api/sfmc/asset/v1/content/assets?fields=id")
+
+    assert resp.status_code == 200
+    assert resp.get_data() == truncated
+
+
+def test_fields_param_is_not_forwarded(monkeypatch, fake_response, client):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append(kwargs["params"])
+        return fake_response(content=json.dumps(LISTING).encode())
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    resp = client.get("/api/sfmc/asset/v1/content/assets?$page=1&fields=id,name")
+
+    assert calls == [{"$page": "1"}]
+    assert resp.json["items"] == [
+        {"id": 1, "name": "Block 1"},
+        {"id": 2, "name": "Block 2"},
+    ]
+    assert resp.json["count"] == 2
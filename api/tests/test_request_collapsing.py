@@ -0,0 +1,70 @@
+import threading
+import time
+
+from api import request_collapsing
+
+
+def run_concurrently(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    threads[0].start()
+    # Let the first thread become the leader before the others start.
+    while not request_collapsing._flights:
+        time.sleep(0.001)
+    for thread in threads[1:]:
+        thread.start()
+    return threads
+
+
+def test_concurrent_requests_share_one_upstream_call():
+    calls = []
+    results = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return 200
+
+    def call():
+        results.append(
+            request_collapsing.collapse("key", fetch, lambda r: r < 500, timeout=5)
+        )
+
+    threads = run_concurrently(3, call)
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [200, 200, 200]
+    assert not request_collapsing._flights
+
+
+def test_a_follower_takes_over_when_the_leader_fails():
+    calls = []
+    results = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)
+            return 503
+        time.sleep(0.1)
+        return 200
+
+    def call():
+        results.append(
+            request_collapsing.collapse("key", fetch, lambda r: r < 500, timeout=5)
+        )
+
+    threads = run_concurrently(3, call)
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 2
+    assert sorted(results) == [200, 200, 503]
+    assert not request_collapsing._flights
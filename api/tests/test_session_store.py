@@ -0,0 +1,130 @@
+import time
+
+import requests
+
+from api import env_config, session_store
+from api.oauth2 import get_encoded_state_jwt
+from api.session_store import SessionStore
+
+
+def test_sessions_expire(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.sqlite3"), ttl=60)
+    session_id = store.create({"tssd": "mcmb4wk3d"})
+    assert store.get(session_id) == {"tssd": "mcmb4wk3d"}
+
+    store.ttl = -1
+    store.update(session_id, {"access_token": "token"})
+    assert store.get(session_id) is None
+
+
+def test_only_one_refresh_is_claimed(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.sqlite3"), ttl=60)
+    session_id = store.create({})
+    assert store.claim_refresh(session_id)
+    assert not store.claim_refresh(session_id)
+
+
+def test_proxy_uses_the_session_tokens(tmp_path, monkeypatch, fake_response, app):
+    store = session_store.init_store(str(tmp_path))
+    try:
+        session_id = store.create(
+            {
+                "tssd": "mcmb4wk3d",
+                "access_token": "session_token",
+                "access_token_expires_at": time.time() + 1200,
+                "refresh_token": "refresh_token",
+            }
+        )
+        calls = []
+
+        def fake_request(self, method, url, **kwargs):
+            calls.append((url, kwargs["headers"]["Authorization"]))
+            return fake_response()
+
+        monkeypatch.setattr(requests.Session, "request", fake_request)
+        client = app.test_client()
+        client.set_cookie("localhost", session_store.SESSION_ID_COOKIE_NAME, session_id)
+        resp = client.get("/api/sfmc/asset/v1/content/assets")
+
+        assert resp.status_code == 200
+        assert calls == [
+            (
+                "https://mcmb4wk3d.rest.marketingcloudapis.com/asset/v1/content/assets",
+                "Bearer session_token",
+            )
+        ]
+        client.set_cookie("localhost", session_store.SESSION_ID_COOKIE_NAME, "unknown")
+        assert client.get("/api/sfmc/asset/v1/content/assets").status_code == 401
+    finally:
+        session_store._store = None  # pylint: disable=protected-access
+
+
+def test_refresh_tokens_are_exchanged_once(tmp_path, monkeypatch, fake_response, app):
+    store = session_store.init_store(str(tmp_path))
+    try:
+        session_id = store.create(
+            {
+                "tssd": "mcmb4wk3d",
+                "access_token": "session_token",
+                "access_token_expires_at": time.time() + 600,
+                "refresh_token": "refresh_token",
+            }
+        )
+        calls = []
+
+        def fake_request(self, method, url, **kwargs):
+            calls.append(kwargs["json"]["refresh_token"])
+            return fake_response(
+                content=b'{"access_token": "new_token", "expires_in": 1080,'
+                b' "refresh_token": "new_refresh_token", "scope": "",'
+                b' "token_type": "Bearer", "rest_instance_url": "",'
+                b' "soap_instance_url": ""}'
+            )
+
+        monkeypatch.setattr(requests.Session, "request", fake_request)
+        client = app.test_client()
+        client.set_cookie("localhost", session_store.SESSION_ID_COOKIE_NAME, session_id)
+        # Another request is refreshing the session.
+        assert store.claim_refresh(session_id)
+        assert client.post("/oauth2/sfmc/refresh_token").status_code == 200
+        assert not calls
+
+        store.update(session_id, {})
+        assert client.post("/oauth2/sfmc/refresh_token").status_code == 200
+        assert calls == ["refresh_token"]
+        assert store.get(session_id)["refresh_token"] == "new_refresh_token"
+    finally:
+        session_store._store = None  # pylint: disable=protected-access
+
+
+def test_logins_start_a_new_session(tmp_path, monkeypatch, fake_response, app):
+    store = session_store.init_store(str(tmp_path))
+    try:
+        planted_id = store.create({"tssd": "mcmb4wk3d"})
+        monkeypatch.setattr(env_config, "WARMUP_ENABLED", False)
+        monkeypatch.setattr(
+            requests.Session,
+            "request",
+            lambda *args, **kwargs: fake_response(
+                content=b'{"access_token": "new_token", "expires_in": 1080,'
+                b' "refresh_token": "new_refresh_token", "scope": "",'
+                b' "token_type": "Bearer", "rest_instance_url": "",'
+                b' "soap_instance_url": ""}'
+            ),
+        )
+        client = app.test_client()
+        client.set_cookie("localhost", session_store.SESSION_ID_COOKIE_NAME, planted_id)
+        state = get_encoded_state_jwt(env_config.JWT_SECRET)
+        resp = client.get(f"/oauth2/sfmc/callback?code=code&state={state}")
+
+        assert resp.status_code == 302
+        session_id = next(
+            cookie.split(";")[0].split("=", 1)[1]
+            for cookie in resp.headers.getlist("Set-Cookie")
+            if cookie.startswith(f"{session_store.SESSION_ID_COOKIE_NAME}=")
+        )
+        assert session_id != planted_id
+        assert store.get(planted_id) is None
+        assert store.get(session_id)["access_token"] == "new_token"
+    finally:
+        session_store._store = None  # pylint: disable=protected-access
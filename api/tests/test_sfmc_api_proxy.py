@@ -0,0 +1,82 @@
+import requests
+
+from api import env_config, response_cache
+
+
+def test_request_body_is_streamed_upstream(monkeypatch, fake_response, client):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        body = kwargs["data"]
+        calls.append((url, len(body), body.read(), kwargs["headers"]))
+        return fake_response(status_code=201)
+
+    monkeypatch.setattr(requests.Session, "request", fake_request)
+    payload = b'{"content": "<p>hello</p>"}'
+    resp = client.post(
+        "/api/sfmc/asset/v1/content/assets",
+        data=payload,
+        content_type="application/json",
+    )
+
+    assert resp.status_code == 201
+    url, length, body, headers = calls[0]
+    assert (
+        url == "https://mcmb4wk3d.rest.marketingcloudapis.com/asset/v1/content/assets"
+    )
+    assert length == len(payload)
+    assert body == payload
+    assert headers["Content-Type"] == "application/json"
+
+
+def test_request_body_over_limit_is_rejected(monkeypatch, client):
+    monkeypatch.setattr(env_config, "MAX_PROXY_BODY_SIZE", 8)
+    monkeypatch.setattr(requests.Session, "request", lambda *args, **kwargs: None)
+    resp = client.post(
+        "/api/sfmc/asset/v1/content/assets",
+        data=b'{"content": "too large"}',
+        content_type="application/json",
+    )
+
+    assert resp.status_code == 413
+
+
+def test_cached_responses_are_served_without_upstream_calls(
+    monkeypatch, fake_response, client
+):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append((method, url))
+        return fake_response(content=b'{"items": []}')
+
+    monkeypatch.setattr(requests.Session, "request", fake_request)
+    response_cache.clear()
+    first = client.get("/api/sfmc/asset/v1/content/categories")
+    second = client.get("/api/sfmc/asset/v1/content/categories")
+
+    assert first.data == second.data == b'{"items": []}'
+    assert len(calls) == 1
+
+
+def test_only_idempotent_routes_are_retried(monkeypatch, fake_response, client):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append(method)
+        return fake_response(status_code=503 if len(calls) == 1 else 200)
+
+    monkeypatch.setattr(env_config, "UPSTREAM_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(requests.Session, "request", fake_request)
+
+    assert client.get("/api/sfmc/asset/v1/content/assets").status_code == 200
+    assert calls == ["GET", "GET"]
+
+    calls.clear()
+    resp = client.post(
+        "/api/sfmc/asset/v1/content/assets",
+        data=b"{}",
+        content_type="application/json",
+    )
+    assert resp.status_code == 503
+    assert calls == ["POST"]
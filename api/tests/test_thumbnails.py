@@ -0,0 +1,54 @@
+import base64
+
+from api import thumbnails
+from api.tools.stub_upstream import make_png
+
+THUMBNAIL_URL = "/api/sfmc/asset/v1/assets/42/thumbnail/image"
+
+
+def test_thumbnail_is_resized_and_negotiated(monkeypatch, fake_response, client):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append(url)
+        return fake_response(content=base64.b64encode(make_png(320, 240)))
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    thumbnails.clear()
+
+    resp = client.get(f"{THUMBNAIL_URL}?w=150", headers={"Accept": "image/*"})
+    assert resp.status_code == 200
+    # Without Pillow, the image is served as it is.
+    assert resp.content_type == (
+        "image/jpeg" if thumbnails.Image is not None else "image/png"
+    )
+    assert resp.headers["Vary"] == "Accept"
+    assert calls == [
+        "https://mcmb4wk3d.rest.marketingcloudapis.com/asset/v1/assets/42/thumbnail"
+    ]
+
+    # The width is rounded up to 160, which is cached with the same ETag.
+    resp = client.get(
+        f"{THUMBNAIL_URL}?w=160",
+        headers={"Accept": "image/*", "If-None-Match": resp.headers["ETag"]},
+    )
+    assert resp.status_code == 304
+    assert len(calls) == 1
+
+    if thumbnails.can_encode("webp"):
+        resp = client.get(
+            f"{THUMBNAIL_URL}?w=160", headers={"Accept": "image/webp,image/*"}
+        )
+        assert resp.content_type == "image/webp"
+
+
+def test_invalid_thumbnail_is_a_bad_gateway(monkeypatch, fake_response, client):
+    monkeypatch.setattr(
+        "requests.Session.request",
+        lambda *args, **kwargs: fake_response(content=b"not base64!"),
+    )
+    thumbnails.clear()
+
+    resp = client.get(THUMBNAIL_URL)
+
+    assert resp.status_code == 502
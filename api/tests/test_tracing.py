@@ -0,0 +1,55 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from api import env_config, tracing, upstream
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+
+def test_invalid_traceparent_starts_a_new_trace():
+    trace = tracing.parse_traceparent(f"00-{TRACE_ID}-{'0' * 16}-01")
+    assert trace.trace_id != TRACE_ID
+    assert trace.parent_id is None
+
+
+def test_phases_are_reported_and_trace_context_is_propagated(monkeypatch, client):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            received.append(self.headers["traceparent"])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        env_config, "SFMC_REST_BASE_URL", f"http://127.0.0.1:{server.server_port}"
+    )
+    upstream.reset()
+    try:
+        resp = client.get(
+            "/api/sfmc/asset/v1/content/assets",
+            headers={"traceparent": f"00-{TRACE_ID}-00f067aa0ba902b7-01"},
+        )
+        resp.get_data()
+    finally:
+        upstream.reset()
+        server.shutdown()
+
+    assert resp.status_code == 200
+    phases = [m.split(";")[0] for m in resp.headers["Server-Timing"].split(", ")]
+    # Admission control is disabled, so there is no "queue" phase.
+    assert phases[0] == "verify"
+    assert {"dns", "connect", "ttfb", "after", "total"} <= set(phases)
+    _, trace_id, parent_id, flags = received[0].split("-")
+    assert (trace_id, flags) == (TRACE_ID, "01")
+    assert parent_id != "00f067aa0ba902b7"
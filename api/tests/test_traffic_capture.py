@@ -0,0 +1,79 @@
+import base64
+
+from api import env_config, response_cache, thumbnails, traffic_capture
+from api.tools.stub_upstream import make_png
+
+
+def test_proxied_calls_are_captured_without_secrets(
+    monkeypatch, tmp_path, fake_response, client
+):
+    monkeypatch.setattr(
+        "requests.Session.request",
+        lambda *args, **kwargs: fake_response(content=b'{"id": 42}'),
+    )
+    monkeypatch.setattr(env_config, "CAPTURE_FILE", str(tmp_path / "capture.ndjson"))
+    capture = traffic_capture.init_capture(str(tmp_path))
+    try:
+        resp = client.patch(
+            "/api/sfmc/asset/v1/content/assets/42",
+            data=b'{"content": "<p>secret</p>"}',
+            content_type="application/json",
+        )
+        assert resp.data == b'{"id": 42}'
+        # The records are written once the responses are closed.
+        resp.close()
+        client.get(
+            "/api/sfmc/asset/v1/content/assets?$filter=customerKey eq 'k'"
+        ).close()
+    finally:
+        capture.close()
+        monkeypatch.setattr(traffic_capture, "_capture", None)
+
+    records = list(traffic_capture.read_records(capture.path))
+    assert [record.route for record in records] == ["update_asset", "filter_assets"]
+    assert records[0].status == 200
+    assert records[0].request_bytes == 28
+    # The streamed response is counted as it is sent.
+    assert records[0].response_bytes == 10
+    assert records[0].tenant == records[1].tenant != "mcmb4wk3d"
+
+    captured = (tmp_path / "capture.ndjson").read_text()
+    for secret in ("mcmb4wk3d", "token", "secret", "customerKey"):
+        assert secret not in captured
+
+
+def test_calls_outside_the_proxied_routes_are_captured(
+    monkeypatch, tmp_path, fake_response, client
+):
+    def fake_request(self, method, url, **kwargs):
+        if url.endswith("/thumbnail"):
+            return fake_response(content=base64.b64encode(make_png(32, 24)))
+        return fake_response(content=b'{"count": 0, "items": []}')
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    monkeypatch.setattr(env_config, "CAPTURE_FILE", str(tmp_path / "capture.ndjson"))
+    response_cache.clear()
+    thumbnails.clear()
+    capture = traffic_capture.init_capture(str(tmp_path))
+    try:
+        client.get("/api/sfmc/asset/v1/assets/42/thumbnail/image").close()
+        client.post(
+            "/api/sfmc/batch",
+            json={"requests": [{"id": "c", "path": "/asset/v1/content/categories"}]},
+        ).close()
+        client.post(
+            "/api/laasie/sfmc", data=b'{"a": 1}', content_type="application/json"
+        ).close()
+    finally:
+        capture.close()
+        monkeypatch.setattr(traffic_capture, "_capture", None)
+
+    records = list(traffic_capture.read_records(capture.path))
+    assert [record.route for record in records] == [
+        "get_thumbnail_image",
+        "list_categories",
+        "laasie_sfmc_payload",
+    ]
+    assert [record.status for record in records] == [200, 200, 200]
+    assert records[1].response_bytes == 25
+    assert records[2].request_bytes == 8
@@ -0,0 +1,120 @@
+import json
+import time
+
+from api import env_config, unchanged_writes
+from api.proxy_engine import ProxyRequest, UpstreamResponse
+from api.sfmc_api_proxy import ROUTES_BY_NAME
+
+ASSET_URL = "/api/sfmc/asset/v1/content/assets/42"
+ASSET = {"id": 42, "customerKey": "laasie-42", "name": "Block", "content": "<p>1</p>"}
+
+
+def make_request(route_name, **kwargs):
+    return ProxyRequest(
+        route=ROUTES_BY_NAME[route_name],
+        tenant_subdomain="mcmb4wk3d",
+        access_token="fake_token",
+        **kwargs,
+    )
+
+
+def look_up(asset):
+    unchanged_writes.record_listing(
+        make_request("filter_assets"),
+        UpstreamResponse(
+            200,
+            "application/json",
+            json.dumps({"count": 1, "items": [asset]}).encode(),
+        ),
+    )
+
+
+def update(fields, **kwargs):
+    return make_request(
+        "update_asset",
+        path_args={"asset_id": "42"},
+        body=json.dumps(fields).encode(),
+        **kwargs,
+    )
+
+
+def test_updates_are_streamed_and_sent_by_default(monkeypatch, fake_response, client):
+    patches = []
+
+    def fake_request(self, method, url, **kwargs):
+        if method == "PATCH":
+            patches.append(json.loads(kwargs["data"].read()))
+            return fake_response(content=json.dumps(ASSET).encode())
+        return fake_response(
+            content=json.dumps({"count": 1, "items": [ASSET]}).encode()
+        )
+
+    monkeypatch.setattr("requests.Session.request", fake_request)
+    unchanged_writes.reset()
+
+    assert not env_config.SKIP_UNCHANGED_WRITES
+    assert ROUTES_BY_NAME["update_asset"].streaming
+    client.get("/api/sfmc/asset/v1/content/assets?$filter=customerKey eq 'laasie-42'")
+    resp = client.patch(ASSET_URL, json={"content": "<p>1</p>"})
+    assert "X-Write-Skipped" not in resp.headers
+    assert patches == [{"content": "<p>1</p>"}]
+
+
+def test_unchanged_update_is_skipped(app):
+    unchanged_writes.reset()
+    skipped = unchanged_writes.writes_total.value(result="skipped")
+
+    look_up(ASSET)
+    resp = unchanged_writes.skip_unchanged(update({"content": "<p>1</p>"}))
+    assert resp.status_code == 200
+    assert resp.headers["X-Write-Skipped"] == "unchanged"
+    assert json.loads(resp.content) == {"id": 42}
+    assert unchanged_writes.writes_total.value(result="skipped") == skipped + 1
+
+    with app.test_request_context(headers={"X-Force-Write": "true"}):
+        assert unchanged_writes.skip_unchanged(update({"content": "<p>1</p>"})) is None
+    assert (
+        unchanged_writes.skip_unchanged(
+            update({"content": "<p>1</p>"}, force_write=True)
+        )
+        is None
+    )
+
+    # A change is sent, then a repeat of it is skipped.
+    changed = update({"content": "<p>2</p>"})
+    assert unchanged_writes.skip_unchanged(changed) is None
+    unchanged_writes.record_write(
+        changed,
+        UpstreamResponse(
+            200,
+            "application/json",
+            json.dumps({**ASSET, "content": "<p>2</p>"}).encode(),
+        ),
+    )
+    assert unchanged_writes.skip_unchanged(update({"content": "<p>2</p>"}))
+    assert (
+        unchanged_writes.skip_unchanged(
+            update({"name": "Renamed", "content": "<p>2</p>"})
+        )
+        is None
+    )
+
+
+def test_updates_are_sent_once_the_lookup_is_too_old(monkeypatch):
+    monkeypatch.setattr(env_config, "UNCHANGED_WRITE_TTL", 0.05)
+    unchanged_writes.reset()
+
+    look_up(ASSET)
+    time.sleep(0.1)
+    # The asset may have been changed in SFMC since the lookup.
+    assert unchanged_writes.skip_unchanged(update({"content": "<p>1</p>"})) is None
+
+
+def test_failed_updates_forget_the_asset():
+    unchanged_writes.reset()
+
+    look_up(ASSET)
+    unchanged_writes.record_write(
+        update({"content": "<p>1</p>"}), UpstreamResponse(500, "application/json", b"")
+    )
+    assert unchanged_writes.skip_unchanged(update({"content": "<p>1</p>"})) is None
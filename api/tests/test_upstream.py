@@ -0,0 +1,33 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from api import upstream
+
+
+def test_response_cookies_are_not_sent_on_later_calls():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            received.append(self.headers.get("Cookie"))
+            self.send_response(200)
+            self.send_header("Set-Cookie", "sid=first-user; Path=/")
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    upstream.reset()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/"
+        upstream.get_session().get(url, timeout=5)
+        upstream.get_session().get(url, timeout=5)
+    finally:
+        upstream.reset()
+        server.shutdown()
+
+    assert received == [None, None]
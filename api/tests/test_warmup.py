@@ -0,0 +1,37 @@
+import requests
+
+from api import response_cache, warmup
+
+
+def test_warmup_prefetches_into_the_response_cache(monkeypatch, fake_response):
+    fetched = []
+
+    def fake_request(self, method, url, **kwargs):
+        fetched.append(url)
+        return fake_response(content=url.encode())
+
+    monkeypatch.setattr(requests.Session, "request", fake_request)
+    response_cache.clear()
+
+    job = warmup.schedule("mcmb4wk3d", "warm_token")
+    assert job is not None and job.future is not None
+    job.future.result(timeout=5)
+
+    assert len(fetched) == 3
+    for _, url, body in warmup.get_warmup_requests("mcmb4wk3d"):
+        cached = response_cache.get(
+            response_cache.make_key("warm_token", url, body=body)
+        )
+        assert cached is not None and cached.content == url.encode()
+
+
+def test_cancelled_warmup_does_not_fetch(monkeypatch):
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda *args, **kwargs: (_ for _ in ()).throw(AssertionError("fetched")),
+    )
+    job = warmup.WarmupJob()
+    job.cancelled.set()
+    # pylint: disable-next=protected-access
+    warmup._run(job, "scope", "mcmb4wk3d", "cancelled_token")
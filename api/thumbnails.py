@@ -0,0 +1,372 @@
+"""
+Asset thumbnails served as resized images.
+
+SFMC returns the thumbnail of an asset as a base64 string, which is a
+third larger than the image, can't be cached by the browser as an image
+and is usually much larger than the size it is shown at. The thumbnail
+image route decodes it once, resizes it to fit the requested width and
+height, and encodes it in the most compact format the browser accepts:
+AVIF or WebP when Pillow can encode them, JPEG otherwise. The encoded
+variants are kept in a cache bounded by size and scoped to the access
+token, like the response cache, and in the disk-backed cache, when it
+is enabled, for `THUMBNAIL_MAX_AGE` seconds. They are sent with an ETag
+so that browsers revalidate them instead of downloading them again.
+
+Without Pillow, the decoded image is served as it is.
+"""
+import base64
+import binascii
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import functools
+import hashlib
+import io
+import json
+import threading
+import time
+from typing import Any, Optional
+
+from flask import make_response, request as flask_request
+from flask.wrappers import Response as FlaskResponse
+import requests
+from werkzeug.datastructures import MIMEAccept
+
+from api import metrics, persistent_cache, proxy_engine, response_cache
+from api.app_logger import get_logger
+from . import env_config
+
+try:
+    from PIL import Image, features  # type: ignore
+except ImportError:
+    Image = None  # pylint: disable=invalid-name
+
+logger = get_logger("thumbnails")
+
+if Image is None:
+    logger.warning(
+        "Pillow is not installed. Thumbnails are served as SFMC stores them,"
+        " without resizing them."
+    )
+
+# Requested sizes are rounded up to a multiple of this, to bound the
+# number of variants of a thumbnail.
+SIZE_STEP = 16
+FALLBACK_FORMAT = "jpeg"
+SNIFFED_CONTENT_TYPES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+)
+
+thumbnails_total = metrics.counter(
+    "thumbnails_total", "Thumbnail images served by format and cache result."
+)
+thumbnail_bytes_total = metrics.counter(
+    "thumbnail_bytes_total",
+    "Bytes of thumbnails received from SFMC (upstream) and sent (served).",
+)
+transcode_duration = metrics.histogram(
+    "thumbnail_transcode_duration_seconds",
+    "Time taken to resize and encode thumbnails.",
+)
+
+
+@dataclass(frozen=True)
+class ImageFormat:
+    """
+    A format that thumbnails are encoded in.
+    """
+
+    pillow_format: str
+    content_type: str
+    options: dict[str, Any] = field(default_factory=dict)
+
+
+FORMATS = {
+    "avif": ImageFormat("AVIF", "image/avif", {"quality": 50}),
+    "webp": ImageFormat("WEBP", "image/webp", {"quality": 75}),
+    "jpeg": ImageFormat(
+        "JPEG", "image/jpeg", {"quality": 80, "optimize": True, "progressive": True}
+    ),
+}
+
+
+@dataclass
+class Thumbnail:
+    """
+    An encoded thumbnail.
+    """
+
+    content: bytes
+    content_type: str
+    etag: str
+
+
+ThumbnailKey = tuple[str, str, Optional[int], Optional[int], str]
+
+# The namespace of the thumbnails in the disk-backed cache.
+PERSISTENT_NAMESPACE = "thumbnail"
+
+_lock = threading.Lock()
+_entries: "OrderedDict[ThumbnailKey, Thumbnail]" = OrderedDict()
+_size = 0
+
+
+@functools.lru_cache(maxsize=None)
+def can_encode(format_name: str) -> bool:
+    """
+    Returns whether Pillow can encode images in the format.
+    """
+    if Image is None:
+        return False
+    return format_name == FALLBACK_FORMAT or bool(features.check(format_name))
+
+
+def get_size(value: Optional[str]) -> Optional[int]:
+    """
+    Returns a requested width or height rounded up to a multiple of
+    `SIZE_STEP`, or None if it is missing or invalid.
+    """
+    if value is None or not value.isdigit() or int(value) == 0:
+        return None
+    size = -(-int(value) // SIZE_STEP) * SIZE_STEP
+    return min(size, env_config.THUMBNAIL_MAX_SIZE)
+
+
+def negotiate_format(accept: MIMEAccept) -> str:
+    """
+    Returns the preferred format that the browser explicitly accepts,
+    or JPEG. Wildcards aren't taken as support for newer formats.
+    """
+    accepted = {value for value, quality in accept if quality > 0}
+    for name in env_config.THUMBNAIL_FORMATS:
+        image_format = FORMATS.get(name)
+        if (
+            image_format is not None
+            and image_format.content_type in accepted
+            and can_encode(name)
+        ):
+            return name
+    return FALLBACK_FORMAT
+
+
+def sniff_content_type(data: bytes) -> str:
+    """
+    Returns the content type of an encoded image.
+    """
+    for signature, content_type in SNIFFED_CONTENT_TYPES:
+        if data.startswith(signature):
+            return content_type
+    return "application/octet-stream"
+
+
+def decode_base64(content: bytes) -> bytes:
+    """
+    Decodes the base64 string returned by SFMC, which may be quoted.
+    Raises `ValueError` if it isn't valid base64.
+    """
+    try:
+        return base64.b64decode(content.strip().strip(b'"'), validate=True)
+    except binascii.Error as ex:
+        raise ValueError(str(ex)) from ex
+
+
+def transcode(
+    data: bytes, width: Optional[int], height: Optional[int], format_name: str
+) -> bytes:
+    """
+    Returns the image resized to fit within the width and height,
+    keeping its aspect ratio, and encoded in the format. Images are
+    never enlarged. Raises `ValueError` if the image can't be decoded.
+    """
+    image_format = FORMATS[format_name]
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            size = (width or image.width, height or image.height)
+            image.draft("RGB", size)
+            image.thumbnail(size)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            if image.mode == "RGBA" and format_name == "jpeg":
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            output = io.BytesIO()
+            image.save(output, image_format.pillow_format, **image_format.options)
+    except (OSError, Image.DecompressionBombError) as ex:
+        raise ValueError(str(ex)) from ex
+    return output.getvalue()
+
+
+def make_thumbnail(
+    data: bytes, width: Optional[int], height: Optional[int], format_name: str
+) -> Thumbnail:
+    """
+    Returns the thumbnail of a decoded image, transcoded if Pillow is
+    installed.
+    """
+    if Image is None:
+        content, content_type = data, sniff_content_type(data)
+    else:
+        started_at = time.monotonic()
+        content = transcode(data, width, height, format_name)
+        content_type = FORMATS[format_name].content_type
+        transcode_duration.observe(time.monotonic() - started_at)
+    return Thumbnail(content, content_type, hashlib.sha256(content).hexdigest()[:32])
+
+
+def get_persistent(key: ThumbnailKey) -> Optional[Thumbnail]:
+    """
+    Returns the thumbnail for the key from the disk-backed cache, if it
+    is enabled, and promotes it into memory.
+    """
+    cache = persistent_cache.get_cache()
+    if cache is None:
+        return None
+    stored = cache.get(PERSISTENT_NAMESPACE, json.dumps(key))
+    if stored is None:
+        return None
+    thumbnail = Thumbnail(
+        stored.content, stored.meta["content_type"], stored.meta["etag"]
+    )
+    remember(key, thumbnail)
+    return thumbnail
+
+
+def get(key: ThumbnailKey) -> Optional[Thumbnail]:
+    """
+    Returns the cached thumbnail for the key.
+    """
+    with _lock:
+        thumbnail = _entries.get(key)
+        if thumbnail is not None:
+            _entries.move_to_end(key)
+    if thumbnail is None:
+        thumbnail = get_persistent(key)
+    return thumbnail
+
+
+def remember(key: ThumbnailKey, thumbnail: Thumbnail):
+    """
+    Keeps a thumbnail in memory, evicting the least recently used ones
+    if the cache is over its size.
+    """
+    global _size  # pylint: disable=global-statement
+    if len(thumbnail.content) > env_config.THUMBNAIL_CACHE_MAX_BYTES:
+        return
+    with _lock:
+        previous = _entries.pop(key, None)
+        if previous is not None:
+            _size -= len(previous.content)
+        _entries[key] = thumbnail
+        _size += len(thumbnail.content)
+        while _size > env_config.THUMBNAIL_CACHE_MAX_BYTES:
+            _, evicted = _entries.popitem(last=False)
+            _size -= len(evicted.content)
+
+
+def put(key: ThumbnailKey, thumbnail: Thumbnail):
+    """
+    Caches a thumbnail in memory and in the disk-backed cache.
+    """
+    remember(key, thumbnail)
+    cache = persistent_cache.get_cache()
+    if cache is not None:
+        cache.put(
+            PERSISTENT_NAMESPACE,
+            json.dumps(key),
+            key[0],
+            key[1],
+            {"content_type": thumbnail.content_type, "etag": thumbnail.etag},
+            thumbnail.content,
+            env_config.THUMBNAIL_MAX_AGE,
+        )
+
+
+def clear():
+    """
+    Removes all cached thumbnails from memory.
+    """
+    global _size  # pylint: disable=global-statement
+    with _lock:
+        _entries.clear()
+        _size = 0
+
+
+def fetch_thumbnail(
+    proxy_request: proxy_engine.ProxyRequest,
+    width: Optional[int],
+    height: Optional[int],
+    format_name: str,
+) -> tuple[Optional[Thumbnail], Optional[FlaskResponse]]:
+    """
+    Fetches the base64 thumbnail from SFMC and returns it transcoded, or
+    the error response to send instead.
+    """
+    url = proxy_engine.get_upstream_url(proxy_request)
+    try:
+        upstream_resp = proxy_engine.read(proxy_request, url)
+    except requests.RequestException as ex:
+        return None, proxy_engine.get_upstream_error_response(url, ex)
+
+    if upstream_resp.status_code != 200:
+        return None, proxy_engine.make_proxy_response(
+            upstream_resp.status_code,
+            upstream_resp.content_type,
+            upstream_resp.content,
+        )
+
+    thumbnail_bytes_total.inc(len(upstream_resp.content), kind="upstream")
+    try:
+        thumbnail = make_thumbnail(
+            decode_base64(upstream_resp.content), width, height, format_name
+        )
+    except ValueError as ex:
+        logger.error("Could not decode the thumbnail from %s: %s", url, ex)
+        return None, proxy_engine.error_response(
+            502, "invalid_thumbnail", "SFMC returned a thumbnail that isn't an image."
+        )
+    return thumbnail, None
+
+
+def serve(
+    proxy_request: proxy_engine.ProxyRequest,
+    width: Optional[str] = None,
+    height: Optional[str] = None,
+) -> FlaskResponse:
+    """
+    Returns the response with the thumbnail image of an asset, resized
+    to fit the width and height, if given.
+    """
+    started_at = time.monotonic()
+    route = proxy_request.route
+    size = (get_size(width), get_size(height))
+    format_name = negotiate_format(flask_request.accept_mimetypes)
+    key = (
+        response_cache.token_scope(proxy_request.access_token),
+        proxy_request.path_args["asset_id"],
+        *size,
+        format_name if Image is not None else "",
+    )
+
+    thumbnail, cache = get(key), "hit"
+    if thumbnail is None:
+        cache = "miss"
+        thumbnail, error = fetch_thumbnail(proxy_request, *size, format_name)
+        if error is not None:
+            proxy_engine.observe(route, error.status_code, started_at)
+            return error
+        put(key, thumbnail)
+
+    resp = make_response(thumbnail.content)
+    resp.headers["Content-Type"] = thumbnail.content_type
+    resp.headers["Cache-Control"] = f"private, max-age={env_config.THUMBNAIL_MAX_AGE}"
+    resp.headers["Vary"] = "Accept"
+    resp.set_etag(thumbnail.etag)
+    resp.make_conditional(flask_request)
+    if resp.status_code == 200:
+        thumbnail_bytes_total.inc(len(thumbnail.content), kind="served")
+    thumbnails_total.inc(format=thumbnail.content_type, cache=cache)
+    proxy_engine.observe(route, resp.status_code, started_at)
+    return resp
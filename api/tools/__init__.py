@@ -0,0 +1,3 @@
+"""
+Development tools for benchmarking and testing the API locally.
+"""
@@ -0,0 +1,163 @@
+"""
+Measures the latency of a small tenant's requests while a big tenant
+keeps the upstream lane busy.
+
+The app from `create_app()` is served in this process by a threaded
+WSGI server against a local stand-in for SFMC (see `stub_upstream.py`).
+A small tenant lists assets at a steady rate, first alone and then
+while a big tenant saves assets from many concurrent clients, as in a
+bulk edit, and the percentiles of the small tenant's latencies are
+printed for both. From the root of the repo:
+
+    python api/tools/bench_fairness.py --duration 20 --big-clients 16
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+import requests
+from itsdangerous import Signer, want_bytes
+from werkzeug.serving import make_server
+
+from stub_upstream import start_in_background
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+SECRET_KEY = "bench-secret"
+SMALL_PATH = "/api/sfmc/asset/v1/content/assets"
+BIG_PATH = "/api/sfmc/asset/v1/content/assets/{n}"
+
+
+def make_cookies(tenant: str) -> dict[str, str]:
+    # pylint: disable=missing-function-docstring
+    signer = Signer(SECRET_KEY, salt="flask-session", key_derivation="hmac")
+    token = str(signer.sign(want_bytes(f"{tenant}_token")), "UTF-8")
+    return {"sfmc_tssd": tenant, "sfmc_access_token": token}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    # pylint: disable=missing-function-docstring
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_small(base_url: str, rate: float, duration: float) -> tuple[list[float], int]:
+    """
+    Lists the small tenant's assets at `rate` requests per second for
+    `duration` seconds, and returns the latencies of the successful
+    requests and the number of failed ones.
+    """
+    cookies = make_cookies("small")
+    latencies, failed = [], 0
+    next_at = time.monotonic()
+    deadline = next_at + duration
+    with requests.Session() as session:
+        while next_at < deadline:
+            time.sleep(max(0.0, next_at - time.monotonic()))
+            next_at += 1 / rate
+            started_at = time.monotonic()
+            resp = session.get(base_url + SMALL_PATH, cookies=cookies, timeout=30)
+            if resp.status_code == 200:
+                latencies.append(time.monotonic() - started_at)
+            else:
+                failed += 1
+    return latencies, failed
+
+
+def run_big(base_url: str, clients: int, stop: threading.Event) -> list[int]:
+    """
+    Saves the big tenant's assets from `clients` threads, each sending
+    its next request as soon as the last one returns, until stopped.
+    Returns the number of requests sent, shed ones included.
+    """
+    cookies = make_cookies("big")
+    sent = [0] * clients
+
+    def run(client: int):
+        with requests.Session() as session:
+            while not stop.is_set():
+                session.patch(
+                    base_url
+                    + BIG_PATH.replace("{n}", str(client * 1000 + sent[client])),
+                    data=b'{"content": "<p>edited</p>"}',
+                    headers={"Content-Type": "application/json"},
+                    cookies=cookies,
+                    timeout=30,
+                )
+                sent[client] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    stop.wait()
+    for thread in threads:
+        thread.join()
+    return sent
+
+
+def main():
+    # pylint: disable=missing-function-docstring
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=20, help="Seconds.")
+    parser.add_argument("--rate", type=float, default=5, help="Small tenant req/s.")
+    parser.add_argument("--big-clients", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.1)
+    args = parser.parse_args()
+
+    stub = start_in_background(latency=args.latency)
+    upstream_url = f"http://127.0.0.1:{stub.server_port}"
+    for name, value in {
+        "JWT_SECRET": "bench",
+        "SECRET_KEY": SECRET_KEY,
+        "SFMC_CLIENT_ID": "bench",
+        "SFMC_CLIENT_SECRET": "bench",
+        "SFMC_REST_BASE_URL": upstream_url,
+        "SFMC_AUTH_BASE_URL": upstream_url,
+        "WARMUP_ENABLED": "False",
+        # Let the big tenant queue up rather than be shed right away.
+        "ADMISSION_MAX_QUEUE": "32",
+        "ADMISSION_MAX_QUEUE_WAIT": "30",
+    }.items():
+        os.environ.setdefault(name, value)
+
+    # pylint: disable=import-outside-toplevel
+    from api import create_app, env_config
+
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    print(
+        f"upstream latency: {args.latency}s, slots: {env_config.ADMISSION_MAX_INFLIGHT},"
+        f" per tenant: {env_config.ADMISSION_TENANT_MAX_INFLIGHT}"
+    )
+    print("big tenant       small p50 ms  small p99 ms  small failed  big req/s")
+    run_small(base_url, args.rate, 2)  # Warm up.
+    for big_clients in (0, args.big_clients):
+        stop = threading.Event()
+        big: dict[str, list[int]] = {}
+        load = threading.Thread(
+            target=lambda: big.update(sent=run_big(base_url, big_clients, stop))
+        )
+        started_at = time.monotonic()
+        load.start()
+        latencies, failed = run_small(base_url, args.rate, args.duration)
+        stop.set()
+        load.join()
+        elapsed = time.monotonic() - started_at
+        print(
+            f"{big_clients:>2} clients       {percentile(latencies, 0.5) * 1000:<13.1f}"
+            f" {percentile(latencies, 0.99) * 1000:<13.1f} {failed:<13}"
+            f" {sum(big['sent']) / elapsed:.1f}"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Compares the HTTP/1.1 and HTTP/2 upstream transports.
+
+Sends requests through the API's shared upstream session to a local
+HTTP/2-capable stand-in for SFMC (see `stub_h2_upstream.py`), once with
+each transport, and prints the time taken and the connections the
+stand-in accepted for two workloads:
+
+- batch: a page loading the thumbnails of its assets, i.e. rounds of
+  `--batch` concurrent requests, each round starting when the previous
+  one is done, on a warm session.
+- burst: `--burst` concurrent requests on a cold session, as after a
+  worker starts or is recycled.
+
+Run it from the root of the repo:
+
+    python api/tools/bench_http2.py --latency 0.02
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+for name, value in {
+    "JWT_SECRET": "bench",
+    "SECRET_KEY": "bench",
+    "SFMC_CLIENT_ID": "bench",
+    "SFMC_CLIENT_SECRET": "bench",
+}.items():
+    os.environ.setdefault(name, value)
+
+# pylint: disable=wrong-import-position
+from stub_h2_upstream import start_in_background
+from api import env_config, upstream
+
+THUMBNAIL_PATH = "/asset/v1/assets/{}/thumbnail"
+
+
+def send(tenant_subdomain: str, count: int, offset: int = 0) -> list[float]:
+    """
+    Sends `count` concurrent thumbnail requests and returns the latency
+    of each.
+    """
+
+    def get(asset_id: int) -> float:
+        started_at = time.monotonic()
+        url = upstream.sfmc_rest_url(tenant_subdomain, THUMBNAIL_PATH.format(asset_id))
+        resp = upstream.get_session().get(url, timeout=30)
+        resp.raise_for_status()
+        return time.monotonic() - started_at
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        return list(executor.map(get, range(offset, offset + count)))
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    # pylint: disable=missing-function-docstring
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(transport: str, server, args) -> list[str]:
+    """
+    Runs both workloads with the transport and returns the result rows.
+    """
+    env_config.UPSTREAM_HTTP2 = ["sfmc_rest"] if transport == "h2" else []
+    rows = []
+
+    upstream.reset()
+    server.connections.clear()
+    send("bench", 1)  # Open a connection.
+    started_at = time.monotonic()
+    latencies = []
+    for batch in range(args.rounds):
+        latencies += send("bench", args.batch, batch * args.batch)
+    elapsed = time.monotonic() - started_at
+    rows.append(
+        f"{'batch':<8}{transport:<10}{elapsed / args.rounds * 1000:<12.1f}"
+        f"{percentile(latencies, 0.99) * 1000:<10.1f}{sum(server.connections.values())}"
+    )
+
+    upstream.reset()
+    server.connections.clear()
+    started_at = time.monotonic()
+    latencies = send("bench", args.burst)
+    elapsed = time.monotonic() - started_at
+    rows.append(
+        f"{'burst':<8}{transport:<10}{elapsed * 1000:<12.1f}"
+        f"{percentile(latencies, 0.99) * 1000:<10.1f}{sum(server.connections.values())}"
+    )
+    upstream.reset()
+    return rows
+
+
+def main():
+    # pylint: disable=missing-function-docstring
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--burst", type=int, default=64)
+    args = parser.parse_args()
+
+    server = start_in_background(latency=args.latency)
+    os.environ["REQUESTS_CA_BUNDLE"] = server.cert_path
+    os.environ["SSL_CERT_FILE"] = server.cert_path
+    env_config.SFMC_REST_BASE_URL = f"https://localhost:{server.port}"
+
+    print(
+        f"cores: {os.cpu_count()}, upstream latency: {args.latency}s, "
+        f"pool size: {env_config.UPSTREAM_POOL_MAXSIZE}"
+    )
+    print("load    transport ms/round    p99 ms    connections")
+    for transport in ("http1.1", "h2"):
+        for row in run(transport, server, args):
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Compares the JSON codecs on payloads of realistic sizes.
+
+For asset listings shaped like SFMC's (see `stub_upstream.py`), a token
+response and a Laasie payload, prints the time taken per operation by
+each available codec in `api/json_codec.py`, and for the payload, the
+time of validating it and passing it on as-is versus decoding and
+encoding it again. Run it from the root of the repo:
+
+    python api/tools/bench_json.py
+"""
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+for name, value in {
+    "JWT_SECRET": "bench",
+    "SECRET_KEY": "bench",
+    "SFMC_CLIENT_ID": "bench",
+    "SFMC_CLIENT_SECRET": "bench",
+}.items():
+    os.environ.setdefault(name, value)
+
+# pylint: disable=wrong-import-position
+from stub_upstream import make_asset
+from api import json_codec
+
+TOKEN_RESPONSE = {
+    "access_token": "a" * 512,
+    "refresh_token": "r" * 25,
+    "expires_in": 1079,
+    "token_type": "Bearer",
+    "rest_instance_url": "https://mcmb4wk3d.rest.marketingcloudapis.com/",
+    "soap_instance_url": "https://mcmb4wk3d.soap.marketingcloudapis.com/",
+    "scope": "documents_and_images_read documents_and_images_write",
+}
+LAASIE_PAYLOAD = {
+    "clientId": "c" * 24,
+    "clientSecret": "s" * 24,
+    "tssd": "mcmb4wk3d",
+    "mid": 100012345,
+}
+
+
+def listing(items: int) -> dict:
+    # pylint: disable=missing-function-docstring
+    return {
+        "count": items,
+        "page": 1,
+        "pageSize": items,
+        "items": [make_asset(i + 1) for i in range(items)],
+    }
+
+
+def per_call_us(func, seconds: float = 0.5) -> float:
+    """
+    Returns the mean time of a call of `func` in microseconds.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * seconds / 0.2))
+    return min(timer.repeat(3, number)) / number * 1e6
+
+
+def main():
+    # pylint: disable=missing-function-docstring
+    payloads = {
+        "token response": TOKEN_RESPONSE,
+        "laasie payload": LAASIE_PAYLOAD,
+        **{f"listing x{n}": listing(n) for n in (10, 50, 250)},
+    }
+    codecs = [json_codec.get_codec(name) for name in sorted(json_codec.CODECS)]
+    print(
+        f"payload         size KB  op      {'  '.join(f'{c.name:>8} us' for c in codecs)}"
+    )
+    for name, obj in payloads.items():
+        data = json.dumps(obj).encode()
+        for op, make_call in (
+            ("loads", lambda c: lambda: c.loads(data)),
+            ("dumps", lambda c: lambda: c.dumps(obj)),
+        ):
+            times = "  ".join(f"{per_call_us(make_call(c)):>11.1f}" for c in codecs)
+            print(f"{name:<16}{len(data) / 1024:<9.1f}{op:<8}{times}")
+
+    data = json.dumps(LAASIE_PAYLOAD).encode()
+    print()
+    print(
+        f"laasie payload  {'':<9}{'':<8}{'  '.join(f'{c.name:>8} us' for c in codecs)}"
+    )
+    for op, make_call in (
+        ("decode and encode", lambda c: lambda: c.dumps(c.loads(data))),
+        ("validate, pass on", lambda c: lambda: (c.loads(data), data)),
+    ):
+        times = "  ".join(f"{per_call_us(make_call(c)):>11.1f}" for c in codecs)
+        print(f"{op:<33}{times}")
+
+
+if __name__ == "__main__":
+    main()
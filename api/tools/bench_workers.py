@@ -0,0 +1,145 @@
+"""
+Measures the throughput of the API under gunicorn with 1 to N workers.
+
+For each worker count, starts gunicorn with the `api.gunicorn_conf`
+profile against a local stub upstream (see `stub_upstream.py`), drives
+a closed-loop load of asset listings at it and prints the requests per
+second. Run it from the root of the repo:
+
+    python api/tools/bench_workers.py --workers 1,2,4 --duration 15
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from itsdangerous import Signer, want_bytes
+
+from stub_upstream import start_in_background
+
+SECRET_KEY = "bench-secret"
+REQUEST_PATH = "/api/sfmc/asset/v1/content/assets"
+
+
+def free_port() -> int:
+    # pylint: disable=missing-function-docstring
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(workers: int, threads: int, upstream_url: str) -> tuple:
+    """
+    Starts gunicorn and waits until it answers health checks.
+    """
+    port = free_port()
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "GUNICORN_WORKERS": str(workers),
+        "GUNICORN_THREADS": str(threads),
+        "JWT_SECRET": "bench",
+        "SECRET_KEY": SECRET_KEY,
+        "SFMC_CLIENT_ID": "bench",
+        "SFMC_CLIENT_SECRET": "bench",
+        "SFMC_REST_BASE_URL": upstream_url,
+        "SFMC_AUTH_BASE_URL": upstream_url,
+        "WARMUP_ENABLED": "False",
+        # Measure the throughput of the workers, not the admission caps.
+        "ADMISSION_ENABLED": "False",
+    }
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--config",
+            "python:api.gunicorn_conf",
+            "--access-logfile",
+            "/dev/null",
+            "api:create_app()",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            if requests.get(f"{base_url}/healthcheck", timeout=1).status_code == 200:
+                return process, base_url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def drive_load(base_url: str, concurrency: int, duration: float) -> tuple[int, int]:
+    """
+    Sends requests from `concurrency` threads for `duration` seconds and
+    returns the number of successful and failed requests.
+    """
+    signer = Signer(SECRET_KEY, salt="flask-session", key_derivation="hmac")
+    cookies = {
+        "sfmc_tssd": "bench",
+        "sfmc_access_token": str(signer.sign(want_bytes("bench_token")), "UTF-8"),
+    }
+    deadline = time.monotonic() + duration
+    results = {"ok": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def run():
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                try:
+                    resp = session.get(
+                        f"{base_url}{REQUEST_PATH}", cookies=cookies, timeout=30
+                    )
+                    outcome = "ok" if resp.status_code == 200 else "failed"
+                except requests.RequestException:
+                    outcome = "failed"
+                with lock:
+                    results[outcome] += 1
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results["ok"], results["failed"]
+
+
+def main():
+    # pylint: disable=missing-function-docstring
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--items", type=int, default=25)
+    args = parser.parse_args()
+
+    stub = start_in_background(latency=args.latency, items=args.items)
+    upstream_url = f"http://127.0.0.1:{stub.server_port}"
+
+    print(f"cores: {os.cpu_count()}, upstream latency: {args.latency}s")
+    print("workers  threads  req/s    failed")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        process, base_url = start_gunicorn(workers, args.threads, upstream_url)
+        try:
+            drive_load(base_url, args.concurrency, 2)  # Warm up.
+            ok, failed = drive_load(base_url, args.concurrency, args.duration)
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{workers:<8} {args.threads:<8} {ok / args.duration:<8.1f} {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Replays a capture of the proxied SFMC calls (see `api/traffic_capture.py`)
+against the API and a local stand-in for SFMC that reproduces the
+recorded latencies and sizes.
+
+The app from `create_app()` is served in this process by a threaded
+WSGI server. Each record is sent at its offset from the first one,
+divided by `--speed`, to the same route, from one tenant per recorded
+tenant and with a request body of the recorded size. Records with the
+same URL hash refer to the same asset. The calls of batches and bulk
+transfers were recorded as calls of their proxied routes, so they are
+sent as separate requests, and the Laasie payloads are skipped. The
+stand-in for SFMC answers each call with the recorded status and a
+body of the recorded size after the recorded upstream latency, so calls
+that were answered from the cache or the asset index are only slow if
+the replay misses them.
+
+Once done, it prints the requests, the latency percentiles and the
+recorded ones per route, the statuses, and how late the requests were
+sent, which shows whether the client kept up. From the root of the repo:
+
+    python api/tools/replay_capture.py traffic_capture.ndjson --speed 4
+"""
+import argparse
+import base64
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, NamedTuple
+
+import requests
+from itsdangerous import Signer, want_bytes
+from werkzeug.serving import make_server
+
+from stub_upstream import make_asset, make_png
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+SECRET_KEY = "replay-secret"
+# The routes whose responses are listings of assets.
+LISTING_ROUTES = ("filter_assets", "advanced_filter_assets", "list_categories")
+THUMBNAIL_ROUTE = "get_thumbnail_base64"
+PNG = make_png(320, 240)
+
+
+class Reply(NamedTuple):
+    """
+    A recorded upstream response.
+    """
+
+    route: str
+    status: int
+    size: int
+    latency: float
+    asset_id: int
+
+
+def make_body(reply: Reply) -> tuple[str, bytes]:
+    """
+    Returns the content type and a body of about the size of the reply,
+    shaped like SFMC's responses to its route.
+    """
+    if reply.route == THUMBNAIL_ROUTE and reply.status < 400:
+        png = PNG + b"\0" * max(0, reply.size * 3 // 4 - len(PNG))
+        return "text/plain", base64.b64encode(png)
+
+    def shape(content_size: int) -> Any:
+        if reply.status >= 400:
+            return {"message": "x" * content_size}
+        asset = make_asset(reply.asset_id, content_size)
+        if reply.route in LISTING_ROUTES:
+            return {"count": 1, "page": 1, "pageSize": 50, "items": [asset]}
+        return asset
+
+    padding = max(0, reply.size - len(json.dumps(shape(0))))
+    # The content of an asset is repeated in a quarter as long view.
+    if reply.status < 400:
+        padding = padding * 4 // 5
+    return "application/json", json.dumps(shape(padding)).encode()
+
+
+class ReplayUpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Answers each call with the next recorded reply for its path.
+    """
+
+    server: "ReplayUpstreamServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self):
+        self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        reply = self.server.next_reply(self.command, self.path.split("?", 1)[0])
+        content_type, body = make_body(reply)
+        time.sleep(reply.latency)
+        self.send_response(reply.status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = _reply
+
+
+class ReplayUpstreamServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server that serves the recorded replies of each
+    method and path in turn.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address) -> None:
+        super().__init__(address, ReplayUpstreamHandler)
+        self._replies: dict[tuple[str, str], deque[Reply]] = defaultdict(deque)
+        self._last: dict[tuple[str, str], Reply] = {}
+        self._lock = threading.Lock()
+
+    def add_reply(self, method: str, path: str, reply: Reply):
+        # pylint: disable=missing-function-docstring
+        self._replies[method, path].append(reply)
+
+    def next_reply(self, method: str, path: str) -> Reply:
+        """
+        Returns the next reply for the path, the last one again once they
+        have all been served, or an empty 404 for unknown paths.
+        """
+        with self._lock:
+            replies = self._replies.get((method, path))
+            if replies:
+                self._last[method, path] = replies.popleft()
+            return self._last.get((method, path), Reply("unknown", 404, 0, 0.0, 0))
+
+
+def make_cookies(tenant: str) -> dict[str, str]:
+    # pylint: disable=missing-function-docstring
+    signer = Signer(SECRET_KEY, salt="flask-session", key_derivation="hmac")
+    token = str(signer.sign(want_bytes(f"{tenant}_token")), "UTF-8")
+    return {"sfmc_tssd": tenant, "sfmc_access_token": token}
+
+
+def make_request_body(size: int) -> bytes:
+    """
+    Returns a JSON body of the given size.
+    """
+    return json.dumps({"name": "Replay", "content": "x" * max(0, size - 32)}).encode()
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    # pylint: disable=missing-function-docstring
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    # pylint: disable=missing-function-docstring,too-many-locals,too-many-statements
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="The capture file.")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 for real time.")
+    parser.add_argument("--clients", type=int, default=64, help="Concurrent clients.")
+    parser.add_argument("--limit", type=int, help="Replay only the first records.")
+    args = parser.parse_args()
+
+    stub = ReplayUpstreamServer(("127.0.0.1", 0))
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{stub.server_port}"
+    for name, value in {
+        "JWT_SECRET": "replay",
+        "SECRET_KEY": SECRET_KEY,
+        "SFMC_CLIENT_ID": "replay",
+        "SFMC_CLIENT_SECRET": "replay",
+        "SFMC_REST_BASE_URL": upstream_url,
+        "SFMC_AUTH_BASE_URL": upstream_url,
+        "WARMUP_ENABLED": "False",
+        "CAPTURE_ENABLED": "False",
+    }.items():
+        os.environ.setdefault(name, value)
+
+    # pylint: disable=import-outside-toplevel
+    from api import create_app, proxy_engine, traffic_capture
+    from api.sfmc_api_proxy import (
+        ROUTES_BY_NAME,
+        THUMBNAIL_BASE64_ROUTE,
+        THUMBNAIL_IMAGE_ROUTE_NAME,
+    )
+
+    # The thumbnail images are fetched from SFMC as base64 thumbnails.
+    routes = {**ROUTES_BY_NAME, THUMBNAIL_IMAGE_ROUTE_NAME: THUMBNAIL_BASE64_ROUTE}
+    records = sorted(
+        (r for r in traffic_capture.read_records(args.capture) if r.route in routes),
+        key=lambda r: r.ts,
+    )[: args.limit]
+    if not records:
+        sys.exit(f"No records of the proxied routes in {args.capture}.")
+
+    # The requests to send, each with its offset in seconds.
+    requests_to_send = []
+    for record in records:
+        route = routes[record.route]
+        asset_id = int(record.key, 16) % 1_000_000 + 1
+        path_args = {"asset_id": str(asset_id)}
+        path = proxy_engine.PATH_VARIABLE.sub(
+            lambda m, a=path_args: a[m.group(1)], route.path
+        )
+        if record.route == THUMBNAIL_IMAGE_ROUTE_NAME:
+            path += "/image"
+        stub.add_reply(
+            route.method,
+            route.get_upstream_path(path_args),
+            Reply(
+                route.name,
+                record.status,
+                record.response_bytes,
+                record.upstream_ms / 1000,
+                asset_id,
+            ),
+        )
+        if record.projected:
+            path += "?fields=id,name,customerKey"
+        requests_to_send.append(
+            ((record.ts - records[0].ts) / args.speed, record, path)
+        )
+
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/api/sfmc"
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    statuses: Counter = Counter()
+    lags: list[float] = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(due_at: float, record, path: str):
+        started_at = time.monotonic()
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        route = routes[record.route]
+        body = None
+        if route.method in ("POST", "PATCH"):
+            body = make_request_body(record.request_bytes)
+        try:
+            resp = local.session.request(
+                route.method,
+                base_url + path,
+                data=body,
+                headers={"Content-Type": "application/json"},
+                cookies=make_cookies(f"t{record.tenant}"),
+                timeout=60,
+            )
+            status = str(resp.status_code)
+        except requests.RequestException as ex:
+            status = type(ex).__name__
+        elapsed = time.monotonic() - started_at
+        with lock:
+            latencies[record.route].append(elapsed)
+            statuses[status] += 1
+            lags.append(started_at - due_at)
+
+    print(
+        f"replaying {len(records)} requests of"
+        f" {records[-1].ts - records[0].ts:.1f}s at {args.speed}x"
+        f" from {len({r.tenant for r in records})} tenants"
+    )
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(args.clients) as executor:
+        for offset, record, path in requests_to_send:
+            due_at = started_at + offset
+            time.sleep(max(0.0, due_at - time.monotonic()))
+            executor.submit(send, due_at, record, path)
+    elapsed = time.monotonic() - started_at
+    server.shutdown()
+
+    recorded: dict[str, list[float]] = defaultdict(list)
+    for record in records:
+        recorded[record.route].append(record.total_ms / 1000)
+    print(f"done in {elapsed:.1f}s, {len(records) / elapsed:.1f} req/s\n")
+    print(
+        "route                    requests  p50 ms   p99 ms   recorded p50 ms"
+        "  recorded p99 ms"
+    )
+    for route_name, values in sorted(latencies.items()):
+        print(
+            f"{route_name:<24} {len(values):<9} {percentile(values, 0.5) * 1000:<8.1f}"
+            f" {percentile(values, 0.99) * 1000:<8.1f}"
+            f" {percentile(recorded[route_name], 0.5) * 1000:<16.1f}"
+            f" {percentile(recorded[route_name], 0.99) * 1000:.1f}"
+        )
+    print(f"\nresponses: {dict(sorted(statuses.items()))}")
+    print(
+        f"send lag: p50 {percentile(lags, 0.5) * 1000:.1f} ms,"
+        f" p99 {percentile(lags, 0.99) * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
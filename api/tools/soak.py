@@ -0,0 +1,394 @@
+"""
+Runs the API for hours under a steady, mixed load and checks that its
+memory, file descriptors and threads don't keep growing.
+
+The app from `create_app()` is served in this process by a threaded
+WSGI server, like a gunicorn worker, against a local stand-in for SFMC
+and Laasie (see `stub_upstream.py`). Client threads send a fixed rate
+of requests that mixes asset listings (whole and projected), queries,
+thumbnails, saves, categories, user info, token refreshes, Laasie
+tokens and payloads, health checks and metrics. Every `--interval`
+seconds the harness samples:
+
+- the resident set size of the process,
+- the memory traced by `tracemalloc`,
+- the open file descriptors and the threads,
+- the entries of the app's caches and of the Laasie spool,
+
+and once the run is over, it compares the lowest samples of the first
+and last third after the warmup and fails if any grew faster, per
+hour, than its limit. The warmup should be long enough for the caches
+to fill up to their bounds. It also prints the allocation sites that
+grew the most since the end of the warmup. From the root of the repo:
+
+    python api/tools/soak.py --duration 14400 --rate 20 --csv soak.csv
+
+The tokens are sent in signed cookies and the Laasie payloads are
+proxied synchronously. With `--sessions`, the tokens are kept in a
+server-side session instead and the payloads go through the Laasie
+spool, so a full check runs once in each mode.
+
+A run of `--duration 900 --warmup 300` is enough to catch fast leaks:
+the caches take a few minutes to fill at the default rate. CSRF
+protection is disabled, as in the tests.
+"""
+import argparse
+import csv
+import logging
+from collections import Counter
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+import requests
+from itsdangerous import Signer, want_bytes
+from werkzeug.serving import make_server
+
+from stub_upstream import start_in_background
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+SECRET_KEY = "soak-secret"
+METRICS_TOKEN = "soak-metrics"
+# The headers of the requests for a path, added to the common ones.
+PATH_HEADERS = {"/metrics": {"Authorization": f"Bearer {METRICS_TOKEN}"}}
+TENANT = "soak"
+
+# The requests of the workload, with their weights.
+WORKLOAD: list[tuple[int, str, str, Optional[bytes]]] = [
+    (30, "GET", "/api/sfmc/asset/v1/content/assets", None),
+    (10, "GET", "/api/sfmc/asset/v1/content/assets?fields=id,name,customerKey", None),
+    (
+        10,
+        "GET",
+        "/api/sfmc/asset/v1/content/assets?$filter=customerKey eq 'laasie-block-{n}'"
+        "&fields=id,customerKey",
+        None,
+    ),
+    (
+        5,
+        "POST",
+        "/api/sfmc/asset/v1/content/assets/query",
+        b'{"page": {"page": 1, "pageSize": 50}, "query": {"property": "name",'
+        b' "simpleOperator": "like", "value": "{n}"}}',
+    ),
+    (15, "GET", "/api/sfmc/asset/v1/assets/{n}/thumbnail", None),
+    (10, "GET", "/api/sfmc/asset/v1/assets/{n}/thumbnail/image?w=160&h=120", None),
+    (
+        5,
+        "POST",
+        "/api/sfmc/asset/v1/content/assets",
+        b'{"customerKey": "soak-{n}", "name": "Soak {n}", "content": "<p>{n}</p>"}',
+    ),
+    (5, "PATCH", "/api/sfmc/asset/v1/content/assets/{n}", b'{"content": "<p>{n}</p>"}'),
+    (5, "GET", "/api/sfmc/asset/v1/content/categories", None),
+    (3, "GET", "/api/sfmc/userinfo", None),
+    (1, "POST", "/oauth2/sfmc/refresh_token", None),
+    (2, "POST", "/auth/laasie/token", None),
+    (5, "POST", "/api/laasie/sfmc", b'{"tenant": "soak", "asset": {n}}'),
+    (3, "GET", "/healthcheck", None),
+    (1, "GET", "/metrics", None),
+]
+# The number of distinct assets the workload refers to, which bounds
+# the entries a correct cache may hold.
+ASSET_IDS = 200
+
+
+def get_rss() -> Optional[int]:
+    """
+    Returns the resident set size of the process in bytes, if known.
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def count_fds() -> Optional[int]:
+    """
+    Returns the number of open file descriptors of the process, if known.
+    """
+    for path in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            pass
+    return None
+
+
+def get_cache_sizes() -> Callable[[], int]:
+    """
+    Returns a function that counts the entries of the app's caches.
+    """
+    # pylint: disable=import-outside-toplevel,protected-access
+    from api import (
+        asset_index,
+        laasie_spool,
+        request_collapsing,
+        response_cache,
+        thumbnails,
+        warmup,
+    )
+
+    spool = laasie_spool.get_spool()
+    return lambda: (
+        len(response_cache._entries)
+        + len(thumbnails._entries)
+        + len(request_collapsing._flights)
+        + len(asset_index._indexes)
+        + len(asset_index._owners)
+        + len(warmup._jobs)
+        + (spool.depth() if spool is not None else 0)
+    )
+
+
+def growth_per_hour(samples: list[tuple[float, float]]) -> float:
+    """
+    Returns the growth, per hour, between the lowest values of the first
+    and the last third of the (seconds, value) samples. The lowest values
+    leave out the requests in flight, which a leak adds to.
+    """
+    third = len(samples) // 3
+    if third == 0:
+        return 0.0
+    first, last = samples[:third], samples[-third:]
+    duration = (last[-1][0] + last[0][0] - first[-1][0] - first[0][0]) / 2
+    if duration <= 0:
+        return 0.0
+    growth = min(v for _, v in last) - min(v for _, v in first)
+    return growth / duration * 3600
+
+
+def make_cookies(sessions: bool) -> dict[str, str]:
+    """
+    Returns the cookies of a logged in user, with the tokens in signed
+    cookies or in a new server-side session.
+    """
+    if sessions:
+        # pylint: disable=import-outside-toplevel
+        from api import session_store
+
+        session_id = session_store.get_store().create(
+            {
+                "tssd": TENANT,
+                "access_token": "soak_token",
+                "access_token_expires_at": time.time() + 1079,
+                "refresh_token": "soak_refresh",
+            }
+        )
+        return {session_store.SESSION_ID_COOKIE_NAME: session_id}
+
+    signer = Signer(SECRET_KEY, salt="flask-session", key_derivation="hmac")
+    return {
+        "sfmc_tssd": TENANT,
+        "sfmc_access_token": str(signer.sign(want_bytes("soak_token")), "UTF-8"),
+        "sfmc_refresh_token": str(signer.sign(want_bytes("soak_refresh")), "UTF-8"),
+    }
+
+
+def drive_load(
+    base_url: str,
+    concurrency: int,
+    rate: float,
+    cookies: dict[str, str],
+    stop: threading.Event,
+) -> Counter:
+    """
+    Sends the workload at `rate` requests per second, in total, from
+    `concurrency` threads until stopped, and returns the number of
+    responses by status code.
+    """
+    statuses: Counter = Counter()
+    lock = threading.Lock()
+    weights = [weight for weight, *_ in WORKLOAD]
+
+    def run(worker: int):
+        rng = random.Random(worker)
+        interval = concurrency / rate
+        next_at = time.monotonic() + rng.random() * interval
+        with requests.Session() as session:
+            while True:
+                if stop.wait(max(0.0, next_at - time.monotonic())):
+                    return
+                next_at += interval
+                _, method, path, body = rng.choices(WORKLOAD, weights)[0]
+                n = str(rng.randrange(1, ASSET_IDS + 1))
+                try:
+                    resp = session.request(
+                        method,
+                        base_url + path.replace("{n}", n),
+                        data=body.replace(b"{n}", n.encode()) if body else None,
+                        headers={
+                            "Content-Type": "application/json",
+                            "Accept": "image/webp,image/*",
+                            **PATH_HEADERS.get(path, {}),
+                        },
+                        cookies=cookies,
+                        timeout=30,
+                    )
+                    status = str(resp.status_code)
+                except requests.RequestException as ex:
+                    status = type(ex).__name__
+                # Don't keep the refreshed cookies, which are for HTTPS.
+                session.cookies.clear()
+                with lock:
+                    statuses[status] += 1
+
+    threads = [
+        threading.Thread(target=run, args=(i,), daemon=True) for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    stop.wait()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def main():
+    # pylint: disable=missing-function-docstring,too-many-locals
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=3600, help="Seconds.")
+    parser.add_argument(
+        "--warmup", type=float, default=300, help="Seconds not checked for growth."
+    )
+    parser.add_argument("--interval", type=float, default=10, help="Seconds.")
+    parser.add_argument("--rate", type=float, default=20, help="Requests per second.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--csv", help="Write the samples to this CSV file.")
+    parser.add_argument(
+        "--sessions",
+        action="store_true",
+        help="Use server-side sessions and the Laasie spool.",
+    )
+    parser.add_argument("--max-rss-growth", type=float, default=8.0, help="MB/hour.")
+    parser.add_argument("--max-traced-growth", type=float, default=4.0, help="MB/hour.")
+    parser.add_argument("--max-fd-growth", type=float, default=2.0, help="Per hour.")
+    parser.add_argument(
+        "--max-thread-growth", type=float, default=2.0, help="Per hour."
+    )
+    parser.add_argument(
+        "--max-cache-growth", type=float, default=50.0, help="Per hour."
+    )
+    parser.add_argument("--top", type=int, default=10, help="Allocation sites shown.")
+    args = parser.parse_args()
+
+    stub = start_in_background(latency=args.latency)
+    upstream_url = f"http://127.0.0.1:{stub.server_port}"
+    for name, value in {
+        "JWT_SECRET": "soak",
+        "SECRET_KEY": SECRET_KEY,
+        "SFMC_CLIENT_ID": "soak",
+        "SFMC_CLIENT_SECRET": "soak",
+        "SFMC_REST_BASE_URL": upstream_url,
+        "SFMC_AUTH_BASE_URL": upstream_url,
+        "LAASIE_API_BASE_URL": upstream_url,
+        "SERVER_SIDE_SESSIONS": str(args.sessions),
+        "LAASIE_ASYNC_DELIVERY": str(args.sessions),
+        "METRICS_TOKEN": METRICS_TOKEN,
+    }.items():
+        os.environ.setdefault(name, value)
+
+    tracemalloc.start()
+    # pylint: disable=import-outside-toplevel
+    from api import create_app
+
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    count_cache_entries = get_cache_sizes()
+
+    stop = threading.Event()
+    statuses: Counter = Counter()
+    load = threading.Thread(
+        target=lambda: statuses.update(
+            drive_load(
+                base_url,
+                args.concurrency,
+                args.rate,
+                make_cookies(args.sessions),
+                stop,
+            )
+        )
+    )
+    load.start()
+
+    columns = ["seconds", "rss_mb", "traced_mb", "fds", "threads", "cache_entries"]
+    samples: list[dict[str, float]] = []
+    baseline: Optional[tracemalloc.Snapshot] = None
+    baseline_at = args.duration
+    started_at = time.monotonic()
+    print(" ".join(f"{column:>13}" for column in columns))
+    try:
+        while (elapsed := time.monotonic() - started_at) < args.duration:
+            rss, fds = get_rss(), count_fds()
+            sample = {
+                "seconds": round(elapsed, 1),
+                "rss_mb": -1 if rss is None else round(rss / 1e6, 2),
+                "traced_mb": round(tracemalloc.get_traced_memory()[0] / 1e6, 2),
+                "fds": -1 if fds is None else fds,
+                "threads": threading.active_count(),
+                "cache_entries": count_cache_entries(),
+            }
+            samples.append(sample)
+            print(" ".join(f"{sample[column]:>13}" for column in columns), flush=True)
+            if baseline is None and elapsed >= args.warmup:
+                # The snapshot itself takes memory, so growth is checked
+                # from the next sample on.
+                baseline = tracemalloc.take_snapshot()
+                baseline_at = elapsed
+            time.sleep(args.interval)
+    finally:
+        stop.set()
+        load.join()
+        server.shutdown()
+
+    if args.csv:
+        with open(args.csv, "w", newline="", encoding="utf-8") as output:
+            writer = csv.DictWriter(output, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(samples)
+
+    print(f"\nresponses: {dict(sorted(statuses.items()))}")
+    if baseline is not None:
+        print(f"\nallocation sites that grew the most since {args.warmup:.0f}s:")
+        stats = tracemalloc.take_snapshot().compare_to(baseline, "lineno")
+        for stat in stats[: args.top]:
+            print(f"  {stat}")
+
+    limits = {
+        "rss_mb": args.max_rss_growth,
+        "traced_mb": args.max_traced_growth,
+        "fds": args.max_fd_growth,
+        "threads": args.max_thread_growth,
+        "cache_entries": args.max_cache_growth,
+    }
+    checked = [s for s in samples if s["seconds"] > baseline_at]
+    failed = False
+    print("\ngrowth after the warmup, per hour:")
+    for column, limit in limits.items():
+        points = [(s["seconds"], s[column]) for s in checked if s[column] >= 0]
+        growth = growth_per_hour(points)
+        exceeded = growth > limit
+        failed = failed or exceeded
+        print(
+            f"  {column:<14}{growth:>10.2f}  limit {limit:<8}"
+            f"{'EXCEEDED' if exceeded else 'ok'}"
+        )
+    if len(checked) < 3:
+        print("Not enough samples after the warmup to check for growth.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+A local stand-in for the SFMC REST API that speaks HTTP/2.
+
+It serves the asset listings, categories and thumbnails of
+`stub_upstream.py` over TLS with a self-signed certificate, and
+negotiates HTTP/2 or HTTP/1.1 with ALPN, so that both transports of the
+API can be benchmarked against it. It counts the connections it
+accepted by protocol. Start it with:
+
+    python api/tools/stub_h2_upstream.py --port 9443 --latency 0.02
+
+and trust the printed certificate with `REQUESTS_CA_BUNDLE` and
+`SSL_CERT_FILE`. Requires `h2` and `h11`, which `httpx[http2]` installs.
+"""
+import argparse
+import asyncio
+import base64
+from collections import Counter
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+from typing import Optional
+
+import h11
+import h2.config
+import h2.connection
+import h2.events
+
+from stub_upstream import THUMBNAIL_PATH, make_asset, make_png
+
+READ_SIZE = 64 * 1024
+
+
+def make_certificate(directory: str) -> tuple[str, str]:
+    """
+    Creates a self-signed certificate for `localhost` and returns the
+    paths of the certificate and its key.
+    """
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost,IP:127.0.0.1",
+            "-keyout",
+            key_path,
+            "-out",
+            cert_path,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert_path, key_path
+
+
+class StubH2Upstream:
+    """
+    Answers the SFMC asset requests over HTTP/2 and HTTP/1.1.
+    """
+
+    def __init__(self, latency: float = 0.02, items: int = 25) -> None:
+        self.latency = latency
+        self.listing = json.dumps(
+            {
+                "count": items,
+                "page": 1,
+                "pageSize": 50,
+                "items": [make_asset(i + 1) for i in range(items)],
+            }
+        ).encode()
+        self.categories = json.dumps(
+            {"count": 1, "items": [{"id": 1, "name": "Content Builder"}]}
+        ).encode()
+        self.thumbnail = base64.b64encode(make_png(320, 240))
+        self.connections: Counter = Counter()
+        self.requests_served = 0
+        self.port = 0
+        self.cert_path = ""
+
+    async def get_response(self, path: str) -> tuple[int, str, bytes]:
+        """
+        Returns the status, content type and body for a GET request.
+        """
+        await asyncio.sleep(self.latency)
+        self.requests_served += 1
+        path = path.split("?", 1)[0]
+        if path == "/asset/v1/content/assets":
+            return 200, "application/json", self.listing
+        if path == "/asset/v1/content/categories":
+            return 200, "application/json", self.categories
+        if THUMBNAIL_PATH.match(path):
+            return 200, "text/plain", self.thumbnail
+        return 404, "application/json", b'{"message": "Not found"}'
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # pylint: disable=missing-function-docstring
+        protocol = writer.get_extra_info("ssl_object").selected_alpn_protocol()
+        self.connections[protocol or "http/1.1"] += 1
+        try:
+            if protocol == "h2":
+                await H2Session(self, reader, writer).serve()
+            else:
+                await self.serve_http11(reader, writer)
+        except (ConnectionError, h11.RemoteProtocolError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_http11(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        # pylint: disable=missing-function-docstring
+        conn = h11.Connection(h11.SERVER)
+        target = ""
+        while True:
+            event = conn.next_event()
+            if event is h11.NEED_DATA:
+                conn.receive_data(await reader.read(READ_SIZE))
+            elif isinstance(event, h11.Request):
+                target = event.target.decode()
+            elif isinstance(event, h11.EndOfMessage):
+                status, content_type, body = await self.get_response(target)
+                headers = [
+                    ("Content-Type", content_type),
+                    ("Content-Length", str(len(body))),
+                ]
+                writer.write(
+                    conn.send(h11.Response(status_code=status, headers=headers))
+                )
+                writer.write(conn.send(h11.Data(data=body)))
+                writer.write(conn.send(h11.EndOfMessage()))
+                await writer.drain()
+                conn.start_next_cycle()
+            elif isinstance(event, h11.ConnectionClosed):
+                return
+
+
+class H2Session:
+    """
+    Serves the requests of one HTTP/2 connection concurrently.
+    """
+
+    def __init__(
+        self,
+        server: StubH2Upstream,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        self.paths: dict[int, str] = {}
+        self.window_updated = asyncio.Event()
+
+    async def serve(self):
+        # pylint: disable=missing-function-docstring
+        self.conn.initiate_connection()
+        await self.flush()
+        while True:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return
+            for event in self.conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    self.paths[event.stream_id] = dict(event.headers)[":path"]
+                elif isinstance(event, h2.events.StreamEnded):
+                    asyncio.create_task(self.respond(event.stream_id))
+                elif isinstance(event, h2.events.WindowUpdated):
+                    # Wake up the responses waiting for the window.
+                    self.window_updated.set()
+                    self.window_updated = asyncio.Event()
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+            await self.flush()
+
+    async def respond(self, stream_id: int):
+        # pylint: disable=missing-function-docstring
+        status, content_type, body = await self.server.get_response(
+            self.paths.pop(stream_id)
+        )
+        self.conn.send_headers(
+            stream_id,
+            [
+                (":status", str(status)),
+                ("content-type", content_type),
+                ("content-length", str(len(body))),
+            ],
+        )
+        while body:
+            window = min(
+                self.conn.local_flow_control_window(stream_id),
+                self.conn.max_outbound_frame_size,
+            )
+            if window <= 0:
+                await self.flush()
+                await self.window_updated.wait()
+                continue
+            self.conn.send_data(stream_id, body[:window])
+            body = body[window:]
+        self.conn.end_stream(stream_id)
+        await self.flush()
+
+    async def flush(self):
+        # pylint: disable=missing-function-docstring
+        self.writer.write(self.conn.data_to_send())
+        await self.writer.drain()
+
+
+def start_in_background(
+    port: int = 0,
+    latency: float = 0.02,
+    items: int = 25,
+    cert_dir: Optional[str] = None,
+) -> StubH2Upstream:
+    """
+    Starts the stand-in on an event loop in a daemon thread and returns
+    it once it is listening. The actual port is `server.port` and the
+    certificate to trust `server.cert_path`.
+    """
+    server = StubH2Upstream(latency=latency, items=items)
+    cert_path, key_path = make_certificate(cert_dir or tempfile.mkdtemp())
+    server.cert_path = cert_path
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    context.set_alpn_protocols(["h2", "http/1.1"])
+
+    started = threading.Event()
+
+    async def serve():
+        listener = await asyncio.start_server(
+            server.handle, "127.0.0.1", port, ssl=context
+        )
+        server.port = listener.sockets[0].getsockname()[1]
+        started.set()
+        await listener.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    started.wait()
+    return server
+
+
+def main():
+    # pylint: disable=missing-function-docstring
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=9443)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds to wait per response."
+    )
+    parser.add_argument(
+        "--items", type=int, default=25, help="Assets returned per listing."
+    )
+    args = parser.parse_args()
+
+    server = start_in_background(args.port, args.latency, args.items)
+    print(f"Stub HTTP/2 upstream listening on https://localhost:{server.port}")
+    print(f"Certificate: {server.cert_path}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+A local stand-in for the SFMC REST and auth APIs and for the Laasie API.
+
+It answers the requests the API proxies with canned responses of a
+realistic shape after an artificial delay, so that the API can be
+benchmarked without calling SFMC or Laasie. Point the API at it with:
+
+    SFMC_REST_BASE_URL=http://127.0.0.1:9000
+    SFMC_AUTH_BASE_URL=http://127.0.0.1:9000
+    LAASIE_API_BASE_URL=http://127.0.0.1:9000
+
+and start it with:
+
+    python api/tools/stub_upstream.py --port 9000 --latency 0.02
+"""
+import argparse
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import struct
+import threading
+import time
+from typing import Any
+import zlib
+
+THUMBNAIL_PATH = re.compile(r"^/asset/v1/assets/(\d+)/thumbnail$")
+ASSET_PATH = re.compile(r"^/asset/v1/content/assets/(\d+)$")
+
+
+def make_asset(asset_id: int, content_size: int = 4096) -> dict[str, Any]:
+    """
+    Returns an HTML block asset shaped like the ones SFMC returns.
+    """
+    return {
+        "id": asset_id,
+        "customerKey": f"laasie-block-{asset_id}",
+        "objectID": f"00000000-0000-0000-0000-{asset_id:012d}",
+        "assetType": {"id": 197, "name": "htmlblock", "displayName": "HTML Block"},
+        "name": f"Laasie block {asset_id}",
+        "owner": {"id": 1, "email": "owner@example.com", "name": "Owner"},
+        "createdDate": "2022-06-01T10:00:00-06:00",
+        "createdBy": {"id": 1, "email": "owner@example.com", "name": "Owner"},
+        "modifiedDate": "2022-06-02T10:00:00-06:00",
+        "modifiedBy": {"id": 1, "email": "owner@example.com", "name": "Owner"},
+        "category": {"id": 1234, "name": "Laasie Collection Templates", "parentId": 1},
+        "content": "<table><tr><td>" + "x" * content_size + "</td></tr></table>",
+        "thumbnail": {"thumbnailUrl": f"/v1/assets/{asset_id}/thumbnail"},
+        "views": {"html": {"content": "x" * (content_size // 4)}},
+        "data": {"email": {"options": {"generateFrom": None}}},
+        "status": {"id": 1, "name": "Draft"},
+    }
+
+
+def make_png(width: int, height: int) -> bytes:
+    """
+    Returns a PNG image with a simple gradient of the given size.
+    """
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        checksum = zlib.crc32(kind + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", checksum)
+
+    rows = b"".join(
+        b"\x00"
+        + b"".join(
+            bytes((x * 255 // width, y * 255 // height, 128)) for x in range(width)
+        )
+        for y in range(height)
+    )
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Handles the SFMC and Laasie API requests made by the proxies.
+    """
+
+    server: "StubUpstreamServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _send_json(self, status: int, payload: Any):
+        body = json.dumps(payload).encode()
+        self._send(status, body, "application/json")
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count_request()
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", "0")))
+
+    def _listing(self) -> dict[str, Any]:
+        items = [make_asset(i + 1) for i in range(self.server.items)]
+        return {"count": len(items), "page": 1, "pageSize": 50, "items": items}
+
+    def do_GET(self):
+        # pylint: disable=missing-function-docstring,invalid-name
+        path = self.path.split("?", 1)[0]
+        if path == "/asset/v1/content/assets":
+            self._send_json(200, self._listing())
+        elif path == "/asset/v1/content/categories":
+            categories = [
+                {"id": 1, "name": "Content Builder", "parentId": 0},
+                {"id": 1234, "name": "Laasie Collection Templates", "parentId": 1},
+            ]
+            self._send_json(200, {"count": 2, "items": categories})
+        elif path == "/v2/userinfo":
+            self._send_json(
+                200,
+                {
+                    "user": {"sub": "1", "name": "Test User", "email": "u@example.com"},
+                    "organization": {"member_id": 1, "enterprise_id": 1},
+                },
+            )
+        elif THUMBNAIL_PATH.match(path):
+            self._send(200, self.server.thumbnail, "text/plain")
+        else:
+            self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        # pylint: disable=missing-function-docstring,invalid-name
+        body = self._read_body()
+        path = self.path.split("?", 1)[0]
+        if path == "/asset/v1/content/assets/query":
+            self._send_json(200, self._listing())
+        elif path == "/asset/v1/content/assets":
+            asset = {**make_asset(999, 0), **json.loads(body or b"{}")}
+            self._send_json(201, asset)
+        elif path == "/asset/v1/content/categories":
+            self._send_json(201, {"id": 1234, **json.loads(body or b"{}")})
+        elif path == "/auth":
+            # Laasie's token endpoint.
+            self._send_json(200, {"token": "stub_laasie_token"})
+        elif path == "/sfmc":
+            # Laasie's endpoint for the SFMC settings of a tenant.
+            self._send_json(200, {"status": "ok"})
+        elif path == "/v2/token":
+            self._send_json(
+                200,
+                {
+                    "access_token": "stub_access_token",
+                    "refresh_token": "stub_refresh_token",
+                    "expires_in": 1079,
+                    "token_type": "Bearer",
+                    "rest_instance_url": "http://127.0.0.1/",
+                    "soap_instance_url": "http://127.0.0.1/",
+                    "scope": "documents_and_images_read",
+                },
+            )
+        else:
+            self._send_json(404, {"message": "Not found"})
+
+    def do_PATCH(self):
+        # pylint: disable=missing-function-docstring,invalid-name
+        body = self._read_body()
+        match = ASSET_PATH.match(self.path.split("?", 1)[0])
+        if match is None:
+            self._send_json(404, {"message": "Not found"})
+            return
+        asset = {**make_asset(int(match.group(1)), 0), **json.loads(body or b"{}")}
+        self._send_json(200, asset)
+
+
+class StubUpstreamServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server that counts the requests it answered.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency: float = 0.02, items: int = 25) -> None:
+        super().__init__(address, StubUpstreamHandler)
+        self.latency = latency
+        self.items = items
+        # Thumbnails are base64-encoded PNGs, like SFMC's.
+        self.thumbnail = base64.b64encode(make_png(320, 240))
+        self.requests_served = 0
+        self._count_lock = threading.Lock()
+
+    def count_request(self):
+        # pylint: disable=missing-function-docstring
+        with self._count_lock:
+            self.requests_served += 1
+
+
+def start_in_background(
+    port: int = 0, latency: float = 0.02, items: int = 25
+) -> StubUpstreamServer:
+    """
+    Starts a stub upstream on a daemon thread and returns it. The
+    actual port is available as `server.server_port`.
+    """
+    server = StubUpstreamServer(("127.0.0.1", port), latency=latency, items=items)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    # pylint: disable=missing-function-docstring
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds to wait per response."
+    )
+    parser.add_argument(
+        "--items", type=int, default=25, help="Assets returned per listing."
+    )
+    args = parser.parse_args()
+
+    server = StubUpstreamServer(
+        ("127.0.0.1", args.port), latency=args.latency, items=args.items
+    )
+    print(f"Stub upstream listening on http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Per-request tracing of the phases of a request.
+
+Each request records how long it spent in each phase (cookie
+verification, admission queue, upstream DNS lookup, connect, TLS
+handshake, time to first byte, body transfer and the `after_request`
+hooks) and reports them in a `Server-Timing` response header, which
+shows in the browser's devtools. Phases that repeat, such as the calls
+of a request to several upstreams, are summed. With `TRACE_LOG`, each
+request is also logged as a JSON line once its response is sent, which
+includes the transfer of streamed response bodies.
+
+Requests belong to the W3C trace context of their `traceparent` header,
+or to a new one, and the calls to SFMC and Laasie carry it on.
+Recording a phase only appends to a dict, so tracing can stay on for
+all requests.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import functools
+import json
+import re
+import secrets
+import time
+from typing import Callable, Iterator, Optional
+
+from flask import Flask, g, has_request_context, request as flask_request
+from flask.wrappers import Response
+
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("trace")
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+INVALID_TRACE_ID = "0" * 32
+INVALID_PARENT_ID = "0" * 16
+SAMPLED = "01"
+
+
+@dataclass
+class Trace:
+    """
+    The trace context and the phase durations of a request.
+    """
+
+    trace_id: str
+    parent_id: Optional[str] = None
+    flags: str = SAMPLED
+    started_at: float = field(default_factory=time.perf_counter)
+    # Seconds spent per phase, in the order the phases started.
+    phases: dict[str, float] = field(default_factory=dict)
+    after_request_started_at: Optional[float] = None
+
+    def record(self, phase: str, duration: float):
+        """
+        Adds the duration to the phase.
+        """
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration
+
+    def get_traceparent(self) -> str:
+        """
+        Returns the `traceparent` header for an outgoing call, with a new
+        span id.
+        """
+        return f"00-{self.trace_id}-{secrets.token_hex(8)}-{self.flags}"
+
+    def get_server_timing(self, total: float) -> str:
+        """
+        Returns the value of the `Server-Timing` header.
+        """
+        metrics = [f"{phase};dur={d * 1000:.1f}" for phase, d in self.phases.items()]
+        metrics.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def parse_traceparent(header: Optional[str]) -> Trace:
+    """
+    Returns a trace that continues the context of a `traceparent`
+    header, or a new trace if the header is missing or invalid.
+    """
+    match = TRACEPARENT.match(header.strip().lower()) if header else None
+    if (
+        match is None
+        or match.group(1) == INVALID_TRACE_ID
+        or match.group(2) == INVALID_PARENT_ID
+    ):
+        return Trace(trace_id=secrets.token_hex(16))
+    return Trace(
+        trace_id=match.group(1), parent_id=match.group(2), flags=match.group(3)
+    )
+
+
+def current() -> Optional[Trace]:
+    """
+    Returns the trace of the current request, if any.
+    """
+    if not has_request_context():
+        return None
+    return g.get("trace")
+
+
+def record(phase: str, duration: float):
+    """
+    Adds the duration to the phase of the current request's trace.
+    """
+    trace = current()
+    if trace is not None:
+        trace.record(phase, duration)
+
+
+@contextmanager
+def span(phase: str) -> Iterator[None]:
+    """
+    Records the time taken by the block in the current request's trace.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started_at)
+
+
+def traced(phase: str) -> Callable:
+    """
+    Decorates a function to record the time it takes as a phase.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def log_trace(trace: Trace, method: str, path: str, status_code: int):
+    """
+    Logs the trace of a finished request as a JSON line.
+    """
+    logger.info(
+        json.dumps(
+            {
+                "trace_id": trace.trace_id,
+                "parent_id": trace.parent_id,
+                "method": method,
+                "path": path,
+                "status": status_code,
+                "phases_ms": {
+                    phase: round(d * 1000, 2) for phase, d in trace.phases.items()
+                },
+                "total_ms": round((time.perf_counter() - trace.started_at) * 1000, 2),
+            }
+        )
+    )
+
+
+def mark_after_request(resp: Response) -> Response:
+    """
+    An `after_request` hook that marks the start of the `after_request`
+    phase. It must be registered after all the other hooks, since Flask
+    calls them in the reverse order of registration.
+    """
+    trace = current()
+    if trace is not None:
+        trace.after_request_started_at = time.perf_counter()
+    return resp
+
+
+def init_app(app: Flask):
+    """
+    Registers the tracing of all requests of the app. Call it before
+    registering the other `before_request` hooks so that their time is
+    traced too.
+    """
+
+    @app.before_request
+    def start_trace():
+        g.trace = parse_traceparent(flask_request.headers.get("traceparent"))
+
+    @app.after_request
+    def finish_trace(resp: Response) -> Response:
+        trace = current()
+        if trace is None:
+            return resp
+
+        now = time.perf_counter()
+        if trace.after_request_started_at is not None:
+            trace.record("after", now - trace.after_request_started_at)
+        resp.headers["Server-Timing"] = trace.get_server_timing(now - trace.started_at)
+
+        if env_config.TRACE_LOG:
+            resp.call_on_close(
+                functools.partial(
+                    log_trace,
+                    trace,
+                    flask_request.method,
+                    flask_request.path,
+                    resp.status_code,
+                )
+            )
+        return resp
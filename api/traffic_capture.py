@@ -0,0 +1,236 @@
+"""
+An opt-in capture of the metadata of the proxied SFMC calls, which
+`tools/replay_capture.py` replays against a local stand-in for SFMC.
+
+With CAPTURE_ENABLED, every call forwarded by `proxy_engine` appends a
+JSON line to the capture file once its response has been sent: when it
+started, its route, its status, the sizes of its request and response
+bodies, and the time spent waiting for SFMC and in total. The calls that
+the sub-requests of batches and the bulk transfers make through the
+proxied routes are written as calls of those routes once they have been
+read, and the thumbnail images and the Laasie payloads under routes of
+their own. The tenant and
+the upstream URL are only written as hashes keyed with SECRET_KEY, which
+tell tenants and assets apart without naming them. Tokens, cookies,
+query parameters and bodies are never written.
+
+Each line is appended with a single write to a file opened in append
+mode, so the workers of a server can share the file.
+"""
+from dataclasses import asdict, dataclass
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+from flask.wrappers import Response as FlaskResponse
+
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("traffic-capture")
+
+CAPTURE_FILE_NAME = "traffic_capture.ndjson"
+# The number of hex digits kept of the tenant and URL hashes.
+HASH_LENGTH = 12
+
+
+@dataclass
+class Record:
+    """
+    The metadata of a proxied call, as written to the capture file.
+    """
+
+    # The time the call started, in seconds since the epoch.
+    ts: float
+    route: str
+    tenant: str
+    # A hash of the upstream URL and query parameters.
+    key: str
+    status: int
+    request_bytes: int
+    response_bytes: int
+    # Milliseconds spent waiting for SFMC, or 0 if the response was
+    # answered locally or from the cache.
+    upstream_ms: float
+    total_ms: float
+    # Whether the items of the listing were projected with `fields`.
+    projected: bool = False
+
+
+@dataclass
+class Call:
+    """
+    What `proxy_engine` knows of a proxied call once it has a response.
+    """
+
+    route: str
+    tenant_subdomain: str
+    # The upstream URL, with the query string.
+    url: str
+    request_bytes: int
+    upstream_seconds: float
+    projected: bool
+
+
+class TrafficCapture:
+    """
+    Appends the records of the proxied calls to a file.
+    """
+
+    def __init__(self, path: str, secret: str, sample_rate: float = 1.0) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self._secret = secret.encode()
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._lock = threading.Lock()
+
+    def hash(self, value: str) -> str:
+        """
+        Returns the keyed hash of a value.
+        """
+        digest = hmac.new(self._secret, value.encode(), hashlib.sha256).hexdigest()
+        return digest[:HASH_LENGTH]
+
+    def write(self, record: Record):
+        """
+        Appends the record to the file as a JSON line.
+        """
+        line = json.dumps(asdict(record), separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._fd is None:
+                return
+            try:
+                os.write(self._fd, line.encode())
+            except OSError as ex:
+                logger.error("Could not write to %s: %s", self.path, ex)
+
+    def close(self):
+        """
+        Closes the file. The records written after it are dropped.
+        """
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def read_records(path: str) -> Iterator[Record]:
+    """
+    Yields the records of a capture file, skipping the invalid lines.
+    """
+    with open(path, encoding="utf-8") as capture_file:
+        for line in capture_file:
+            try:
+                yield Record(**json.loads(line))
+            except (TypeError, ValueError):
+                logger.warning("Skipping an invalid line of %s", path)
+
+
+def count_bytes(chunks: Iterable[bytes], counted: list[int]) -> Iterator[bytes]:
+    """
+    Yields the chunks of a streamed body and adds their sizes to
+    `counted[0]`.
+    """
+    for chunk in chunks:
+        counted[0] += len(chunk)
+        yield chunk
+
+
+def make_record(
+    traffic_capture: TrafficCapture,
+    call: Call,
+    status: int,
+    response_bytes: int,
+    started_ts: float,
+    started_at: float,
+) -> Record:
+    """
+    Returns the record of a call that has just ended.
+    """
+    return Record(
+        ts=round(started_ts, 3),
+        route=call.route,
+        tenant=traffic_capture.hash(call.tenant_subdomain),
+        key=traffic_capture.hash(call.url),
+        status=status,
+        request_bytes=call.request_bytes,
+        response_bytes=response_bytes,
+        upstream_ms=round(call.upstream_seconds * 1000, 1),
+        total_ms=round((time.monotonic() - started_at) * 1000, 1),
+        projected=call.projected,
+    )
+
+
+def capture(call: Call, resp: FlaskResponse, started_at: float):
+    """
+    Writes the record of a proxied call once its response has been sent.
+    `started_at` is the `time.monotonic()` at which the call started.
+    """
+    traffic_capture = _capture
+    if traffic_capture is None or random.random() >= traffic_capture.sample_rate:
+        return
+
+    response_bytes = [resp.calculate_content_length() or 0]
+    if resp.is_streamed:
+        resp.response = count_bytes(resp.response, response_bytes)
+    started_ts = time.time() - (time.monotonic() - started_at)
+    resp.call_on_close(
+        lambda: traffic_capture.write(
+            make_record(
+                traffic_capture,
+                call,
+                resp.status_code,
+                response_bytes[0],
+                started_ts,
+                started_at,
+            )
+        )
+    )
+
+
+def capture_read(call: Call, status: int, response_bytes: int, started_at: float):
+    """
+    Writes the record of a call whose response has been read into memory
+    instead of being sent to the client, such as a sub-request of a batch.
+    """
+    traffic_capture = _capture
+    if traffic_capture is None or random.random() >= traffic_capture.sample_rate:
+        return
+    started_ts = time.time() - (time.monotonic() - started_at)
+    traffic_capture.write(
+        make_record(
+            traffic_capture, call, status, response_bytes, started_ts, started_at
+        )
+    )
+
+
+_capture: Optional[TrafficCapture] = None
+
+
+def init_capture(instance_path: str) -> TrafficCapture:
+    """
+    Opens the capture file, CAPTURE_FILE or a file in the given instance
+    folder, and starts capturing the proxied calls.
+    """
+    global _capture  # pylint: disable=global-statement
+    if _capture is not None:
+        _capture.close()
+    _capture = TrafficCapture(
+        env_config.CAPTURE_FILE or os.path.join(instance_path, CAPTURE_FILE_NAME),
+        env_config.SECRET_KEY,
+        sample_rate=env_config.CAPTURE_SAMPLE_RATE,
+    )
+    logger.info("Capturing the proxied calls to %s", _capture.path)
+    return _capture
+
+
+def get_capture() -> Optional[TrafficCapture]:
+    """
+    Returns the capture if it is enabled.
+    """
+    return _capture
@@ -0,0 +1,211 @@
+"""
+Skips the updates of assets that wouldn't change anything.
+
+Saving a block from the UI looks the asset up by its customer key and
+then PATCHes its content, even when the content is the same as in SFMC,
+so re-saving templates uses up SFMC's write quota for nothing. The
+hashes of the writable fields of the assets read by those lookups and
+returned by the writes are kept, per access token like the response
+cache. An update whose fields all have the hashes of the asset's
+record, or of the asset index, is answered with a 200 and the
+`X-Write-Skipped: unchanged` header instead of being sent. The
+`X-Force-Write: true` request header sends it anyway.
+
+Someone else may change the asset in SFMC in the meantime, so the
+records and the index are only trusted for `UNCHANGED_WRITE_TTL`
+seconds: long enough to cover the lookup just before the write, but not
+a listing of a minute ago or an index between its syncs.
+
+The skipping is off unless `SKIP_UNCHANGED_WRITES` is set: the updates
+and the responses of the lookups and writes are then read into memory
+instead of being streamed.
+"""
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+from typing import Any, Optional
+
+from flask import has_request_context, request as flask_request
+
+from api import asset_index, json_codec, metrics
+from api.app_logger import get_logger
+from api.proxy_engine import ProxyRequest, UpstreamResponse
+from . import env_config
+
+logger = get_logger("unchanged-writes")
+
+# The fields of an asset whose updates can be skipped.
+WRITABLE_FIELDS = ("name", "description", "content")
+SKIPPED_HEADER = "X-Write-Skipped"
+FORCE_HEADER = "X-Force-Write"
+
+writes_total = metrics.counter(
+    "asset_writes_total", "Asset updates by result: sent, skipped or forced."
+)
+skipped_bytes_total = metrics.counter(
+    "asset_writes_skipped_bytes_total", "Bytes of the asset updates not sent to SFMC."
+)
+
+
+def field_hash(name: str, value: Any) -> str:
+    """
+    Returns the hash of the value of an asset's field. The content is
+    hashed like the asset index does.
+    """
+    if name == "content" and isinstance(value, str):
+        return asset_index.content_hash(value)
+    return hashlib.sha256(json_codec.dumps_canonical(value)).hexdigest()
+
+
+def get_hashes(asset: Any) -> dict[str, str]:
+    """
+    Returns the hashes of the writable fields of an asset.
+    """
+    if not isinstance(asset, dict):
+        return {}
+    return {
+        name: field_hash(name, asset[name]) for name in WRITABLE_FIELDS if name in asset
+    }
+
+
+_lock = threading.Lock()
+# The hashes of each asset's fields and when they were recorded, by
+# access token and asset id.
+_records: "OrderedDict[tuple[str, int], tuple[dict[str, str], float]]" = OrderedDict()
+
+
+def record(access_token: str, asset: Any):
+    """
+    Records the hashes of the fields of an asset read or written with
+    the access token.
+    """
+    hashes = get_hashes(asset)
+    if not hashes or not isinstance(asset.get("id"), int):
+        return
+    with _lock:
+        _records[access_token, asset["id"]] = (hashes, time.monotonic())
+        _records.move_to_end((access_token, asset["id"]))
+        while len(_records) > env_config.UNCHANGED_WRITE_MAX_ASSETS:
+            _records.popitem(last=False)
+
+
+def forget(access_token: str, asset_id: int):
+    """
+    Forgets the record of an asset.
+    """
+    with _lock:
+        _records.pop((access_token, asset_id), None)
+
+
+def get_record(access_token: str, asset_id: int) -> dict[str, str]:
+    """
+    Returns the hashes recorded for the asset, unless they are too old.
+    """
+    with _lock:
+        hashes, recorded_at = _records.get((access_token, asset_id), ({}, 0.0))
+    if time.monotonic() - recorded_at > env_config.UNCHANGED_WRITE_TTL:
+        return {}
+    return hashes
+
+
+def load_json(upstream_resp: UpstreamResponse) -> Any:
+    """
+    Returns the JSON body of a successful upstream response read into
+    memory, or None.
+    """
+    if upstream_resp.status_code not in (200, 201) or not isinstance(
+        upstream_resp.content, bytes
+    ):
+        return None
+    try:
+        return json_codec.loads(upstream_resp.content)
+    except ValueError:
+        return None
+
+
+def record_listing(proxy_request: ProxyRequest, upstream_resp: UpstreamResponse):
+    """
+    Records the assets of a listing read from SFMC.
+    """
+    listing = load_json(upstream_resp)
+    items = listing.get("items") if isinstance(listing, dict) else None
+    for item in items if isinstance(items, list) else ():
+        record(proxy_request.access_token, item)
+
+
+def record_write(proxy_request: ProxyRequest, upstream_resp: UpstreamResponse):
+    """
+    Records the asset returned by a write, or forgets the updated asset
+    if the write failed.
+    """
+    asset = load_json(upstream_resp)
+    if asset is not None:
+        record(proxy_request.access_token, asset)
+        return
+    asset_id = proxy_request.path_args.get("asset_id", "")
+    if asset_id.isdigit():
+        forget(proxy_request.access_token, int(asset_id))
+
+
+def is_forced() -> bool:
+    """
+    Returns whether the current request asks for writes to be sent. The
+    requests sent outside of its context carry it as `force_write`.
+    """
+    return (
+        has_request_context()
+        and flask_request.headers.get(FORCE_HEADER, "").lower() == "true"
+    )
+
+
+def skip_unchanged(proxy_request: ProxyRequest) -> Optional[UpstreamResponse]:
+    """
+    Answers an asset update that wouldn't change the asset, as far as
+    the recorded hashes go. Returns None to send it.
+    """
+    asset_id = proxy_request.path_args.get("asset_id", "")
+    if not asset_id.isdigit() or not isinstance(proxy_request.body, bytes):
+        writes_total.inc(result="sent")
+        return None
+    if proxy_request.force_write or is_forced():
+        writes_total.inc(result="forced")
+        return None
+    try:
+        body = json_codec.loads(proxy_request.body)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or not body or not set(body) <= set(WRITABLE_FIELDS):
+        writes_total.inc(result="sent")
+        return None
+
+    known = dict(get_record(proxy_request.access_token, int(asset_id)))
+    indexed = asset_index.get_content_hash(
+        proxy_request.tenant_subdomain,
+        proxy_request.access_token,
+        int(asset_id),
+        env_config.UNCHANGED_WRITE_TTL,
+    )
+    if indexed is not None:
+        known["content"] = indexed
+    if any(known.get(name) != field_hash(name, value) for name, value in body.items()):
+        writes_total.inc(result="sent")
+        return None
+
+    logger.info("skipping the unchanged update of asset %s", asset_id)
+    writes_total.inc(result="skipped")
+    skipped_bytes_total.inc(len(proxy_request.body))
+    return UpstreamResponse(
+        200,
+        "application/json",
+        json_codec.dumps({"id": int(asset_id)}),
+        headers={SKIPPED_HEADER: "unchanged"},
+    )
+
+
+def reset():
+    """
+    Forgets all the records.
+    """
+    with _lock:
+        _records.clear()
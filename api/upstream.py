@@ -0,0 +1,232 @@
+"""
+The HTTP session shared by all calls to SFMC and Laasie, and the URLs
+of the upstream hosts.
+
+Reusing one session keeps the connections to the upstream hosts, and
+their TLS sessions, open between requests instead of paying for a new
+handshake on every call. New connections look up the upstream hosts in
+`dns_cache` instead of doing a DNS lookup each.
+
+Calls made while serving a request carry on its trace context and
+record their DNS lookup, connect, TLS handshake, time to first byte and
+body transfer in its trace.
+"""
+import http.cookiejar
+import socket
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from api import dns_cache, http2_transport, tracing
+from . import env_config
+
+
+# The phases of an upstream call that happen before the request is sent.
+CONNECTION_PHASES = ("dns", "connect", "tls")
+
+
+class CachedDNSConnectionMixin:
+    """
+    Connects to the addresses of the host from the DNS cache, trying
+    each in turn. The host name is still used for TLS verification.
+    """
+
+    def connect(self):
+        # pylint: disable=missing-function-docstring
+        started_at = time.perf_counter()
+        self._new_conn_time = 0.0
+        super().connect()
+        if isinstance(self, HTTPSConnection):
+            elapsed = time.perf_counter() - started_at
+            tracing.record("tls", elapsed - self._new_conn_time)
+
+    def _new_conn(self):
+        started_at = time.perf_counter()
+        try:
+            return self._connect_to_cached_address()
+        finally:
+            self._new_conn_time = time.perf_counter() - started_at
+
+    def _connect_to_cached_address(self):
+        host = self._dns_host
+        try:
+            with tracing.span("dns"):
+                addresses = dns_cache.get_cache().resolve(host)
+        except socket.gaierror as ex:
+            raise NewConnectionError(self, f"Failed to resolve {host}: {ex}") from ex
+
+        try:
+            for address in addresses[:-1]:
+                self._dns_host = address
+                try:
+                    with tracing.span("connect"):
+                        return super()._new_conn()
+                except NewConnectionError:
+                    pass
+            self._dns_host = addresses[-1]
+            with tracing.span("connect"):
+                return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class CachedDNSHTTPConnection(CachedDNSConnectionMixin, HTTPConnection):
+    # pylint: disable=missing-class-docstring
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSConnectionMixin, HTTPSConnection):
+    # pylint: disable=missing-class-docstring
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    # pylint: disable=missing-class-docstring
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    # pylint: disable=missing-class-docstring
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class UpstreamAdapter(HTTPAdapter):
+    """
+    A transport adapter whose connections use the DNS cache.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        if env_config.DNS_CACHE_ENABLED:
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": CachedDNSHTTPConnectionPool,
+                "https": CachedDNSHTTPSConnectionPool,
+            }
+
+
+class UpstreamSession(requests.Session):
+    """
+    A session that sends the requests to the upstreams listed in
+    `UPSTREAM_HTTP2` with the HTTP/2 transport.
+
+    The session is shared by the requests of all users, so it never
+    keeps the cookies set by an upstream response.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = UpstreamAdapter(
+            pool_connections=env_config.UPSTREAM_POOL_HOSTS,
+            pool_maxsize=env_config.UPSTREAM_POOL_MAXSIZE,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+        self.http2_urls = http2_transport.get_url_pattern(env_config.UPSTREAM_HTTP2)
+        self.http2_adapter = None
+        if self.http2_urls is not None:
+            self.http2_adapter = http2_transport.make_adapter()
+
+    def request(self, method, url, *args, **kwargs):
+        # pylint: disable=missing-function-docstring
+        trace = tracing.current()
+        if trace is None:
+            return super().request(method, url, *args, **kwargs)
+
+        kwargs["headers"] = {
+            **(kwargs.get("headers") or {}),
+            "traceparent": trace.get_traceparent(),
+        }
+        connection_time = sum(trace.phases.get(p, 0.0) for p in CONNECTION_PHASES)
+        started_at = time.perf_counter()
+        headers_received_at = None
+
+        def on_response(resp, **_):
+            nonlocal headers_received_at
+            headers_received_at = time.perf_counter()
+            return resp
+
+        hooks = dict(kwargs.get("hooks") or {})
+        hooks["response"] = [*_as_list(hooks.get("response")), on_response]
+        kwargs["hooks"] = hooks
+        resp = super().request(method, url, *args, **kwargs)
+
+        if headers_received_at is not None:
+            # The time to first byte excludes setting up the connection.
+            connection_time = (
+                sum(trace.phases.get(p, 0.0) for p in CONNECTION_PHASES)
+                - connection_time
+            )
+            trace.record("ttfb", headers_received_at - started_at - connection_time)
+            if not kwargs.get("stream"):
+                trace.record("transfer", time.perf_counter() - headers_received_at)
+        return resp
+
+    def get_adapter(self, url):
+        if self.http2_adapter is not None and self.http2_urls.match(url):
+            return self.http2_adapter
+        return super().get_adapter(url)
+
+    def close(self):
+        super().close()
+        if self.http2_adapter is not None:
+            self.http2_adapter.close()
+
+
+def _as_list(hooks) -> list:
+    if hooks is None:
+        return []
+    if callable(hooks):
+        return [hooks]
+    return list(hooks)
+
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the shared session, creating it if needed.
+    """
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = UpstreamSession()
+    return _session
+
+
+def reset():
+    """
+    Closes the shared session and its pooled connections. The next call
+    to `get_session` creates a new one.
+    """
+    global _session  # pylint: disable=global-statement
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def sfmc_rest_url(tenant_subdomain: str, request_path: str) -> str:
+    """
+    Returns the URL of a REST API path for the customer's SFMC instance.
+    """
+    base_url = env_config.SFMC_REST_BASE_URL.format(tssd=tenant_subdomain)
+    return f"{base_url}{request_path}"
+
+
+def sfmc_auth_url(tenant_subdomain: str, request_path: str) -> str:
+    """
+    Returns the URL of an auth API path for the customer's SFMC instance.
+    """
+    base_url = env_config.SFMC_AUTH_BASE_URL.format(tssd=tenant_subdomain)
+    return f"{base_url}{request_path}"
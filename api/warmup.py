@@ -0,0 +1,201 @@
+"""
+Prefetches the data the UI requests right after login.
+
+After the OAuth2 callback and every token refresh, the UI requests the
+user info, the Content Builder categories and the Laasie HTML blocks.
+A warmup fetches those in the background with the new access token and
+stores them in the response cache, which also opens pooled connections
+to the tenant's REST and auth hosts. Warmups never block the request
+that scheduled them: they run on a small bounded thread pool, are
+dropped when too many are pending and can be cancelled.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import json
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from api import deadlines, metrics, response_cache, upstream
+from api.app_logger import get_logger
+from . import env_config
+
+logger = get_logger("warmup")
+
+# Keep in sync with `defaultCategoryName` and `listExistingHtmlBlocks`
+# in the UI's `sfmcClient.ts`.
+DEFAULT_CATEGORY_NAME = "Laasie Collection Templates"
+HTML_BLOCKS_QUERY = json.dumps(
+    {
+        "page": {"page": 1, "pageSize": 50},
+        "query": {
+            "leftOperand": {
+                "property": "assetType.name",
+                "simpleOperator": "equal",
+                "value": "htmlblock",
+            },
+            "logicalOperator": "AND",
+            "rightOperand": {
+                "property": "category.name",
+                "simpleOperator": "equal",
+                "value": DEFAULT_CATEGORY_NAME,
+            },
+        },
+    }
+).encode()
+
+warmups = metrics.counter("warmups_total", "Post-login warmups by outcome.")
+warmup_duration = metrics.histogram(
+    "warmup_duration_seconds", "Time taken by completed warmups."
+)
+
+
+@dataclass
+class WarmupJob:
+    """
+    A scheduled warmup for an access token.
+    """
+
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    future: Optional[Future] = None
+
+
+_lock = threading.Lock()
+_jobs: dict[str, WarmupJob] = {}
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor  # pylint: disable=global-statement
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=env_config.WARMUP_MAX_WORKERS, thread_name_prefix="warmup"
+        )
+    return _executor
+
+
+def get_warmup_requests(
+    tenant_subdomain: str,
+) -> list[tuple[str, str, Optional[bytes]]]:
+    """
+    Returns the method, URL and body of each request that is prefetched.
+    These must match the requests the proxy makes for the UI so that
+    they share cache entries.
+    """
+    return [
+        ("GET", upstream.sfmc_auth_url(tenant_subdomain, "/v2/userinfo"), None),
+        (
+            "GET",
+            upstream.sfmc_rest_url(tenant_subdomain, "/asset/v1/content/categories"),
+            None,
+        ),
+        (
+            "POST",
+            upstream.sfmc_rest_url(tenant_subdomain, "/asset/v1/content/assets/query"),
+            HTML_BLOCKS_QUERY,
+        ),
+    ]
+
+
+def schedule(tenant_subdomain: str, access_token: str) -> Optional[WarmupJob]:
+    """
+    Schedules a warmup for the access token and returns immediately.
+    Returns None if warmups are disabled or too many are pending.
+    """
+    if not env_config.WARMUP_ENABLED:
+        return None
+
+    scope = response_cache.token_scope(access_token)
+    with _lock:
+        if scope in _jobs:
+            return _jobs[scope]
+        if len(_jobs) >= env_config.WARMUP_MAX_PENDING:
+            warmups.inc(outcome="dropped")
+            return None
+        job = WarmupJob()
+        _jobs[scope] = job
+
+    job.future = _get_executor().submit(
+        _run, job, scope, tenant_subdomain, access_token
+    )
+    return job
+
+
+def cancel(access_token: str):
+    """
+    Cancels the pending warmup of the access token, if any.
+    """
+    with _lock:
+        job = _jobs.pop(response_cache.token_scope(access_token), None)
+    if job is not None:
+        job.cancelled.set()
+        if job.future is not None:
+            job.future.cancel()
+
+
+def _run(job: WarmupJob, scope: str, tenant_subdomain: str, access_token: str):
+    started_at = time.monotonic()
+    deadline = started_at + env_config.WARMUP_TIMEOUT
+    outcome = "completed"
+    try:
+        for method, url, body in get_warmup_requests(tenant_subdomain):
+            remaining = deadline - time.monotonic()
+            if job.cancelled.is_set():
+                outcome = "cancelled"
+                return
+            if remaining <= 0:
+                outcome = "timed_out"
+                return
+
+            key = response_cache.make_key(access_token, url, body=body)
+            if response_cache.get(key) is not None:
+                continue
+
+            headers = {"Authorization": f"Bearer {access_token}"}
+            if body is not None:
+                headers["Content-Type"] = "application/json"
+            http_resp = deadlines.send(
+                method,
+                url,
+                "warmup",
+                env_config.UPSTREAM_TIMEOUT,
+                deadline,
+                data=body,
+                headers=headers,
+            )
+            if http_resp.status_code == 200 and not job.cancelled.is_set():
+                response_cache.put(
+                    key,
+                    http_resp.status_code,
+                    http_resp.headers.get("Content-Type", "application/json"),
+                    http_resp.content,
+                )
+    except requests.RequestException as ex:
+        outcome = "failed"
+        logger.error("Warmup for tenant %s failed: %s", tenant_subdomain, ex)
+    finally:
+        with _lock:
+            if _jobs.get(scope) is job:
+                del _jobs[scope]
+        warmups.inc(outcome=outcome)
+        if outcome == "completed":
+            warmup_duration.observe(time.monotonic() - started_at)
+
+
+def reset():
+    """
+    Cancels all warmups and discards the thread pool. The next warmup
+    creates a new one.
+    """
+    global _executor  # pylint: disable=global-statement
+    with _lock:
+        jobs = list(_jobs.values())
+        _jobs.clear()
+        executor = _executor
+        _executor = None
+    for job in jobs:
+        job.cancelled.set()
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -74,16 +74,18 @@ export async function refreshSfmcToken() {
 
 export async function getAssetByCustomerKey(
     name: string
-): Promise<Asset | undefined> {
+): Promise<Pick<Asset, "id" | "customerKey"> | undefined> {
     try {
-        const response = await client.get<SfmcResponse<Asset>>(
-            "/api/sfmc/asset/v1/content/assets",
-            {
-                params: {
-                    $filter: `customerKey eq '${name}'`,
-                },
-            }
-        );
+        const response = await client.get<
+            SfmcResponse<Pick<Asset, "id" | "customerKey">>
+        >("/api/sfmc/asset/v1/content/assets", {
+            params: {
+                $filter: `customerKey eq '${name}'`,
+                // Only ask for indexed fields so that the API can answer
+                // from its asset index.
+                fields: "id,customerKey",
+            },
+        });
         if (!response.data.count) {
             return;
         }
@@ -175,7 +177,11 @@ async function createAsset(
     }
 }
 
-async function updateAsset(assetId: number, html: string): Promise<void> {
+/**
+ * Updates the content of an asset. Returns false if the asset no longer
+ * exists.
+ */
+async function updateAsset(assetId: number, html: string): Promise<boolean> {
     const body: PatchAssetRequest = {
         content: html,
     };
@@ -190,7 +196,11 @@ async function updateAsset(assetId: number, html: string): Promise<void> {
                 },
             }
         );
+        return true;
     } catch (err) {
+        if (axios.isAxiosError(err) && err.response?.status === 404) {
+            return false;
+        }
         const msg = "Failed to update the asset";
         console.error(msg, err);
         throw new Error(msg);
@@ -238,7 +248,11 @@ export async function upsertAsset(
         return;
     }
 
-    await updateAsset(existingAsset.id, html);
+    // The lookup may be answered by the API's asset index, which only
+    // notices deleted assets periodically.
+    if (!(await updateAsset(existingAsset.id, html))) {
+        await createAsset(key, name, html);
+    }
 }
 
 export async function getThumbnailBase64(
@@ -256,6 +270,18 @@ export async function getThumbnailBase64(
     return "";
 }
 
+/**
+ * Returns the URL of the thumbnail image of an asset, resized by the API
+ * to fit within the width and height and cached by the browser.
+ */
+export function getThumbnailImageUrl(
+    thumbnailUrl: string,
+    width: number,
+    height: number
+): string {
+    return `/api/sfmc/asset${thumbnailUrl}/image?w=${width}&h=${height}`;
+}
+
 export async function getUserInfo(): Promise<UserInfo> {
      
     const response = await client.get<UserInfo>("/api/sfmc/userinfo");